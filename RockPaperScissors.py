@@ -1,290 +1,581 @@
-import cupy as cp
+import numpy as np
+from backend import get_backend, asnumpy, is_cupy
+from kernels import neighbor_counts, neighbor_flat_index, pack_2bit, unpack_2bit, state_counts, packed_state_counts, sublattice_swaps, swap_state_bits, OFFSETS_Y, OFFSETS_X, SWAP_SUBSTEPS
+from entropy import entropy_log_table, boundary_complexity, EntropyTracker
+from sparse import check_tile_size, written_tiles, tile_windows, window_cells, window_margin, BLOCK_TILES, WINDOW_BATCH_CELLS
+from profiling import NULL_PROFILER
+from checkpoint import capture_state, write_checkpoint, read_checkpoint
+from rng import CounterRNG, SEEDING_STEP, to_threshold, lookup_thresholds, uniform_bits, direction_bits
+from rules import RuleSet
 
 
 class RockPaperScissors():
   '''
-  Initializes our Rock Paper Scissors game instance, with neighbor-sensitive rules
+  Initializes our Rock Paper Scissors game instance, with neighbor-sensitive rules (mode='neighbor-sensitive')
   This means, once some threshold (default 2) is reached, then a transition condition is checked,
-  for every neighboring cell that imposes this transition condition
+  for every neighboring cell that imposes this transition condition.
+  mode='agnostic' plays the neighbor-agnostic rules instead (see RockPaperScissorsAgnostic)
 
   Expects height, width, density and transition probabilities, where the probabilities are floats that some to one formatted as [p_settle, p_competition, p_mobility]
 
-  We assign rock->1, paper->2, scissors->3
+  backend picks the array library ('cupy', 'numpy' or 'auto'; defaults to the RPS_BACKEND environment variable).
+  Randomness is counter-based (see rng.py): every cell draws one word per step from (seed, stream, step, cell index),
+  so a run replays exactly from its seed on any backend, and from any step given the grid at that step.
+  seed=None picks a fresh seed and stores it in .seed; stream tells apart independent runs sharing a seed
+
+  rules=rules.RuleSet(...) swaps in other species and dominance graphs (RuleSet.rpsls(), RuleSet.cyclic(n),
+  RuleSet.tournament(n), any matrix of per-pair rates), in either mode. The default is RuleSet.rps(mode).
+  Everything that only depends on the rules and probabilities (the rules' lookup tables, the entropy's log q table)
+  is built once per set of probabilities and reused every step; assign new p_settle / p_competition / p_mobility
+  values (rather than modifying them in place) to change them mid-run
+
+  The lattice is stored as uint8 (states 0..n_species). packed=True stores it 2-bit packed instead,
+  4 cells per byte - this needs the second grid dimension to be divisible by 4 (and at most 3 species).
+  Packing only compacts the stored lattice between steps, and counting reads the packed bytes directly. Stepping
+  and entropy work on a full uint8 copy unpacked from it (seeding builds one too), and a step's result is repacked,
+  so a step's peak memory is the dense step's plus the packed copy: packed mode saves memory between steps, not during them
+
+  Population counts recorded with update(counting=True) go into a preallocated device-side buffer of history_capacity
+  steps, and only reach the host in bulk: when the buffer fills up, every history_sync_interval records (if set),
+  or when history is read
+
+  track_entropy=True keeps an EntropyTracker (pair histogram of cell/neighbor types) updated from the cells each
+  update() changes, so get_entropy() every step costs O(changed cells) instead of a pass over the whole lattice
+
+  sparse_tile=T steps only the T x T tiles that can change (plus a margin) instead of the whole lattice, which pays off
+  once the lattice is mostly empty space and single-species domains. The result is identical to a dense step.
+  T must be even, at least 8 and divide both lattice dimensions
+
+  save_checkpoint(path) writes the whole state of the run (lattice, step, seed, stream, probabilities, rules, history)
+  atomically to one file, and RockPaperScissors.load_checkpoint(path) restores it to continue bit-identically;
+  checkpoint.Checkpointer does it periodically from a background thread
+
+  profiler=profiling.Profiler(xp) times every phase of update() (random words, neighbor counts, probabilities,
+  masks, settlement, domination, mobility, ...) and counts settling, dominated and moving cells each step
+
+  Both lattice dimensions must be even: mobility swaps individuals pairwise on alternating sublattices
+
+  We assign rock->1, paper->2, scissors->3 (species s of a RuleSet is state s)
   '''
 
   # build grid
-  def __init__(self, dims=[512,512], density=0.25, probs=[0.25,0.5,0.25]):
+  def __init__(self, dims=[512,512], density=0.25, probs=[0.25,0.5,0.25], backend=None, seed=None, packed=False,
+               history_capacity=1024, history_sync_interval=None, track_entropy=False, stream=0, sparse_tile=None,
+               profiler=None, rules=None, mode=None):
+    self.xp = get_backend(backend) # cupy on GPU nodes, numpy otherwise
+    self.stream = stream
+    self.rng = CounterRNG(seed, self.xp, stream) # Draws depend only on (seed, stream, step, cell), never on call order
+    self.seed = self.rng.seed # Filled in when seed is None, so the run can still be replayed
+    self.step = 0 # Steps since seeding: the counter our random words are keyed by
     self.width, self.height = dims
-    self.grid = cp.zeros(dims, dtype=cp.int32) # Specify dtype
-    self.species = [1,2,3] #How many species do we want in our system?
+    self.shape = tuple(dims) # Shape of the lattice array
+    if self.width % 2 or self.height % 2:
+      raise ValueError(f"Lattice dimensions must be even (mobility swaps on alternating sublattices), got {dims}")
+    if rules is not None and mode is not None and rules.mode != mode:
+      raise ValueError(f"mode='{mode}' contradicts the rules' mode '{rules.mode}'")
+    self.rules = rules or RuleSet.rps(mode or 'neighbor-sensitive') # Species and who dominates whom
+    self.n_states = self.rules.n_states # Species plus the empty state
+    self.packed = packed # 2-bit packed storage (4 cells per byte) instead of one uint8 per cell
+    if packed and self.n_states > 4:
+      raise ValueError(f"Packed storage holds at most 3 species (2 bits per cell), got {self.rules.n_species}")
+    self.grid = self.xp.zeros(self.shape, dtype=self.xp.uint8) # Specify dtype
+    self.species = list(range(1, self.n_states)) #How many species do we want in our system?
     self.counts = [0 for i in range(len(self.species))] # Array of population counts, for statistics later
-    self.history = [] # Initialize history list
+    self.history_capacity = history_capacity # Steps of counts kept on the device between bulk transfers
+    self.history_sync_interval = history_sync_interval # Optionally move counts to the host every this many records
+    self._history_buffer = None # (history_capacity, ..., n_states) device array, allocated on first use
+    self._history_fill = 0 # Rows of _history_buffer not yet transferred
+    self._host_history = [] # Host-side chunks of already transferred counts
+    self.track_entropy = track_entropy
+    self._entropy_tracker = None # Built lazily from the current grid, then updated from per-step changes
+    self.sparse_tile = sparse_tile # Tile size for sparse active-region stepping (None = dense)
+    if sparse_tile:
+      check_tile_size(sparse_tile, self.shape)
+    self.profiler = profiler or NULL_PROFILER # Opt-in per-phase timing and event counts (see profiling.py)
     self.density = density #change for different density initialization
 
     #transition probabilities
     self.p_settle, self.p_competition, self.p_mobility = probs
+    self._precomputed_for = None # (rules, p_settle, p_competition, p_mobility) the cached tables below were built for
+    self._precomputed = {}
+
+  @property
+  def grid(self):
+    ''' The lattice as a uint8 array of states 0..n_species (in packed mode, a full unpacked copy made on every access) '''
+    if self.packed:
+      return unpack_2bit(self._grid, self.xp)
+    return self._grid
+
+  @grid.setter
+  def grid(self, value):
+    self._store_grid(value)
+    self._entropy_tracker = None # An externally assigned grid invalidates the incremental entropy state
+
+  def _store_grid(self, value):
+    if self.packed:
+      self._grid = pack_2bit(value, self.xp)
+    else:
+      self._grid = value.astype(self.xp.uint8, copy=False)
+
+  @property
+  def packed_grid(self):
+    ''' 2-bit packed copy of the lattice (4 cells per byte), e.g. for compact snapshots '''
+    if self.packed:
+      return self._grid
+    return pack_2bit(self._grid, self.xp)
+
+  def _state_counts(self):
+    ''' Population of every state (empties included) in one pass over the stored (compact) layout '''
+    if self.packed:
+      return packed_state_counts(self._grid, self.xp)
+    return state_counts(self._grid, self.xp, self.n_states) # One bincount over all states instead of a pass per species
+
+  def _species_counts(self):
+    ''' Population of each species, as a list of (device) arrays '''
+    counts = self._state_counts()
+    return [counts[..., species_type] for species_type in self.species]
+
+  def record_counts(self):
+    '''
+    Counts every state with a single bincount and stores the result in the device-side history buffer.
+    Nothing is copied to the host here, so recording every step doesn't stall the simulation
+    '''
+    self._append_history(self._state_counts())
+
+  def _append_history(self, counts):
+    ''' Stores one step's (..., n_states) state counts in the device-side history buffer '''
+    xp = self.xp
+    self.counts = [counts[..., species_type] for species_type in self.species]
+
+    if self._history_buffer is None:
+      self._history_buffer = xp.empty((self.history_capacity,) + counts.shape, dtype=xp.int64)
+    elif self._history_fill == self.history_capacity:
+      self.sync_history() # Buffer full: move it to the host in one transfer and start refilling it
+    self._history_buffer[self._history_fill] = counts
+    self._history_fill += 1
+
+    if self.history_sync_interval and self._history_fill % self.history_sync_interval == 0:
+      self.sync_history()
+
+  def sync_history(self):
+    ''' Transfers all counts recorded on the device since the last sync to the host, in bulk '''
+    if self._history_fill:
+      chunk = asnumpy(self._history_buffer[:self._history_fill])
+      if not is_cupy(self.xp):
+        chunk = chunk.copy() # On numpy that was a view of rows the buffer is about to refill
+      self._host_history.append(chunk)
+      self._history_fill = 0
+
+  def get_history(self, include_empty=False):
+    '''
+    Every recorded count as a host numpy array of shape (steps, ..., n_species),
+    or (steps, ..., n_states) with the empty-cell count in column 0 if include_empty
+    '''
+    self.sync_history()
+    if self._host_history:
+      history = self._host_history[0] if len(self._host_history) == 1 else np.concatenate(self._host_history)
+      self._host_history = [history] # Keep a single chunk so repeated reads don't re-concatenate
+    else:
+      history = np.zeros((0,) + self.shape[:-2] + (self.n_states,), dtype=np.int64)
+    return history if include_empty else history[..., self.species]
+
+  @property
+  def history(self):
+    ''' Recorded species counts, (steps, ..., n_species) on the host '''
+    return self.get_history()
+
+  def _per_lattice(self, value):
+    ''' A parameter as an array with one entry per lattice (0-d here; one per replica in an ensemble) '''
+    return self.xp.asarray(value, dtype=self.xp.float32).reshape(self.shape[:-2])
+
+  def _parameter_tables(self, name):
+    '''
+    Tables that only depend on the rules and probabilities, built on first use and kept until one of them is
+    reassigned: 'rules' (the RuleTables of every lattice) or 'entropy' (the log2 q table)
+    '''
+    parameters = (self.rules, self.p_settle, self.p_competition, self.p_mobility)
+    if self._precomputed_for is None or any(a is not b for a, b in zip(parameters, self._precomputed_for)):
+      self._precomputed_for = parameters # Holding the objects themselves, so their identities can't be reused
+      self._precomputed = {}
+    if name not in self._precomputed:
+      p_settle, p_competition, p_mobility = [self._per_lattice(p) for p in parameters[1:]]
+      if name == 'rules':
+        self._precomputed[name] = self.rules.compile(p_settle, p_competition, p_mobility, self.xp)
+      else:
+        self._precomputed[name] = entropy_log_table(p_settle, p_competition, self.xp, self.rules.interaction)
+    return self._precomputed[name]
+
+  def _checkpoint_arguments(self):
+    ''' Constructor arguments that rebuild this game's configuration, as JSON-serializable values '''
+    host = lambda value: np.asarray(asnumpy(value)).tolist()
+    rules = self.rules
+    return dict(dims=list(self.shape[-2:]), density=host(self.density),
+                probs=[host(p) for p in (self.p_settle, self.p_competition, self.p_mobility)],
+                seed=self.seed, stream=self.stream, packed=self.packed, history_capacity=self.history_capacity,
+                history_sync_interval=self.history_sync_interval, track_entropy=self.track_entropy,
+                sparse_tile=self.sparse_tile,
+                rules=dict(dominance=rules.dominance[1:, 1:].tolist(), mode=rules.mode, threshold=rules.threshold, names=rules.names))
+
+  def save_checkpoint(self, path):
+    ''' Writes the complete state of the run to path (an .npz file), atomically (see checkpoint.py) '''
+    write_checkpoint(path, *capture_state(self))
+
+  @classmethod
+  def load_checkpoint(cls, path, **overrides):
+    '''
+    A game restored from a save_checkpoint() file, continuing exactly where the saved run was.
+    overrides replace constructor arguments that don't change the dynamics, e.g. backend, profiler or sparse_tile
+    '''
+    arrays, header = read_checkpoint(path)
+    if header['engine'] != cls.__name__:
+      raise ValueError(f"'{path}' holds a {header['engine']} checkpoint, not a {cls.__name__} one")
+    arguments = dict(header['arguments'], rules=RuleSet(**header['arguments']['rules']))
+    arguments.update(overrides)
+    game = cls(**arguments)
+    grid = game.xp.asarray(arrays['grid'])
+    game.grid = unpack_2bit(grid, game.xp) if header['packed'] else grid
+    game.step = header['step']
+    history = arrays['history']
+    game._host_history = [history] if len(history) else []
+    game.counts = game._species_counts()
+    return game
 
   def seeding(self):
     ''' Get starting positions of our grid '''
+    xp = self.xp
     density = self.density
-    width,height = self.width,self.height
-    # Sample values for the entire grid
-    values = cp.random.choice([1, 2, 3], size=(width, height), p=[1/3, 1/3, 1/3]).astype(cp.int32) 
-    toggles = cp.random.choice([True, False], size=(width, height), p=[density, 1-density])
+    # One random word per cell at the reserved seeding step: the low half decides occupancy, the high half
+    # picks the species uniformly over 1..n_species (multiply-shift of its 24 uniform bits, so no modulo bias)
+    word_lo, word_hi = self.rng.lattice_words(self.shape, SEEDING_STEP)
+    values = (1 + ((uniform_bits(word_hi) * len(self.species)) >> 24)).astype(xp.uint8)
+    toggles = uniform_bits(word_lo) < to_threshold(self._per_lattice(density)[..., None, None], xp)
     # Update the grid where toggle is True
-    self.grid = cp.where(toggles, values, 0) # Apply values only where toggles is True
+    self.grid = xp.where(toggles, values, xp.uint8(0)) # Apply values only where toggles is True
+
+    self.step = 0
 
     # Count the number of each species after seeding
-    for i, species_type in enumerate(self.species):
-        self.counts[i] = cp.sum(self.grid == species_type)
+    self.counts = self._species_counts()
 
   def get_entropy(self):
     '''
-    Calculates the 'border complexity' or entropy of the system using CuPy broadcasting.
+    Calculates the 'border complexity' or entropy of the system using array broadcasting.
     This involves calculating global species proportions, constructing a lookup table for
     relation probabilities (q_values), and then computing the entropic contribution
     for all cell-neighbor pairs in parallel.
 
-    Returns: scaled boundary entropy (cupy32 float)
+    Returns: scaled boundary entropy (float32 array on the engine's backend, 0-d for a single lattice)
     '''
-    p_settle = self.p_settle
-    p_competition = self.p_competition
-
-    current_grid = self.grid
-    current_height, current_width = current_grid.shape
-    total_cells = current_grid.size
-
-    # Calculate global species proportions (p(x))
-    species_proportions = cp.zeros(4, dtype=cp.float32)
-    species_proportions[0] = cp.sum(current_grid == 0) / total_cells # Empty cells
-    species_proportions[1] = cp.sum(current_grid == 1) / total_cells # Rock
-    species_proportions[2] = cp.sum(current_grid == 2) / total_cells # Paper
-    species_proportions[3] = cp.sum(current_grid == 3) / total_cells # Scissors
+    xp = self.xp
 
     #Construct the q_lookup_table_log - efficient way to get q(x,y) contributions
-    # Initialize with default competition log value for non-empty, different species interaction
-    # this gives the minimal number of changes to our matrix
-    q_lookup_table_log = cp.full((4, 4), cp.log2(1 - p_competition), dtype=cp.float32)
-
-    #Set same species or both empty (t, t) to log2(1) = 0
-    for t in range(4):
-        q_lookup_table_log[t, t] = cp.log2(1.0)
-
-    #Set empty cell (0, t) with non-empty neighbor to log2(1 - p_settle)
-    for t in [1, 2, 3]:
-        q_lookup_table_log[0, t] = cp.log2(1 - p_settle)
-
-    #Set non-empty cell (t, 0) with empty neighbor to log2(1 - p_settle)
-    for t in [1, 2, 3]:
-        q_lookup_table_log[t, 0] = cp.log2(1 - p_settle)
-
-    #Prepare current_grid and neighbors
-    padded_grid = cp.pad(current_grid, 1, mode='wrap') # Use wrap to handle toroidal grid
-
-    neighbors = cp.zeros((8, current_height, current_width), dtype=cp.int32)
-    neighbors[0] = padded_grid[:-2, :-2] # Top-left
-    neighbors[1] = padded_grid[:-2, 1:-1] # Top-center
-    neighbors[2] = padded_grid[:-2, 2:]   # Top-right
-    neighbors[3] = padded_grid[1:-1, :-2] # Middle-left
-    neighbors[4] = padded_grid[1:-1, 2:]   # Middle-right
-    neighbors[5] = padded_grid[2:, :-2]   # Bottom-left
-    neighbors[6] = padded_grid[2:, 1:-1] # Bottom-center
-    neighbors[7] = padded_grid[2:, 2:]   # Bottom-right
-
-    #Compute entropic contribution using broadcasting
-    current_grid_reshaped = current_grid[cp.newaxis, :, :]
-
-    #Look up the cp.log2(q(x,y)) values for all cell-neighbor pairs
-    log_q_values = q_lookup_table_log[current_grid_reshaped, neighbors]
+    #(one n_states x n_states table per lattice, built once per set of probabilities)
+    q_lookup_table_log = self._parameter_tables('entropy')
 
-    #Calculate the weight_grid_values for each cell based on its species type
-    #species_proportions is 1D (length 4), current_grid is 2D (height x width)
-    #This uses advanced indexing to map each cell's type to its proportion
-    weight_grid_values = species_proportions[current_grid]
+    if self.track_entropy:
+      #The tracker already holds the pair histogram and species counts, so this is closed-form
+      if self._entropy_tracker is None:
+        self._entropy_tracker = EntropyTracker(self.grid, xp, self.n_states)
+      return self._entropy_tracker.entropy(q_lookup_table_log)
 
-    #Compute the entropic contribution for each cell-neighbor pair
-    #Reshape weight_grid_values for broadcasting with log_q_values (8, height, width)
-    entropic_contributions = (1/8) * weight_grid_values[cp.newaxis, :, :] * log_q_values
+    #Histogram all (cell type, neighbor type) pairs with one fused neighbor-count pass,
+    #then weight the histogram by p(x) and log2 q(x,y) and apply the sqrt(H*W) scaling
+    return boundary_complexity(self.grid, q_lookup_table_log, xp)
 
-    #Sum these contributions
-    total_entropy = -cp.sum(entropic_contributions)
 
-    #Apply the scaling factor
-    scaled_total_entropy = total_entropy / cp.sqrt(current_height * current_width)#2D -> 1D
 
-    #Return the final total_entropy
-    return scaled_total_entropy
-
-
-
-  def update(self, counting=False):
+  def _transition(self, current_grid, word_lo, word_hi, tables, substep_order, counted=None):
     '''
-    Markov process where we update our grid based on starting probabilities.
-    Integrates settlement, domination, and mobility as concurrent, mutually exclusive actions.
-    Dominated cells become empty, mobility involves swapping with a neighbor.
-
-    Returns: updated grid (cupy array)
+    One step of the rules applied to a (..., H, W) stack of toroidal lattices: the whole lattice on a dense step,
+    or the windows around active tiles on a sparse one. word_lo / word_hi are the cells' random words for this step,
+    tables are the rules' RuleTables with one row per stacked lattice (or one set shared by all of them), and
+    substep_order is this step's mobility substep order. counted is the slice of rows and columns whose events the
+    profiler counts: the window centers on a sparse step (their margins overlap and are stepped again elsewhere),
+    None for the whole stack.
+
+    Returns: the new stack (current_grid is left untouched)
     '''
-    global p_settle, p_competition, p_mobility # Access global probability constants
-
-    current_grid = self.grid
-    current_height, current_width = current_grid.shape
+    xp = self.xp
+    profiler = self.profiler # NULL_PROFILER unless profiling: its spans and counters are no-ops
+    current_height, current_width = current_grid.shape[-2:]
+    count = lambda name, mask: profiler.count(name, mask if counted is None else mask[..., counted, counted])
 
     # Initialize new_grid with the current_grid state.
     # Cells not affected by any rule will retain their state.
-    new_grid = cp.copy(current_grid)
-
-    # 1. Pad the grid to handle neighbors at edges (for neighbor calculations)
-    padded_grid = cp.pad(current_grid, 1, mode='wrap') # Use wrap to handle toroidal grid
-
-    # 2. Get neighbor values for each cell in the current_grid
-    #We store as an 8-depth 3D tensor so each cell has its neighbor dynamics easily caluclated!
-    neighbors = cp.zeros((8, current_height, current_width), dtype=cp.int32)
-    neighbors[0] = padded_grid[:-2, :-2] # Top-left
-    neighbors[1] = padded_grid[:-2, 1:-1] # Top-center
-    neighbors[2] = padded_grid[:-2, 2:]   # Top-right
-    neighbors[3] = padded_grid[1:-1, :-2] # Middle-left
-    neighbors[4] = padded_grid[1:-1, 2:]   # Middle-right
-    neighbors[5] = padded_grid[2:, :-2]   # Bottom-left
-    neighbors[6] = padded_grid[2:, 1:-1] # Bottom-center
-    neighbors[7] = padded_grid[2:, 2:]   # Bottom-right
-
-    # Count non-empty neighbors and neighbors of each type for each cell
-    non_empty_neighbor_count = cp.sum(neighbors != 0, axis=0)
-    rock_neighbor_counts = cp.sum(neighbors == 1, axis=0)
-    paper_neighbor_counts = cp.sum(neighbors == 2, axis=0)
-    scissors_neighbor_counts = cp.sum(neighbors == 3, axis=0)
-
-    # 3. Generate independent random rolls for each action type
-    rand_settle_roll = cp.random.rand(current_height, current_width)
-    rand_dominate_roll = cp.random.rand(current_height, current_width)
-    rand_mobility_roll = cp.random.rand(current_height, current_width)
-
-    # 4. Calculate local probabilities for each action
-
-    # Settlement probability (prob_settle_local)
-    prob_settle_local = 1 - (1 - p_settle)**non_empty_neighbor_count
-    # Ensure prob_settle_local is 0 where non_empty_neighbor_count is 0 (or where cell is not empty)
-    prob_settle_local = cp.where(non_empty_neighbor_count == 0, 0.0, prob_settle_local)
-
-    # Domination probability (prob_dominate_local)
-    prob_dominate_local = cp.zeros((current_height, current_width), dtype=cp.float32)
-
-    # Rock (1) dominated by Paper (2)
-    rock_cells = (current_grid == 1)
-    prob_dominate_local = cp.where(rock_cells, 1 - (1 - p_competition)**paper_neighbor_counts, prob_dominate_local)
-
-    # Paper (2) dominated by Scissors (3)
-    paper_cells = (current_grid == 2)
-    prob_dominate_local = cp.where(paper_cells, 1 - (1 - p_competition)**scissors_neighbor_counts, prob_dominate_local)
-
-    # Scissors (3) dominated by Rock (1)
-    scissors_cells = (current_grid == 3)
-    prob_dominate_local = cp.where(scissors_cells, 1 - (1 - p_competition)**rock_neighbor_counts, prob_dominate_local)
-
-    # Mobility probability (prob_mobility_local)
-    # Assuming max 8 neighbors for mobility consideration (Moore neighborhood)
-    prob_mobility_local = 1 - (1 - p_mobility)**8
-    # Only occupied cells can move
-    prob_mobility_local = cp.where(current_grid == 0, 0.0, prob_mobility_local)
-
-    # 5. Create masks for each action based on independent rolls and local probabilities, ensuring priority.
-    # Priority: Settlement > Domination > Mobility
-
-    # ----------------------- Settlement Mask ------------------------
-    # Cells that roll for settlement AND are empty AND have non-empty neighbors.
-    final_settle_mask = (current_grid == 0) & (rand_settle_roll < prob_settle_local)
-
-    # ----------------------- Domination Mask ------------------------
-    # Cells that roll for domination AND are occupied AND meet domination conditions
-    # AND are not already settling.
-    domination_condition_mask = \
-        ((current_grid == 1) & (paper_neighbor_counts > 0)) | \
-        ((current_grid == 2) & (scissors_neighbor_counts > 0)) | \
-        ((current_grid == 3) & (rock_neighbor_counts > 0))
-
-    final_dominate_mask = \
-        (~final_settle_mask) & \
-        (current_grid != 0) & \
-        (rand_dominate_roll < prob_dominate_local) & \
-        domination_condition_mask
-
-
-    # ------------------------- Mobility Mask --------------------------
-    # Cells that roll for mobility AND are occupied AND are not settling or dominating.
-    mobility_condition_mask = (current_grid != 0)
-    final_mobility_mask = \
-        (~final_settle_mask) & \
-        (~final_dominate_mask) & \
-        (rand_mobility_roll < prob_mobility_local) & \
-        mobility_condition_mask
-
+    new_grid = xp.copy(current_grid)
+
+    # 1./2. Count neighbors of each type for each cell in a single fused stencil pass.
+    # Wrap-around is handled inside the kernel, so there is no padded copy and no 8-plane neighbor tensor
+    with profiler.span('neighbor_counts'):
+      neighbor_count_planes = neighbor_counts(current_grid, xp, self.n_states)
+    non_empty_neighbor_count = 8 - neighbor_count_planes[0]
+
+    # Define offsets for 8 neighbors (Moore neighborhood), used to look up chosen neighbors on the fly
+    offsets_y = xp.array(OFFSETS_Y, dtype=xp.int32)
+    offsets_x = xp.array(OFFSETS_X, dtype=xp.int32)
+    # Flat views of the grids: scatters use flat indices so stacked (..., H, W) lattices work unchanged
+    flat_current_grid = current_grid.reshape(-1)
+    flat_new_grid = new_grid.reshape(-1)
+
+    with profiler.span('probabilities'):
+      # 3. One 64-bit counter-based random word per cell (word_lo, word_hi), keyed by (seed, step, cell index).
+      # Every decision is carved out of it: the low half's uniform bits are the settle roll of an empty cell or the
+      # domination roll of an occupied one (a cell never needs both), the high half's are the mobility roll
+      # (with agnostic rules, the low half's roll decides all three), and the low 3 bits of each half pick the
+      # settlement / mobility neighbor
+      rand_settle_roll = uniform_bits(word_lo)
+      rand_dominate_roll = rand_settle_roll
+      rand_mobility_roll = rand_settle_roll if tables.single_roll else uniform_bits(word_hi)
+
+      # 4. Calculate local probabilities for each action, as integer thresholds on the 24-bit rolls.
+      # They only depend on small neighbor counts, so the rules' precomputed per-lattice tables are gathered per cell
+
+      # Settlement probability (prob_settle_local), by non-empty neighbor count
+      # The k = 0 entry is 0, so cells without non-empty neighbors never settle
+      prob_settle_local = lookup_thresholds(tables.settle, non_empty_neighbor_count, xp)
+
+      # Domination probability (prob_dominate_local)
+      # Each species only fears its predators: the cell's state and its predator-neighbor counts form one code,
+      # gathered once per predator rank (not per species), whose threshold is a single table lookup
+      neighborhood_codes = self.rules.codes(current_grid, neighbor_count_planes, xp)
+      # Empty cells and cells without predator neighbors get a threshold of 0
+      prob_dominate_local = lookup_thresholds(tables.dominate, neighborhood_codes, xp)
+
+      # Mobility probability (prob_mobility_local)
+      # Only occupied cells can move
+      prob_mobility_local = xp.where(current_grid == 0, xp.uint32(0), tables.mobility_high)
+
+    with profiler.span('masks'):
+      # 5. Create masks for each action based on independent rolls and local probabilities, ensuring priority.
+      # Priority: Settlement > Domination > Mobility
+
+      # ----------------------- Settlement Mask ------------------------
+      # Cells that roll for settlement AND are empty AND have (enough) non-empty neighbors.
+      final_settle_mask = (current_grid == 0) & (rand_settle_roll < prob_settle_local)
+
+      # ----------------------- Domination Mask ------------------------
+      # Cells that roll for domination AND are occupied AND have (enough) predator neighbors
+      # AND are not already settling.
+      final_dominate_mask = \
+          (~final_settle_mask) & \
+          (current_grid != 0) & \
+          (rand_dominate_roll < prob_dominate_local)
+      if tables.dominate_low is not None:
+          # Agnostic rules: domination is the interval of the roll right after settlement's
+          final_dominate_mask &= (rand_dominate_roll >= tables.dominate_low)
+
+
+      # ------------------------- Mobility Mask --------------------------
+      # Cells that roll for mobility AND are occupied AND are not settling or dominating.
+      final_mobility_mask = \
+          (~final_settle_mask) & \
+          (~final_dominate_mask) & \
+          (rand_mobility_roll < prob_mobility_local)
+      if tables.single_roll:
+          final_mobility_mask &= (rand_mobility_roll >= tables.mobility_low)
+
+
+    # Event counts (reductions run only when profiling; final settlers are counted once they're applied)
+    count('dominate', final_dominate_mask)
+    count('move_attempt', final_mobility_mask)
 
     # 6. Apply actions to new_grid based on the final, mutually exclusive masks.
 
-    # Apply Settlement: Empty cells adopt a random non-empty neighbor's species
-    if cp.any(final_settle_mask):
-        settling_y_coords, settling_x_coords = cp.where(final_settle_mask)
-        num_settling_cells = settling_y_coords.shape[0]
+    with profiler.span('settlement'):
+      # Apply Settlement: Empty cells adopt a random non-empty neighbor's species
+      if xp.any(final_settle_mask):
+          settling_cells = xp.flatnonzero(final_settle_mask)
+          num_settling_cells = settling_cells.shape[0]
 
-        if num_settling_cells > 0:
-            # For each settling cell, choose a random neighbor index (0-7)
-            rand_neighbor_idx_for_settlers = cp.random.randint(0, 8, size=num_settling_cells)
+          if num_settling_cells > 0:
+              # For each settling cell, choose a random neighbor index (0-7) from its word's low bits
+              rand_neighbor_idx_for_settlers = direction_bits(word_lo.reshape(-1)[settling_cells])
 
-            # Get the species of these randomly chosen neighbors
-            # `neighbors[k, y, x]` gives the k-th neighbor's species for cell (y,x)
-            chosen_neighbor_species = neighbors[rand_neighbor_idx_for_settlers, settling_y_coords, settling_x_coords]
+              # Get the species of these randomly chosen neighbors, wrapping around the torus
+              chosen_neighbors = neighbor_flat_index(settling_cells, rand_neighbor_idx_for_settlers,
+                                                     offsets_y, offsets_x, current_height, current_width)
+              chosen_neighbor_species = flat_current_grid[chosen_neighbors]
 
-            # Only settle if the chosen neighbor is not empty (species != 0)
-            valid_settlement_mask_for_chosen_neighbor = (chosen_neighbor_species != 0)
+              # Only settle if the chosen neighbor is not empty (species != 0)
+              valid_settlement_mask_for_chosen_neighbor = (chosen_neighbor_species != 0)
 
-            # Apply the species of the valid chosen neighbors to the new_grid
-            new_grid[settling_y_coords[valid_settlement_mask_for_chosen_neighbor],
-                     settling_x_coords[valid_settlement_mask_for_chosen_neighbor]] = \
-                chosen_neighbor_species[valid_settlement_mask_for_chosen_neighbor]
+              # Apply the species of the valid chosen neighbors to the new_grid
+              flat_new_grid[settling_cells[valid_settlement_mask_for_chosen_neighbor]] = \
+                  chosen_neighbor_species[valid_settlement_mask_for_chosen_neighbor]
+              if profiler.enabled:
+                  # Settlers are the only cells changed so far
+                  count('settle', (current_grid == 0) & (new_grid != 0))
 
-    # Apply Domination: Dominated cells become empty (0)
-    if cp.any(final_dominate_mask):
-        new_grid[final_dominate_mask] = 0
+    with profiler.span('domination'):
+      # Apply Domination: Dominated cells become empty (0)
+      if xp.any(final_dominate_mask):
+          new_grid[final_dominate_mask] = 0
 
-    # Apply Mobility: Occupied cells swap their state with a randomly chosen neighbor
-    mover_y, mover_x = cp.where(final_mobility_mask)
-    num_movers = mover_y.shape[0]
+    with profiler.span('mobility'):
+      # Apply Mobility: Occupied cells swap their state with a randomly chosen neighbor
+      # Each mover records the direction it wants to go in (from its word's low bits). The swaps then run as 8 substeps
+      # of disjoint neighbor pairs - one per axis and sublattice parity, in an order drawn for this step - so every
+      # move is an exact exchange: nobody is duplicated or destroyed when movers pick the same target
+      intent = xp.where(final_mobility_mask, (direction_bits(word_hi) + 1).astype(xp.uint8), xp.uint8(0))
+      sublattice_swaps(new_grid, intent, substep_order, xp, swap_state_bits(self.n_states))
 
-    if num_movers > 0:
-        # Select a random neighbor for each mover (index 0-7 for 8 neighbors)
-        rand_neighbor_idx = cp.random.randint(0, 8, size=num_movers)
+    return new_grid
 
-        # Define offsets for 8 neighbors (Moore neighborhood)
-        offsets_y = cp.array([-1, -1, -1, 0, 0, 1, 1, 1], dtype=cp.int32)
-        offsets_x = cp.array([-1, 0, 1, -1, 1, -1, 0, 1], dtype=cp.int32)
 
-        # Calculate target coordinates for each mover, ensuring wrap-around boundaries
-        target_y = (mover_y + offsets_y[rand_neighbor_idx]) % current_height
-        target_x = (mover_x + offsets_x[rand_neighbor_idx]) % current_width
 
-        # To perform the swap in parallel without race conditions or overwriting intermediate values:
-        # We need to read values from `current_grid` (the state *before* any updates this tick)
-        # and write them to appropriate locations in `new_grid`.
+  def _step_windows(self, current_grid, tiles, tile, n_steps=1, counting=False):
+    '''
+    Advances the flagged tiles of current_grid by n_steps steps, each inside a window with a margin wide enough for
+    n_steps steps of dependence (unflagged tiles must be ones that can't change in that time). Windows go through
+    the steps in batches of about WINDOW_BATCH_CELLS cells, gathered from the lattice once and written back once.
 
-        # Get the current values at the mover's original position and their target neighbor's position
-        values_at_mover_positions = current_grid[mover_y, mover_x]
-        values_at_target_positions = current_grid[target_y, target_x]
+    Returns (new_grid, changed_cells, step_counts): the flat indices of changed cells if an entropy tracker is kept,
+    and the (n_steps, ..., n_states) state counts after every step if counting
+    '''
+    xp = self.xp
+    height, width = current_grid.shape[-2:]
+    lead_shape = current_grid.shape[:-2]
+    n_lattices = current_grid.size // (height * width)
+    n_states = self.n_states
+    margin = window_margin(n_steps)
+    center = slice(margin, -margin) # Only each window's center tile is exact; the margin just feeds it
+    window_index, window_lattice = tile_windows(tiles, current_grid.shape, tile, xp, margin)
+    tables = self._parameter_tables('rules')
+    substep_orders = [self.rng.shared_permutation(len(SWAP_SUBSTEPS), self.step + j) for j in range(n_steps)]
+
+    flat_current_grid = current_grid.reshape(-1)
+    new_grid = xp.copy(current_grid)
+    flat_new_grid = new_grid.reshape(-1)
+    changed_cells = [] if self._entropy_tracker is not None else None
+    step_counts = xp.zeros((n_steps, n_lattices * n_states), dtype=xp.int64) if counting else None
+    window_counts = xp.zeros(n_lattices * n_states, dtype=xp.int64) # State counts of the tiles as they were, to subtract later
+
+    batch = max(1, WINDOW_BATCH_CELLS // window_index[0].size) if window_index.shape[0] else 1
+    for start in range(0, window_index.shape[0], batch):
+      index = window_index[start:start + batch]
+      lattice = window_lattice[start:start + batch]
+      # Per-window count bins, so one bincount sorts the tiles' counts by lattice
+      count_bins = lattice[:, None, None] * n_states
+      windows = flat_current_grid[index]
+      batch_tables = tables.select(lattice)
+      if counting:
+        window_counts += xp.bincount((windows[:, center, center] + count_bins).reshape(-1), minlength=n_lattices * n_states)
+
+      # Windows are stepped as a stack of small lattices, drawing the random words of the global cells they cover
+      for j in range(n_steps):
+        with self.profiler.span('rng'):
+          word_lo, word_hi = self.rng.words(index, self.step + j, height * width)
+        windows = self._transition(windows, word_lo, word_hi, batch_tables, substep_orders[j], center)
+        if counting:
+          step_counts[j] += xp.bincount((windows[:, center, center] + count_bins).reshape(-1), minlength=n_lattices * n_states)
+
+      tile_index = index[:, center, center]
+      new_tiles = windows[:, center, center]
+      flat_new_grid[tile_index] = new_tiles
+      if changed_cells is not None:
+        changed_cells.append(tile_index[new_tiles != flat_current_grid[tile_index]])
+
+    if changed_cells is not None:
+      changed_cells = xp.concatenate(changed_cells) if changed_cells else xp.zeros(0, dtype=xp.int64)
+    if counting:
+      # Cells outside the windows don't change, so they add the same counts to every step
+      outside_counts = state_counts(current_grid, xp, n_states).reshape(-1) - window_counts
+      step_counts = (step_counts + outside_counts).reshape((n_steps,) + lead_shape + (n_states,))
+    return new_grid, changed_cells, step_counts
 
-        # Assign the target neighbor's value to the mover's original position in new_grid
-        new_grid[mover_y, mover_x] = values_at_target_positions
+  def advance(self, n_steps, counting=False, block_steps=1, tile=None):
+    '''
+    Runs n_steps generations - the exact same lattice as n_steps update() calls - recording the counts of every step
+    if counting. block_steps=1 is a plain update() loop.
+
+    block_steps=k > 1 blocks the steps in time: the lattice is cut into tiles with a margin wide enough for k steps,
+    every batch of tiles is gathered once, advanced k steps while it's in cache (or device memory), and its centers
+    written back once, so the lattice itself is read and written once per k steps instead of every step.
+    tile defaults to sparse_tile, or else the largest of BLOCK_TILES dividing both lattice dimensions; with sparse_tile
+    set, tiles that can't change during a block are skipped. Falls back to the update() loop when no tile size fits.
+    The profiler gets one record per block.
 
-        # Assign the mover's original value to the target neighbor's position in new_grid
-        # Note: If multiple movers target the same cell, the last write will prevails.
-        # This is generally acceptable for this type of simulation as order is not strictly critical.
-        new_grid[target_y, target_x] = values_at_mover_positions
+    Deeper blocks aren't free: every window redoes its margin of 9 k cells per side at every step, so they only pay
+    off where a step is bound by memory traffic rather than arithmetic (large lattices on a GPU, with large tiles).
+    On numpy they're slower than the update() loop; benchmarks/advance.py measures both
+
+    Returns: the grid after n_steps steps
+    '''
+    xp = self.xp
+    height, width = self.shape[-2:]
+    if tile is None and block_steps > 1:
+      tile = self.sparse_tile or next((t for t in BLOCK_TILES if height % t == 0 and width % t == 0), None)
+    if tile is None:
+      for _ in range(n_steps):
+        self.update(counting)
+      return self.grid
+    check_tile_size(tile, self.shape)
+
+    remaining = n_steps
+    while remaining > 0:
+      block = min(block_steps, remaining)
+      current_grid = self.grid
+      if self.sparse_tile:
+        with self.profiler.span('sparse_tiles'):
+          tiles = written_tiles(current_grid, tile, xp, block)
+      else:
+        tiles = xp.ones(self.shape[:-2] + (height // tile, width // tile), dtype=bool)
+      new_grid, changed_cells, step_counts = self._step_windows(current_grid, tiles, tile, block, counting)
+
+      if self._entropy_tracker is not None:
+        with self.profiler.span('entropy_tracker'):
+          self._entropy_tracker.update(current_grid, new_grid, changed_cells)
+      self._store_grid(new_grid)
+      self.step += block
+      if counting:
+        for counts in step_counts:
+          self._append_history(counts)
+      self.profiler.end_step(self.step) # One profiler record per block
+      remaining -= block
+    return self.grid
+
+  def update(self, counting=False):
+    '''
+    Markov process where we update our grid based on starting probabilities.
+    Integrates settlement, domination, and mobility as concurrent, mutually exclusive actions.
+    Dominated cells become empty, mobility involves swapping with a neighbor.
+
+    Returns: updated grid (cupy or numpy array, depending on the backend)
+    '''
+    xp = self.xp
+    profiler = self.profiler
+    current_grid = self.grid
 
-    self.grid = new_grid # Update the grid to the new state
+    # In sparse mode, only the tiles that can change are stepped, each inside a window of the old lattice.
+    # If those windows would cover more cells than the lattice itself, a dense step is cheaper (and gives the same result)
+    new_grid = None
+    if self.sparse_tile:
+      with profiler.span('sparse_tiles'):
+        tiles = written_tiles(current_grid, self.sparse_tile, xp)
+      if window_cells(int(tiles.sum()), self.sparse_tile) < current_grid.size:
+        new_grid, changed_cells, _ = self._step_windows(current_grid, tiles, self.sparse_tile)
+
+    if new_grid is None:
+      with profiler.span('rng'):
+        word_lo, word_hi = self.rng.lattice_words(current_grid.shape, self.step)
+      new_grid = self._transition(current_grid, word_lo, word_hi, self._parameter_tables('rules'),
+                                  self.rng.shared_permutation(len(SWAP_SUBSTEPS), self.step))
+      changed_cells = None
+
+    # Keep the entropy tracker in sync using only the cells this step changed
+    if self._entropy_tracker is not None:
+      with profiler.span('entropy_tracker'):
+        if changed_cells is None:
+          changed_cells = xp.flatnonzero(new_grid != current_grid)
+        self._entropy_tracker.update(current_grid, new_grid, changed_cells)
+
+    self._store_grid(new_grid) # Update the grid to the new state
+    self.step += 1
 
     # Update counts if counting is enabled
     if counting:
-      for i, species_type in enumerate(self.species):
-          self.counts[i] = cp.sum(self.grid == species_type)
-      self.history.append([count.get().item() for count in self.counts]) #Add counts to history (transfer to CPU for plotting)
+      with profiler.span('counting'):
+        self.record_counts() #Add counts to the device-side history (bulk-transferred to the host later)
 
+    profiler.end_step(self.step)
     return self.grid
\ No newline at end of file
@@ -0,0 +1,305 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from backend import get_backend, asnumpy, is_cupy
+from kernels import neighbor_counts, batched_bincount, state_counts, SWAP_SUBSTEPS
+from entropy import entropy_log_table, complexity_from_histogram
+from sparse import window_margin
+from rng import SEEDING_STEP, to_threshold, uniform_bits
+from RockPaperScissors import RockPaperScissors
+
+'''
+Domain-decomposed RPS for lattices too big for one process or device.
+
+The lattice is cut into horizontal strips, one per worker process. Each step a cell only depends on the old lattice
+within 9 cells, so a worker that knows window_margin(k) rows of each neighboring strip can advance its own strip k
+steps on its own. Workers publish their edge rows in shared memory, wait on a barrier, read their neighbors' edges
+and step (strip + halos) as a small toroidal lattice - the halo rows come out wrong, the strip comes out exact.
+The counter-based RNG is keyed by global cell index, so a distributed run gives exactly the lattice, counts and
+entropy a single RockPaperScissors with the same seed and stream would.
+
+Counts and the (cell type, neighbor type) pair histogram are reduced in the parent, so get_entropy() never gathers
+the lattice. On a single box the worker processes stand in for nodes; with cupy, worker i uses GPU i (mod the count).
+'''
+
+
+def strip_rows(height, workers, margin):
+    '''
+    Splits height rows into `workers` strips of even row counts (so strips start on the same sublattice parity as
+    the lattice), each at least margin rows so halos only come from the adjacent strips. Returns the start rows
+    '''
+    pairs = height // 2
+    sizes = [2 * (pairs // workers + (i < pairs % workers)) for i in range(workers)]
+    if min(sizes) < margin:
+        raise ValueError(f"{height} rows can't be split into {workers} strips of at least {margin} rows; "
+                         f"use fewer workers or a smaller halo_steps")
+    return [sum(sizes[:i]) for i in range(workers + 1)]
+
+
+class _StripWorker():
+  '''
+  One strip of the lattice, living in a worker process.
+  edges is the shared (workers, 2 buffers, 2 sides, margin, W) array of published edge rows: double-buffered
+  by exchange parity, so one barrier per exchange is enough (a worker can't reuse a buffer before everyone has
+  passed the next barrier, i.e. finished reading it)
+  '''
+
+  def __init__(self, index, rows, dims, density, probs, engine, rules, backend, seed, stream, margin, edges, barrier):
+    self.xp = get_backend(backend)
+    if is_cupy(self.xp):
+      self.xp.cuda.Device(index % self.xp.cuda.runtime.getDeviceCount()).use()
+    self.index = index
+    self.workers = edges.shape[0]
+    self.start, self.stop = rows
+    self.height, self.width = dims
+    self.margin = margin
+    self.edges = edges
+    self.barrier = barrier
+    self.exchanges = 0
+    # The engine only provides the rules and the RNG: it's sized to one window, never to the whole lattice
+    self.game = engine(dims=[self.stop - self.start + 2 * margin, self.width], density=density, probs=probs,
+                       backend=backend, seed=seed, stream=stream, rules=rules)
+    self.n_states = self.game.n_states
+    self.strip = self.xp.zeros((self.stop - self.start, self.width), dtype=self.xp.uint8)
+    self.step = 0
+
+    # Global rows of the window (strip plus margin rows above and below, wrapping around): random words are drawn
+    # by row, so no per-cell index is kept next to the uint8 strip
+    self.window_rows = self.xp.arange(self.start - margin, self.stop + margin, dtype=self.xp.int64) % self.height
+
+  def seeding(self):
+    # The words of the seeding step, drawn by global cell index exactly as RockPaperScissors.seeding() does
+    xp = self.xp
+    strip_rows = self.window_rows[self.margin:-self.margin]
+    word_lo, word_hi = self.game.rng.row_words(strip_rows, (self.height, self.width), SEEDING_STEP)
+    values = (1 + ((uniform_bits(word_hi) * len(self.game.species)) >> 24)).astype(xp.uint8)
+    toggles = uniform_bits(word_lo) < to_threshold(self.game._per_lattice(self.game.density), xp)
+    self.strip = xp.where(toggles, values, xp.uint8(0))
+    self.step = 0
+
+  def window(self, rows=None):
+    ''' Publishes this strip's edge rows, then returns the strip with `rows` halo rows from its neighbors '''
+    xp = self.xp
+    rows = rows or self.margin
+    buffer = self.exchanges % 2
+    self.exchanges += 1
+    self.edges[self.index, buffer, 0] = asnumpy(self.strip[:self.margin])
+    self.edges[self.index, buffer, 1] = asnumpy(self.strip[-self.margin:])
+    self.barrier.wait()
+    above = self.edges[(self.index - 1) % self.workers, buffer, 1, self.margin - rows:]
+    below = self.edges[(self.index + 1) % self.workers, buffer, 0, :rows]
+    return xp.concatenate([xp.asarray(above), self.strip, xp.asarray(below)])
+
+  def advance(self, n_steps, counting):
+    # One halo exchange, then n_steps steps of the whole window; only the strip rows are kept
+    xp = self.xp
+    center = slice(self.margin, -self.margin)
+    window = self.window()
+    tables = self.game._parameter_tables('rules')
+    step_counts = []
+    for j in range(n_steps):
+      word_lo, word_hi = self.game.rng.row_words(self.window_rows, (self.height, self.width), self.step + j)
+      substep_order = self.game.rng.shared_permutation(len(SWAP_SUBSTEPS), self.step + j)
+      window = self.game._transition(window, word_lo, word_hi, tables, substep_order)
+      if counting:
+        step_counts.append(state_counts(window[center], xp, self.n_states))
+    self.strip = window[center]
+    self.step += n_steps
+    return asnumpy(xp.stack(step_counts)) if counting else None
+
+  def pair_histogram(self):
+    # The strip's (cell type, neighbor type) pairs: neighbor counts of the strip rows need one halo row each side
+    xp = self.xp
+    window = self.window(1)
+    n_states = self.n_states
+    planes = neighbor_counts(window, xp, n_states)
+    pairs = xp.stack([batched_bincount(self.strip, n_states, xp, weights=planes[y][1:-1]) for y in range(n_states)], axis=-1)
+    return asnumpy(pairs), asnumpy(state_counts(self.strip, xp, n_states))
+
+
+def _worker_main(connection, index, rows, dims, density, probs, engine, rules, backend, seed, stream, margin,
+                 edges_name, barrier):
+    # Serves commands from the parent until 'close'; every worker gets the same sequence, so barriers line up.
+    # A failing command sends its exception back (and breaks the barrier, so the other workers don't hang)
+    edges_memory = shared_memory.SharedMemory(name=edges_name)
+    edges = np.ndarray((barrier.parties, 2, 2, margin, dims[1]), dtype=np.uint8, buffer=edges_memory.buf)
+    worker = None
+    try:
+        while True:
+            command, args = connection.recv()
+            if command == 'close':
+                connection.send(None)
+                break
+            try:
+                if worker is None:
+                    worker = _StripWorker(index, rows, dims, density, probs, engine, rules, backend, seed, stream,
+                                          margin, edges, barrier)
+                if command == 'seeding':
+                    result = worker.seeding()
+                elif command == 'advance':
+                    result = worker.advance(*args)
+                elif command == 'pair_histogram':
+                    result = worker.pair_histogram()
+                elif command == 'get_strip':
+                    result = asnumpy(worker.strip)
+                elif command == 'set_strip':
+                    worker.strip, worker.step = worker.xp.asarray(args[0], dtype=worker.xp.uint8), args[1]
+                    result = None
+            except Exception as error:
+                barrier.abort()
+                result = error
+            connection.send(result)
+    finally:
+        del edges, worker # Drop the views into the shared block before closing it
+        edges_memory.close()
+
+
+class RockPaperScissorsDistributed():
+  '''
+  Our neighbor-sensitive game (or engine=RockPaperScissorsAgnostic) split into horizontal strips across
+  `workers` processes, for lattices that don't fit in one process's or device's memory.
+
+  Workers exchange halos of window_margin(halo_steps) rows through shared memory once every halo_steps steps
+  (each step depends on the old lattice within 9 cells, so halos are 10 rows for one step, 9 k rounded up to even
+  for k). Between exchanges every worker steps its strip plus halos on its own, in _StripWorker.advance - this
+  doesn't go through RockPaperScissors.advance() and is exact for any halo_steps >= 1, at the cost of stepping the
+  wider halos too. Every strip must have at least window_margin(halo_steps) rows. The run is bit-identical to RockPaperScissors(dims, density, probs, seed=seed, stream=stream):
+  counts and get_entropy() are reduced across workers, and .grid gathers the whole lattice (only for lattices
+  that fit in the parent)
+
+  rules=rules.RuleSet(...) and mode= pick the game as they do for RockPaperScissors; the rules are resolved by the
+  engine (RockPaperScissorsAgnostic defaults to agnostic ones), so .rules is what the workers play
+
+  Use it as a context manager, or call close() to stop the workers
+  '''
+
+  def __init__(self, dims=[512,512], density=0.25, probs=[0.25,0.5,0.25], workers=4, engine=RockPaperScissors,
+               backend=None, seed=None, stream=0, halo_steps=1, rules=None, mode=None):
+    self.shape = tuple(dims)
+    self.height, self.width = self.shape
+    if self.height % 2 or self.width % 2:
+      raise ValueError(f"Lattice dimensions must be even (mobility swaps on alternating sublattices), got {dims}")
+    if seed is None:
+      seed = int(np.random.SeedSequence().generate_state(1, dtype=np.uint64)[0] >> np.uint64(1))
+    self.seed, self.stream = seed, stream
+    self.density = density
+    self.p_settle, self.p_competition, self.p_mobility = probs
+    # Resolve the rules exactly as the engine does, on a lattice of one sublattice cell: the workers get the result
+    engine_arguments = {} if mode is None else {'mode': mode}
+    self.rules = engine(dims=[2, 2], backend='numpy', seed=seed, rules=rules, **engine_arguments).rules
+    self.species = list(range(1, self.rules.n_states))
+    self.counts = [0 for i in range(len(self.species))]
+    if halo_steps < 1:
+      raise ValueError(f"halo_steps must be at least 1, got {halo_steps}")
+    self.halo_steps = halo_steps
+    self.step = 0
+    self._host_history = [] # Per-block (steps, n_states) count arrays, already reduced over workers
+
+    margin = window_margin(halo_steps)
+    self.rows = strip_rows(self.height, workers, margin)
+    context = mp.get_context('spawn') # Safe with cupy, and the same on every platform
+    self._edges_memory = shared_memory.SharedMemory(create=True, size=workers * 2 * 2 * margin * self.width)
+    self._barrier = context.Barrier(workers) # Kept referenced: workers attach to its semaphores after we return
+    self._connections, self._processes = [], []
+    for i in range(workers):
+      parent_end, worker_end = context.Pipe()
+      process = context.Process(target=_worker_main, daemon=True,
+                                args=(worker_end, i, self.rows[i:i + 2], self.shape, density, probs, engine, self.rules,
+                                      backend, seed, stream, margin, self._edges_memory.name, self._barrier))
+      process.start()
+      self._connections.append(parent_end)
+      self._processes.append(process)
+
+  def _broadcast(self, command, *args):
+    ''' Sends one command to every worker, then collects their replies in strip order '''
+    for connection in self._connections:
+      connection.send((command, args))
+    replies = [connection.recv() for connection in self._connections]
+    errors = [reply for reply in replies if isinstance(reply, Exception)]
+    if errors:
+      raise errors[0] # The first worker to fail; the others just saw the broken barrier
+    return replies
+
+  def close(self):
+    ''' Stops the workers and frees the shared halo buffers '''
+    if self._processes:
+      self._broadcast('close')
+      for process in self._processes:
+        process.join()
+      self._processes = []
+      self._edges_memory.close()
+      self._edges_memory.unlink()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def seeding(self):
+    ''' Get starting positions of our grid (each worker seeds its own strip) '''
+    self._broadcast('seeding')
+    self.step = 0
+    self.counts = list(self._state_counts()[self.species])
+
+  @property
+  def grid(self):
+    ''' The whole lattice, gathered from the workers as a host uint8 array '''
+    return np.concatenate(self._broadcast('get_strip'))
+
+  @grid.setter
+  def grid(self, value):
+    value = asnumpy(value)
+    for i, connection in enumerate(self._connections):
+      connection.send(('set_strip', (value[self.rows[i]:self.rows[i + 1]], self.step)))
+    for connection in self._connections:
+      reply = connection.recv()
+      if isinstance(reply, Exception):
+        raise reply
+
+  def _reduced_histograms(self):
+    replies = self._broadcast('pair_histogram')
+    return sum(pairs for pairs, _ in replies), sum(counts for _, counts in replies)
+
+  def _state_counts(self):
+    return self._reduced_histograms()[1]
+
+  def advance(self, n_steps, counting=False):
+    '''
+    Runs n_steps generations, exchanging halos once every halo_steps steps.
+    counting records the counts of every step, as update(counting=True) does
+    '''
+    remaining = n_steps
+    while remaining > 0:
+      block = min(self.halo_steps, remaining)
+      step_counts = self._broadcast('advance', block, counting)
+      self.step += block
+      if counting:
+        step_counts = sum(step_counts)
+        self._host_history.append(step_counts)
+        self.counts = list(step_counts[-1, self.species])
+      remaining -= block
+
+  def update(self, counting=False):
+    ''' One step of the game (see advance() to exchange halos less often) '''
+    self.advance(1, counting)
+
+  def get_history(self, include_empty=False):
+    ''' Every recorded count as a host array of shape (steps, n_species), or (steps, n_states) with empties if include_empty '''
+    history = np.concatenate(self._host_history) if self._host_history else np.zeros((0, self.rules.n_states), dtype=np.int64)
+    return history if include_empty else history[..., self.species]
+
+  @property
+  def history(self):
+    ''' Recorded species counts, (steps, n_species) on the host '''
+    return self.get_history()
+
+  def get_entropy(self):
+    '''
+    Boundary complexity of the whole lattice, from the pair histograms and state counts of the strips summed
+    in the parent (the same closed form RockPaperScissors.get_entropy() evaluates)
+    '''
+    pair_counts, counts = self._reduced_histograms()
+    n_cells = self.height * self.width
+    log_table = entropy_log_table(self.p_settle, self.p_competition, np, self.rules.interaction)
+    return complexity_from_histogram(pair_counts, counts / n_cells, log_table, n_cells, np)
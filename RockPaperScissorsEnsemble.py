@@ -0,0 +1,41 @@
+import numpy as np
+from backend import asnumpy
+from RockPaperScissors import RockPaperScissors
+from rng import CounterRNG
+
+
+class RockPaperScissorsEnsemble(RockPaperScissors):
+  '''
+  R independent replicas of our game (neighbor-sensitive, or mode='agnostic' / any rules=), advanced together as one stacked (R, H, W) array.
+  Every update() is a single batch of array operations for all replicas, so a sweep pays the Python and
+  kernel-launch overhead once per step instead of once per replica.
+
+  probs is either one [p_settle, p_competition, p_mobility] triple shared by every replica, or an (R, 3) table
+  giving each replica its own probabilities. density can likewise be a float or a length-R list.
+
+  counts holds one length-R vector per species, history is a (steps, R, n_species) array,
+  and get_entropy() returns a length-R vector
+
+  Replica r draws the same random numbers as RockPaperScissors(seed=seed, stream=stream + r), so its trajectory
+  doesn't depend on how many replicas are batched with it
+  '''
+
+  def __init__(self, replicas=5, dims=[512,512], density=0.25, probs=[0.25,0.5,0.25], **kwargs):
+    super().__init__(dims=dims, **kwargs) # backend, seed, packed, ... work exactly as for a single game
+    xp = self.xp
+    self.replicas = replicas
+    self.shape = (replicas,) + tuple(dims) # Replicas are stacked along a leading axis
+    self.grid = xp.zeros(self.shape, dtype=xp.uint8)
+    # Replica r draws from stream (stream + r), so it evolves exactly like a single game with that stream
+    self.rng = CounterRNG(self.seed, xp, self.stream + np.arange(replicas))
+
+    # Per-replica parameters are stored as (R, 1, 1) so they broadcast against the stacked grid
+    self.density = xp.broadcast_to(xp.asarray(density, dtype=xp.float32).reshape(-1), (replicas,)).reshape(replicas, 1, 1)
+    probs = xp.broadcast_to(xp.asarray(probs, dtype=xp.float32).reshape(-1, 3), (replicas, 3))
+    self.p_settle, self.p_competition, self.p_mobility = [probs[:, i].reshape(replicas, 1, 1) for i in range(3)]
+
+  def _checkpoint_arguments(self):
+    # Per-replica probabilities and densities go back in as an (R, 3) table and a length-R list
+    arguments = super()._checkpoint_arguments()
+    probs = np.stack([asnumpy(p).reshape(-1) for p in (self.p_settle, self.p_competition, self.p_mobility)], axis=1)
+    return dict(arguments, replicas=self.replicas, probs=probs.tolist(), density=asnumpy(self.density).reshape(-1).tolist())
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+
+'''
+Array backend selection for our RPS engines.
+
+Every engine holds an `xp` namespace (either cupy or numpy) and only ever calls array functions through it,
+so the same class runs on a GPU node or a CPU-only batch node. The backend is chosen at construction
+(backend='cupy' / 'numpy' / 'auto') or, when nothing is passed, through the RPS_BACKEND environment variable.
+'''
+
+BACKEND_ENV_VAR = 'RPS_BACKEND'
+
+
+def get_backend(name=None):
+    '''
+    Returns the array namespace we simulate with.
+
+    name can be 'cupy', 'numpy', 'auto' or an already-imported module. 'auto' picks cupy when it imports
+    and can see a device, and falls back to numpy otherwise. If name is None we read RPS_BACKEND (default 'auto')
+    '''
+    if name is None:
+        name = os.environ.get(BACKEND_ENV_VAR, 'auto')
+    if not isinstance(name, str):
+        return name # Already a module (e.g. someone passed numpy directly)
+
+    name = name.lower()
+    if name == 'numpy':
+        return np
+    if name not in ('cupy', 'auto'):
+        raise ValueError(f"Unknown backend '{name}', expected 'cupy', 'numpy' or 'auto'")
+
+    try:
+        import cupy as cp
+        if cp.cuda.runtime.getDeviceCount() > 0:
+            return cp
+        reason = 'no CUDA device is visible'
+    except Exception as e: # ImportError, or a CUDA runtime error on driverless nodes
+        reason = str(e)
+
+    if name == 'cupy':
+        raise RuntimeError(f"The cupy backend was requested but is unavailable: {reason}")
+    return np
+
+
+def is_cupy(xp):
+    ''' True if xp is the cupy namespace '''
+    return xp.__name__ == 'cupy'
+
+
+def asnumpy(array):
+    ''' Brings a cupy or numpy array (or scalar) to the host as a numpy array '''
+    if hasattr(array, 'get'):
+        return array.get()
+    return np.asarray(array)
+
+
+def synchronize(xp):
+    ''' Blocks until all queued device work is done (a no-op on numpy), so wall-clock timings are honest '''
+    if is_cupy(xp):
+        xp.cuda.get_current_stream().synchronize()
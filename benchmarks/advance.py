@@ -0,0 +1,57 @@
+import argparse
+import time
+from backend import synchronize
+from RockPaperScissors import RockPaperScissors
+
+'''
+Benchmarks advance(), which steps the lattice in tiles for several generations per pass, against the
+`for i in range(k): game.update()` loop of rps_main.py.
+Run from the repo root:  python -m benchmarks.advance --backend numpy --size 1024 --steps 32 --block-steps 2 4
+'''
+
+
+def make_game(args, **kwargs):
+    game = RockPaperScissors(dims=[args.size, args.size], density=0.5, probs=[1/3, 1/3, 1/3], backend=args.backend,
+                             seed=0, **kwargs)
+    game.seeding()
+    return game
+
+
+def steps_per_second(run, game, steps):
+    xp = game.xp
+    run(game, 2) # warm-up (and kernel compilation on cupy)
+    synchronize(xp)
+    start = time.perf_counter()
+    run(game, steps)
+    synchronize(xp)
+    return steps / (time.perf_counter() - start)
+
+
+def update_loop(game, steps):
+    for i in range(steps):
+        game.update()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Temporally blocked advance() vs an update() loop')
+    parser.add_argument('--backend', default=None, help="'cupy', 'numpy' or 'auto' (default: RPS_BACKEND)")
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=32)
+    parser.add_argument('--block-steps', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--tile', type=int, default=None, help='tile size (default: largest of sparse.BLOCK_TILES that fits)')
+    args = parser.parse_args()
+
+    # Sanity check: advance() must land on exactly the lattice the update() loop does
+    reference, blocked = make_game(args), make_game(args)
+    update_loop(reference, 5)
+    blocked.advance(5, block_steps=2, tile=args.tile)
+    assert bool((reference.grid == blocked.grid).all())
+
+    loop_rate = steps_per_second(update_loop, make_game(args), args.steps)
+    print(f"backend: {reference.xp.__name__}, {args.size}² lattice, {args.steps} steps")
+    print(f"{'method':>16} {'steps/s':>9} {'speedup':>8}")
+    print(f"{'update() loop':>16} {loop_rate:>9.2f} {1:>7.2f}x")
+    for block_steps in args.block_steps:
+        rate = steps_per_second(lambda game, steps: game.advance(steps, block_steps=block_steps, tile=args.tile),
+                                make_game(args), args.steps)
+        print(f"{'advance(k=' + str(block_steps) + ')':>16} {rate:>9.2f} {rate / loop_rate:>7.2f}x")
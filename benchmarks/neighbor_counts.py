@@ -0,0 +1,63 @@
+import argparse
+import time
+from backend import get_backend, synchronize
+from kernels import neighbor_counts
+
+'''
+Benchmarks the fused neighbor-count stencil against the old pad + (8, H, W) neighbor tensor approach that update() used.
+Run from the repo root:  python -m benchmarks.neighbor_counts --backend numpy --sizes 512 1024 2048
+'''
+
+
+def legacy_neighbor_counts(grid, xp):
+    ''' The pre-fusion path: pad, materialize 8 neighbor planes, then four separate comparison passes '''
+    height, width = grid.shape
+    padded_grid = xp.pad(grid, 1, mode='wrap')
+    neighbors = xp.zeros((8, height, width), dtype=xp.int32)
+    neighbors[0] = padded_grid[:-2, :-2]
+    neighbors[1] = padded_grid[:-2, 1:-1]
+    neighbors[2] = padded_grid[:-2, 2:]
+    neighbors[3] = padded_grid[1:-1, :-2]
+    neighbors[4] = padded_grid[1:-1, 2:]
+    neighbors[5] = padded_grid[2:, :-2]
+    neighbors[6] = padded_grid[2:, 1:-1]
+    neighbors[7] = padded_grid[2:, 2:]
+    non_empty = xp.sum(neighbors != 0, axis=0)
+    rock = xp.sum(neighbors == 1, axis=0)
+    paper = xp.sum(neighbors == 2, axis=0)
+    scissors = xp.sum(neighbors == 3, axis=0)
+    return non_empty, rock, paper, scissors
+
+
+def cells_per_second(fn, grid, xp, repeats):
+    fn(grid, xp) # warm-up (and kernel compilation on cupy)
+    synchronize(xp)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(grid, xp)
+    synchronize(xp)
+    return grid.size * repeats / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fused vs legacy neighbor-count throughput')
+    parser.add_argument('--backend', default=None, help="'cupy', 'numpy' or 'auto' (default: RPS_BACKEND)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 2048])
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    xp = get_backend(args.backend)
+    rng = xp.random.default_rng(0)
+    print(f"backend: {xp.__name__}")
+    print(f"{'size':>6} {'legacy Mcells/s':>16} {'fused Mcells/s':>15} {'speedup':>8}")
+    for size in args.sizes:
+        grid = rng.integers(0, 4, size=(size, size)).astype(xp.int32)
+
+        # Sanity check: both paths must agree before we compare their speed
+        fused = neighbor_counts(grid, xp)
+        legacy = legacy_neighbor_counts(grid, xp)
+        assert bool((8 - fused[0] == legacy[0]).all()) and all(bool((fused[s] == legacy[s]).all()) for s in (1, 2, 3))
+
+        before = cells_per_second(legacy_neighbor_counts, grid, xp, args.repeats)
+        after = cells_per_second(neighbor_counts, grid, xp, args.repeats)
+        print(f"{size:>5}² {before / 1e6:>16.1f} {after / 1e6:>15.1f} {after / before:>7.2f}x")
@@ -0,0 +1,180 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from backend import get_backend, synchronize, is_cupy
+from RockPaperScissors import RockPaperScissors
+from RockPaperScissorsAgnostic import RockPaperScissorsAgnostic
+from utils.trajectory import TrajectoryWriter
+from utils.snapshot_pipeline import AsyncSnapshotWriter
+
+'''
+Benchmark suite for our engines: step throughput, counting, entropy and snapshot cost across sizes and variants.
+
+Every case seeds a game, runs a warm-up step and then `steps` timed steps, timing each phase on its own
+(update, counting, entropy every N steps, snapshot submission, and the final snapshot flush). It reports
+cells updated per second, the per-phase seconds and peak memory (tracemalloc on numpy, the memory pool on cupy),
+and writes everything to a JSON file tagged with the commit and machine, so runs can be compared:
+
+  python -m benchmarks.suite --backend numpy --output before.json
+  python -m benchmarks.suite --backend numpy --output after.json --compare before.json
+
+The default matrix is every engine x size x density with plain steps, plus one variant per feature (counting,
+entropy, snapshots) at each size; --full runs the whole cross product instead
+'''
+
+ENGINES = {'rps': RockPaperScissors, 'agnostic': RockPaperScissorsAgnostic}
+CASE_KEYS = ('engine', 'size', 'density', 'counting', 'entropy_every', 'snapshot_every')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_cases(args):
+    ''' The list of case dicts to run, in a stable order '''
+    cases = []
+    if args.full:
+        for engine, size, density, counting, entropy_every, snapshot_every in itertools.product(
+                args.engines, args.sizes, args.densities, (False, True), (0, args.entropy_every), (0, args.snapshot_every)):
+            cases.append(dict(engine=engine, size=size, density=density, counting=counting,
+                              entropy_every=entropy_every, snapshot_every=snapshot_every))
+        return cases
+    for engine, size in itertools.product(args.engines, args.sizes):
+        for density in args.densities:
+            cases.append(dict(engine=engine, size=size, density=density, counting=False, entropy_every=0, snapshot_every=0))
+        variant = dict(engine=engine, size=size, density=args.densities[0], counting=False, entropy_every=0, snapshot_every=0)
+        cases.append(dict(variant, counting=True))
+        cases.append(dict(variant, entropy_every=args.entropy_every))
+        cases.append(dict(variant, snapshot_every=args.snapshot_every))
+    return cases
+
+
+class PeakMemory():
+    ''' Peak bytes allocated by the backend while active: tracemalloc for numpy, pool growth for cupy '''
+
+    def __init__(self, xp):
+        self.xp = xp
+        self.peak = None
+
+    def __enter__(self):
+        if is_cupy(self.xp):
+            self._pool = self.xp.get_default_memory_pool()
+            self._pool.free_all_blocks()
+            self._start = self._pool.total_bytes()
+        else:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if is_cupy(self.xp):
+            self.peak = self._pool.total_bytes() - self._start # The pool keeps every block it grew to
+        else:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def run_case(case, args, snapshot_dir):
+    xp = get_backend(args.backend)
+    size = case['size']
+    cells = size * size
+    steps = int(np.clip(args.cell_budget // cells, args.min_steps, args.max_steps))
+    phases = dict(update=0.0, counting=0.0, entropy=0.0, snapshot=0.0, snapshot_flush=0.0)
+
+    def timed(phase, fn, *fn_args):
+        synchronize(xp)
+        start = time.perf_counter()
+        result = fn(*fn_args)
+        synchronize(xp)
+        phases[phase] += time.perf_counter() - start
+        return result
+
+    with PeakMemory(xp) as memory:
+        game = ENGINES[case['engine']](dims=[size, size], density=case['density'], backend=args.backend, seed=0,
+                                       track_entropy=case['entropy_every'] == 1) # The tracker only pays off every step
+        game.seeding()
+        game.update() # warm-up (and kernel compilation on cupy)
+        writer = None
+        if case['snapshot_every']:
+            sink = TrajectoryWriter(os.path.join(snapshot_dir, f"{case['engine']}_{size}.h5"), game.shape, seed=game.seed)
+            writer = AsyncSnapshotWriter(sink, game.shape, xp)
+
+        for step in range(steps):
+            timed('update', game.update)
+            if case['counting']:
+                timed('counting', game.record_counts)
+            if case['entropy_every'] and step % case['entropy_every'] == 0:
+                timed('entropy', game.get_entropy)
+            if writer is not None and step % case['snapshot_every'] == 0:
+                timed('snapshot', writer.submit, game.grid, game.step)
+        if writer is not None:
+            timed('snapshot_flush', writer.close)
+
+    total = sum(phases.values())
+    return dict(case, steps=steps, seconds=total, cells_per_second=cells * steps / total,
+                update_cells_per_second=cells * steps / phases['update'],
+                phases={phase: seconds for phase, seconds in phases.items() if seconds},
+                peak_memory_bytes=memory.peak)
+
+
+def compare(results, baseline_path):
+    ''' Prints the throughput ratio of every case also present in the baseline file '''
+    with open(baseline_path) as f:
+        baseline = {tuple(r[k] for k in CASE_KEYS): r for r in json.load(f)['results']}
+    print(f"\ncompared with {baseline_path}:")
+    for result in results:
+        before = baseline.get(tuple(result[k] for k in CASE_KEYS))
+        if before is not None:
+            label = ' '.join(f"{k}={result[k]}" for k in CASE_KEYS)
+            print(f"  {label}: {result['cells_per_second'] / before['cells_per_second']:.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Step, counting, entropy and snapshot benchmarks for the RPS engines')
+    parser.add_argument('--backend', default=None, help="'cupy', 'numpy' or 'auto' (default: RPS_BACKEND)")
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512, 1024, 2048, 4096, 8192])
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.25, 0.5])
+    parser.add_argument('--entropy-every', type=int, default=10, help='steps between get_entropy() calls in entropy cases')
+    parser.add_argument('--snapshot-every', type=int, default=10, help='steps between snapshots in snapshot cases')
+    parser.add_argument('--cell-budget', type=int, default=1 << 26, help='cell updates per case (sets the step count)')
+    parser.add_argument('--min-steps', type=int, default=3)
+    parser.add_argument('--max-steps', type=int, default=200)
+    parser.add_argument('--full', action='store_true', help='run the full cross product of variants')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, metavar='BASELINE', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    xp = get_backend(args.backend)
+    meta = dict(commit=git_commit(), timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+                machine=platform.node(), processor=platform.processor() or platform.machine(),
+                python=platform.python_version(), numpy=np.__version__, backend=xp.__name__)
+    print(f"backend: {xp.__name__}, commit {meta['commit']}")
+    print(f"{'engine':>8} {'size':>6} {'dens':>5} {'count':>5} {'ent':>4} {'snap':>4} {'steps':>5} "
+          f"{'Mcells/s':>9} {'peak MB':>8}  phases (s)")
+
+    results = []
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        for case in build_cases(args):
+            result = run_case(case, args, snapshot_dir)
+            results.append(result)
+            phases = ', '.join(f"{phase} {seconds:.3f}" for phase, seconds in result['phases'].items())
+            print(f"{case['engine']:>8} {case['size']:>5}² {case['density']:>5} {case['counting']!s:>5} "
+                  f"{case['entropy_every']:>4} {case['snapshot_every']:>4} {result['steps']:>5} "
+                  f"{result['cells_per_second'] / 1e6:>9.1f} {result['peak_memory_bytes'] / 2**20:>8.1f}  {phases}")
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(meta=meta, results=results), f, indent=1)
+    print(f"results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
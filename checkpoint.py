@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+from backend import asnumpy
+
+'''
+Checkpoints of a running game, so long runs on preemptible nodes can pick up where they stopped.
+
+A checkpoint is one .npz file: the lattice (2-bit packed when the game has at most 4 states and W % 4 == 0), the
+recorded history (empties included) and a JSON header with the step, seed, stream, probabilities, density, rules and
+engine settings.
+That is the whole state of a run: randomness is counter-based (rng.py), so (seed, stream, step) is the RNG state, and
+a restored game continues bit-identically. Files are written to a temporary name next to the target, fsynced and
+moved over it with os.replace, so a crash mid-write leaves the previous checkpoint intact.
+
+game.save_checkpoint(path) / RockPaperScissors.load_checkpoint(path) do it by hand. Checkpointer(game, path,
+every_steps=..., every_seconds=...) does it periodically: its save_if_due() (called from the simulation loop) only
+copies the state off the device, and a background thread serializes and writes it.
+
+Example:
+  game = RockPaperScissors.load_checkpoint('run.ckpt.npz') if os.path.exists('run.ckpt.npz') else RockPaperScissors(...)
+  with Checkpointer(game, 'run.ckpt.npz', every_seconds=300) as checkpointer:
+      while game.step < 10000:
+          game.update(counting=True)
+          checkpointer.save_if_due()
+'''
+
+FORMAT_VERSION = 1
+
+
+def capture_state(game):
+    ''' The arrays and JSON-serializable header of a game's checkpoint, as host copies taken right now '''
+    packed = game.n_states <= 4 and game.shape[-1] % 4 == 0 # pack_2bit's requirements
+    header = dict(format_version=FORMAT_VERSION, engine=type(game).__name__, step=int(game.step), packed=packed,
+                  arguments=game._checkpoint_arguments())
+    arrays = dict(grid=asnumpy(game.packed_grid if packed else game.grid),
+                  history=game.get_history(include_empty=True))
+    return arrays, header
+
+
+def write_checkpoint(path, arrays, header):
+    ''' Writes a checkpoint file atomically: a temporary file in the same directory, fsynced, then renamed over path '''
+    directory = os.path.dirname(os.path.abspath(path))
+    temporary = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(temporary, 'wb') as f:
+            np.savez(f, header=np.array(json.dumps(header)), **arrays) # Uncompressed: the grid is already packed
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def read_checkpoint(path):
+    ''' (arrays, header) of a checkpoint file '''
+    with np.load(path) as data:
+        header = json.loads(str(data['header']))
+        if header.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"'{path}' is checkpoint format {header.get('format_version')}, expected {FORMAT_VERSION}")
+        arrays = {name: data[name] for name in data.files if name != 'header'}
+    return arrays, header
+
+
+class Checkpointer():
+    '''
+    Periodic checkpoints of `game` to `path`, due every every_steps steps and/or every every_seconds seconds.
+    save_if_due() captures the state in the calling thread (the game must not step meanwhile) and hands it to a
+    writer thread; if the previous checkpoint is still being written, the newer state replaces it in the queue.
+    Use as a context manager, or call close(), which writes any pending checkpoint (close(final=True) also saves
+    the current state)
+    '''
+
+    def __init__(self, game, path, every_steps=None, every_seconds=None):
+        if every_steps is None and every_seconds is None:
+            raise ValueError("Give every_steps and/or every_seconds")
+        self.game = game
+        self.path = path
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.saved = 0 # Checkpoints written so far
+        self.last_step = game.step
+        self.last_time = time.monotonic()
+        self._pending = None
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def due(self):
+        if self.every_steps is not None and self.game.step - self.last_step >= self.every_steps:
+            return True
+        return self.every_seconds is not None and time.monotonic() - self.last_time >= self.every_seconds
+
+    def save_if_due(self):
+        ''' Queues a checkpoint if one is due; returns whether it did '''
+        if not self.due():
+            return False
+        self.save()
+        return True
+
+    def save(self):
+        ''' Queues a checkpoint of the game's current state '''
+        self._raise_if_failed()
+        state = capture_state(self.game)
+        with self._condition:
+            self._pending = state # Replaces a checkpoint that hasn't started writing yet: this one is newer
+            self._condition.notify()
+        self.last_step = self.game.step
+        self.last_time = time.monotonic()
+
+    def _writer_loop(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                state, self._pending = self._pending, None
+            try:
+                write_checkpoint(self.path, *state)
+                self.saved += 1
+            except Exception as error:
+                self._error = error
+
+    def close(self, final=False):
+        ''' Writes what's pending (and, if final, the current state) and stops the writer thread '''
+        if self._closed:
+            return
+        if final:
+            self.save()
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._raise_if_failed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(final=exc_type is None)
@@ -0,0 +1,142 @@
+import numpy as np
+from kernels import neighbor_counts, neighbor_flat_index, state_counts, batched_bincount, N_STATES, OFFSETS_Y, OFFSETS_X
+
+'''
+Boundary complexity ("entropy") of a lattice, shared by our RPS engines:
+
+  C = -sum_x sum_{y in N(x)} p(x) log2 q(x, y) / (8 sqrt(H W))
+
+Every cell-neighbor pair only depends on the (cell type, neighbor type) combination, so we histogram those pairs once
+and weight the 4x4 histogram by the log-q table, instead of gathering a value for all 8*H*W pairs.
+EntropyTracker keeps that histogram up to date from the cells each step changed, so C costs O(changes) per step.
+'''
+
+
+def entropy_log_table(p_settle, p_competition, xp, interaction=None):
+    '''
+    log2 q(x, y) for every (cell type x, neighbor type y) pair:
+    0 for the same type, log2(1 - p_settle) when exactly one of them is empty, log2(1 - p_competition r) for two
+    different species interacting at relative rate r. interaction is the (n_states, n_states) table of those rates
+    (e.g. RuleSet.interaction); None means our 3 species, every pair at rate 1.
+    The probabilities may be scalars or arrays (e.g. one per replica), giving a (..., n_states, n_states) float32 table
+    '''
+    if interaction is None:
+        interaction = 1 - np.eye(N_STATES, dtype=np.float32)
+        interaction[0, :] = interaction[:, 0] = 0
+    interaction = xp.asarray(interaction, dtype=xp.float32)
+    p_settle = xp.asarray(p_settle, dtype=xp.float32)[..., None, None]
+    p_competition = xp.asarray(p_competition, dtype=xp.float32)[..., None, None]
+
+    states = xp.arange(interaction.shape[-1])
+    cell_type, neighbor_type = states[:, None], states[None, :]
+    settle_pairs = (cell_type != neighbor_type) & ((cell_type == 0) | (neighbor_type == 0))
+
+    log_keep_settle = xp.log2(1 - p_settle)
+    log_keep_competition = xp.log2(1 - p_competition * interaction) # 0 where the species don't interact
+    table = xp.where(settle_pairs, log_keep_settle, log_keep_competition)
+    return table.astype(xp.float32)
+
+
+def pair_histogram(grid, xp, n_states=N_STATES):
+    '''
+    pair_counts[..., x, y] = number of ordered (cell, neighbor) pairs where the cell is type x and the neighbor type y,
+    over the 8-neighbor torus. Built from one fused neighbor-count pass plus one weighted bincount per neighbor type
+    '''
+    planes = neighbor_counts(grid, xp, n_states)
+    return xp.stack([batched_bincount(grid, n_states, xp, weights=planes[y]) for y in range(n_states)], axis=-1)
+
+
+def complexity_from_histogram(pair_counts, proportions, log_table, n_cells, xp):
+    '''
+    Closed-form boundary complexity from a pair histogram (..., S, S), state proportions (..., S)
+    and the log-q table (..., S, S), S being the number of states. n_cells is H*W of one lattice
+    '''
+    # Pairs that never occur contribute nothing, even where log q = -inf (a probability of exactly 1)
+    weighted_pairs = xp.where(pair_counts > 0, pair_counts * log_table, 0)
+    total_entropy = -(1/8) * xp.sum(proportions[..., :, None] * weighted_pairs, axis=(-2, -1))
+    return (total_entropy / xp.sqrt(n_cells)).astype(xp.float32) # 2D -> 1D scaling
+
+
+def boundary_complexity(grid, log_table, xp):
+    ''' Boundary complexity of a (..., H, W) grid, one value per leading index (0-d for a single lattice) '''
+    n_cells = grid.shape[-2] * grid.shape[-1]
+    n_states = log_table.shape[-1]
+    proportions = state_counts(grid, xp, n_states) / n_cells
+    return complexity_from_histogram(pair_histogram(grid, xp, n_states), proportions, log_table, n_cells, xp)
+
+
+class EntropyTracker():
+    '''
+    Incrementally maintained pair histogram and state counts of a (..., H, W) lattice.
+
+    update(old_grid, new_grid, touched) only looks at the touched cells and their 8 neighbors: every ordered pair
+    (cell, neighbor) that involves a changed cell is removed with its old types and added back with its new ones.
+    entropy(log_table) then evaluates the closed-form boundary complexity from the histogram, so a per-step entropy
+    time series costs time proportional to the number of changed cells rather than to the lattice size
+    '''
+
+    def __init__(self, grid, xp, n_states=N_STATES):
+        self.xp = xp
+        self.shape = grid.shape
+        self.n_states = n_states
+        self._offsets_y = xp.array(OFFSETS_Y, dtype=xp.int64)
+        self._offsets_x = xp.array(OFFSETS_X, dtype=xp.int64)
+        self._changed_marks = xp.zeros(grid.size, dtype=bool) # Scratch membership mask, all False between updates
+        self.reset(grid)
+
+    def reset(self, grid):
+        ''' Rebuilds the histogram and counts from scratch (one full pass) '''
+        xp = self.xp
+        self.pair_counts = pair_histogram(grid, xp, self.n_states).astype(xp.int64)
+        self.state_counts = state_counts(grid, xp, self.n_states).astype(xp.int64)
+
+    def update(self, old_grid, new_grid, touched):
+        '''
+        Applies one step's changes. touched holds flat indices (duplicates allowed) of every cell the step may have
+        written; cells whose value didn't actually change are skipped
+        '''
+        xp = self.xp
+        n_states = self.n_states
+        height, width = self.shape[-2:]
+        n_lattices = old_grid.size // (height * width)
+        flat_old, flat_new = old_grid.reshape(-1), new_grid.reshape(-1)
+
+        touched = xp.unique(touched)
+        changed = touched[flat_old[touched] != flat_new[touched]]
+        if changed.size == 0:
+            return
+        lattice = changed // (height * width)
+        old_cells, new_cells = flat_old[changed].astype(xp.int64), flat_new[changed].astype(xp.int64)
+
+        pair_bins = lattice * (n_states * n_states)
+        added, removed = [], []
+        self._changed_marks[changed] = True
+        for direction in range(8):
+            neighbors = neighbor_flat_index(changed, direction, self._offsets_y, self._offsets_x, height, width)
+            old_neighbors, new_neighbors = flat_old[neighbors].astype(xp.int64), flat_new[neighbors].astype(xp.int64)
+
+            # (changed cell, neighbor) pairs
+            removed.append(pair_bins + old_cells * n_states + old_neighbors)
+            added.append(pair_bins + new_cells * n_states + new_neighbors)
+
+            # (neighbor, changed cell) pairs - unless the neighbor changed too, in which case this is
+            # that cell's own (changed cell, neighbor) pair and was counted above already
+            unchanged = ~self._changed_marks[neighbors]
+            removed.append((pair_bins + old_neighbors * n_states + old_cells)[unchanged])
+            added.append((pair_bins + new_neighbors * n_states + new_cells)[unchanged])
+        self._changed_marks[changed] = False
+
+        n_pair_bins = n_lattices * n_states * n_states
+        pair_delta = xp.bincount(xp.concatenate(added), minlength=n_pair_bins) - \
+                     xp.bincount(xp.concatenate(removed), minlength=n_pair_bins)
+        self.pair_counts += pair_delta.reshape(self.pair_counts.shape)
+
+        state_bins = lattice * n_states
+        state_delta = xp.bincount(state_bins + new_cells, minlength=n_lattices * n_states) - \
+                      xp.bincount(state_bins + old_cells, minlength=n_lattices * n_states)
+        self.state_counts += state_delta.reshape(self.state_counts.shape)
+
+    def entropy(self, log_table):
+        ''' Boundary complexity from the tracked histogram (no pass over the lattice) '''
+        n_cells = self.shape[-2] * self.shape[-1]
+        return complexity_from_histogram(self.pair_counts, self.state_counts / n_cells, log_table, n_cells, self.xp)
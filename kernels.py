@@ -0,0 +1,299 @@
+import numpy as np
+from backend import is_cupy
+
+'''
+Array kernels shared by our RPS engines.
+
+neighbor_counts() replaces the old pad + (8, H, W) neighbor tensor + four comparison passes with a single fused
+stencil over the toroidal Moore neighborhood. Every cell state v is encoded as a 4-bit "nibble" (1 << 4*v),
+so summing the eight neighbor codes counts all states at once (a count is at most 8, which fits in a nibble).
+The 4 states of the RPS games fit a uint16 code; rule sets with more species (see rules.py) use up to MAX_STATES.
+
+sublattice_swaps() runs mobility as exact pair exchanges on non-overlapping sublattices, so parallel movers never collide.
+'''
+
+# Moore neighborhood offsets, in the same order as the old neighbors[0..7] planes
+OFFSETS_Y = [-1, -1, -1, 0, 0, 1, 1, 1]
+OFFSETS_X = [-1, 0, 1, -1, 1, -1, 0, 1]
+
+N_STATES = 4 # empty, rock, paper, scissors
+MAX_STATES = 16 # Nibble codes of 16 states fill a uint64
+
+_nibble_codes = {} # n_states -> code of every state, in the narrowest unsigned type holding them all
+
+_cupy_kernels = {} # Compiled lazily, so importing this module never needs a GPU
+
+
+def _roll_add(out, src, axis):
+    '''
+    out += roll(src, 1, axis) + roll(src, -1, axis), with toroidal wrap, written as in-place slice adds
+    so no padded or rolled copy of the grid is ever materialized
+    '''
+    n = src.shape[axis]
+    def sl(start, stop):
+        index = [slice(None)] * src.ndim
+        index[axis] = slice(start, stop)
+        return tuple(index)
+
+    out[sl(1, None)] += src[sl(None, -1)] # neighbor above/left
+    out[sl(None, 1)] += src[sl(n - 1, None)] # wrap-around
+    out[sl(None, -1)] += src[sl(1, None)] # neighbor below/right
+    out[sl(n - 1, None)] += src[sl(None, 1)] # wrap-around
+
+
+def _get_nibble_codes(n_states):
+    if n_states not in _nibble_codes:
+        dtype = np.uint16 if n_states <= 4 else np.uint32 if n_states <= 8 else np.uint64
+        _nibble_codes[n_states] = np.array([1 << (4 * v) for v in range(n_states)], dtype=dtype)
+    return _nibble_codes[n_states]
+
+
+def _neighbor_counts_numpy(grid, n_states):
+    ''' Separable rolled-sum path: 3x3 box sum of the nibble codes, minus the center cell '''
+    code = _get_nibble_codes(n_states)[grid] # (..., H, W) uint16 for 4 states, one pass over the grid
+
+    rows = code.copy()
+    _roll_add(rows, code, axis=-1) # horizontal 1x3 sums
+    box = rows.copy()
+    _roll_add(box, rows, axis=-2) # vertical 3x1 sums of those -> 3x3 box
+    box -= code # drop the center, leaving the 8 Moore neighbors
+
+    counts = np.empty((n_states,) + grid.shape, dtype=np.uint8)
+    for v in range(n_states):
+        counts[v] = (box >> box.dtype.type(4 * v)) & 0xF
+    return counts
+
+
+def _get_cupy_neighbor_kernel(n_states):
+    if ('neighbors', n_states) not in _cupy_kernels:
+        import cupy as cp
+        # One thread per cell: read the 8 wrapped neighbors once, accumulate nibbles in a register,
+        # then write every count plane from the same launch
+        _cupy_kernels[('neighbors', n_states)] = cp.ElementwiseKernel(
+            'raw T grid, int32 H, int32 W',
+            'raw uint8 counts',
+            '''
+            const int plane = H * W;
+            const int base = (i / plane) * plane;
+            const int r = (i / W) % H;
+            const int c = i % W;
+            const int up = (r == 0) ? H - 1 : r - 1;
+            const int down = (r == H - 1) ? 0 : r + 1;
+            const int left = (c == 0) ? W - 1 : c - 1;
+            const int right = (c == W - 1) ? 0 : c + 1;
+
+            ACC acc = 0;
+            acc += (ACC)1 << (4 * (int)grid[base + up * W + left]);
+            acc += (ACC)1 << (4 * (int)grid[base + up * W + c]);
+            acc += (ACC)1 << (4 * (int)grid[base + up * W + right]);
+            acc += (ACC)1 << (4 * (int)grid[base + r * W + left]);
+            acc += (ACC)1 << (4 * (int)grid[base + r * W + right]);
+            acc += (ACC)1 << (4 * (int)grid[base + down * W + left]);
+            acc += (ACC)1 << (4 * (int)grid[base + down * W + c]);
+            acc += (ACC)1 << (4 * (int)grid[base + down * W + right]);
+
+            const long long n = _ind.size();
+            for (int v = 0; v < N_STATES; v++) {
+                counts[v * n + i] = (acc >> (4 * v)) & 0xF;
+            }
+            ''',
+            f'rps_neighbor_counts_{n_states}',
+            preamble=f"#define N_STATES {n_states}\ntypedef {'unsigned int' if n_states <= 8 else 'unsigned long long'} ACC;")
+    return _cupy_kernels[('neighbors', n_states)]
+
+
+def _neighbor_counts_cupy(grid, n_states):
+    import cupy as cp
+    height, width = grid.shape[-2:]
+    counts = cp.empty((n_states,) + grid.shape, dtype=cp.uint8)
+    # The kernel iterates over grid.size cells (size=...) and scatters into the count planes itself
+    _get_cupy_neighbor_kernel(n_states)(grid, cp.int32(height), cp.int32(width), counts, size=grid.size)
+    return counts
+
+
+def neighbor_counts(grid, xp, n_states=N_STATES):
+    '''
+    Counts, for every cell, how many of its 8 toroidal Moore neighbors are in each state.
+
+    grid is a (..., H, W) integer array holding states 0..n_states - 1 (at most MAX_STATES); any leading batch
+    dimensions are treated as independent lattices.
+    Returns a (n_states, ..., H, W) uint8 array where counts[v] is the number of neighbors in state v
+    (so counts[0] counts empty neighbors and 8 - counts[0] is the non-empty neighbor count)
+    '''
+    if is_cupy(xp):
+        return _neighbor_counts_cupy(grid, n_states)
+    return _neighbor_counts_numpy(grid, n_states)
+
+
+def neighbor_flat_index(flat_index, direction, offsets_y, offsets_x, height, width):
+    '''
+    Flat index of the neighbor in Moore direction 0..7 of each flat cell index, wrapping around the torus.
+    Works for stacked (..., H, W) lattices too: the neighbor always stays inside its own H x W lattice
+    '''
+    x = flat_index % width
+    y = (flat_index // width) % height
+    lattice_start = flat_index - (y * width + x)
+    return lattice_start + ((y + offsets_y[direction]) % height) * width + (x + offsets_x[direction]) % width
+
+
+def batched_bincount(values, n_bins, xp, weights=None):
+    '''
+    bincount over the last two axes of a (..., H, W) integer array, independently for every leading index.
+    Returns (..., n_bins). Stacked lattices are offset into disjoint bin ranges so this is still a single bincount
+    '''
+    lead_shape = values.shape[:-2]
+    flat_values = values.reshape(-1)
+    n_lattices = flat_values.size // max(values.shape[-2] * values.shape[-1], 1)
+    if n_lattices > 1:
+        lattice_ids = xp.arange(n_lattices, dtype=xp.int64).repeat(flat_values.size // n_lattices)
+        flat_values = flat_values + lattice_ids * n_bins
+    flat_weights = None if weights is None else weights.reshape(-1)
+    counts = xp.bincount(flat_values, weights=flat_weights, minlength=n_lattices * n_bins)
+    return counts.reshape(lead_shape + (n_bins,))
+
+
+def state_counts(grid, xp, n_states=N_STATES):
+    ''' Population of each state 0..n_states - 1 in a single bincount pass. Returns (..., n_states) for a (..., H, W) grid '''
+    return batched_bincount(grid, n_states, xp)
+
+
+# --- Compact 2-bit storage: 4 cells per byte, cell j of a byte lives in bits 2j..2j+1 ---
+
+CELLS_PER_BYTE = 4
+
+# _PACKED_STATE_COUNTS[b, v] = how many of the 4 cells packed in byte b are in state v
+_PACKED_STATE_COUNTS = np.array([[sum(((b >> (2 * j)) & 3) == v for j in range(CELLS_PER_BYTE)) for v in range(N_STATES)]
+                                 for b in range(256)], dtype=np.int64)
+
+
+def pack_2bit(grid, xp):
+    '''
+    Packs a (..., H, W) uint8 grid of states 0..3 into a (..., H, W // 4) uint8 array, 4 cells per byte.
+    W must be divisible by 4
+    '''
+    width = grid.shape[-1]
+    if width % CELLS_PER_BYTE != 0:
+        raise ValueError(f"2-bit packing needs the last grid dimension to be divisible by 4, got {width}")
+    quads = grid.reshape(grid.shape[:-1] + (width // CELLS_PER_BYTE, CELLS_PER_BYTE))
+    packed = quads[..., 0].astype(xp.uint8)
+    packed |= quads[..., 1] << 2
+    packed |= quads[..., 2] << 4
+    packed |= quads[..., 3] << 6
+    return packed
+
+
+def unpack_2bit(packed, xp):
+    ''' Inverse of pack_2bit: (..., H, W // 4) packed bytes -> (..., H, W) uint8 states '''
+    cells = xp.empty(packed.shape + (CELLS_PER_BYTE,), dtype=xp.uint8)
+    for j in range(CELLS_PER_BYTE):
+        cells[..., j] = (packed >> (2 * j)) & 3
+    return cells.reshape(packed.shape[:-1] + (packed.shape[-1] * CELLS_PER_BYTE,))
+
+
+def packed_state_counts(packed, xp):
+    '''
+    Population of each state 0..3 computed straight from packed bytes: one bincount over the bytes,
+    then a (256, 4) lookup table turns byte frequencies into cell counts. Returns (..., 4) int64 counts
+    '''
+    byte_frequencies = batched_bincount(packed, 256, xp)
+    return byte_frequencies @ xp.asarray(_PACKED_STATE_COUNTS)
+
+
+# --- Conflict-free mobility: exact pair swaps on non-overlapping sublattices ---
+
+# (dy, dx) from the first cell of a pair to its partner: horizontal, vertical, diagonal, antidiagonal.
+# Every Moore direction is +/- one of these axes
+SWAP_AXES = [(0, 1), (1, 0), (1, 1), (-1, 1)]
+
+# One substep per (axis, parity), where parity is that of the first cell's column (of its row for the vertical axis).
+# Within a substep the pairs are disjoint; over all 8, every neighbor pair of the torus comes up exactly once
+SWAP_SUBSTEPS = [(axis, parity) for axis in range(len(SWAP_AXES)) for parity in (0, 1)]
+
+# Moore direction index (into OFFSETS_Y / OFFSETS_X) pointing along (+) and against (-) each axis
+_AXIS_DIRECTIONS = [(list(zip(OFFSETS_Y, OFFSETS_X)).index((dy, dx)), list(zip(OFFSETS_Y, OFFSETS_X)).index((-dy, -dx)))
+                    for dy, dx in SWAP_AXES]
+
+
+def _wrapped_blocks(shift):
+    # (first, second) slices pairing index i with (i + shift) mod n, split where the wrap-around happens
+    if shift == 0:
+        return [(slice(None), slice(None))]
+    if shift == 1:
+        return [(slice(None, -1), slice(1, None)), (slice(-1, None), slice(None, 1))]
+    return [(slice(1, None), slice(None, -1)), (slice(None, 1), slice(-1, None))]
+
+
+def _shifted_pairs(first, second, dy, dx):
+    ''' View pairs matching first[..., y, x] with second[..., (y + dy) % h, (x + dx) % w] '''
+    return [(first[..., first_rows, first_cols], second[..., second_rows, second_cols])
+            for first_rows, second_rows in _wrapped_blocks(dy) for first_cols, second_cols in _wrapped_blocks(dx)]
+
+
+def _substep_pairs(even, odd, axis, parity):
+    '''
+    The pairs of one substep as view pairs into the even- and odd-column planes of the lattice
+    (even[..., y, j] is column 2j, odd[..., y, j] column 2j + 1). Every view is a block of contiguous rows
+    '''
+    dy, dx = SWAP_AXES[axis]
+    if dx == 0: # vertical pairs stay inside one plane: rows of this parity with the next row
+        rows = [(plane[..., 0::2, :], plane[..., 1::2, :]) if parity == 0 else (plane[..., 1::2, :], plane[..., 0::2, :])
+                for plane in (even, odd)]
+        return [pair for first, second in rows for pair in _shifted_pairs(first, second, parity, 0)]
+    # The partner one column to the right is in the other plane: same index from an even column,
+    # the next index (wrapping) from an odd one
+    if parity == 0:
+        return _shifted_pairs(even, odd, dy, 0)
+    return _shifted_pairs(odd, even, dy, 1)
+
+
+def swap_state_bits(n_states):
+    ''' Bits sublattice_swaps() packs a state into: 2 for our 4 states, 4 for up to 16 (the intent takes the rest of a byte) '''
+    if n_states > MAX_STATES:
+        raise ValueError(f"At most {MAX_STATES} states fit next to a move intent in one byte, got {n_states}")
+    return 2 if n_states <= 4 else 4
+
+
+def _swap_pairs(first, second, forward_code, backward_code, intent_bits, xp):
+    # Cells hold state | (intent << state bits); a pair swaps when either cell's intent points at the other
+    swap = ((first & intent_bits) == forward_code) | ((second & intent_bits) == backward_code)
+    mask = xp.uint8(0) - swap.view(xp.uint8) # 0xFF where swapping, branch-free
+    difference = (first ^ second) & mask
+    first ^= difference
+    second ^= difference
+    # Both individuals of a swap have moved this step, so both intents are spent
+    keep = ~(mask & intent_bits)
+    first &= keep
+    second &= keep
+
+
+def sublattice_swaps(grid, intent, substep_order, xp, state_bits=2):
+    '''
+    Moves individuals by exact pair swaps, in place.
+
+    grid is a (..., H, W) lattice with even H and W, intent a uint8 array of the same shape holding 1 + the Moore
+    direction each cell wants to move in (0 = staying put). Neighbor pairs are split into the 8 substeps of
+    SWAP_SUBSTEPS (one per axis and sublattice parity), run in substep_order. The pairs of a substep are disjoint,
+    so each substep is a fully parallel, race-free exchange.
+
+    A pair swaps when either cell wants to move onto the other, so nothing is duplicated or lost however many movers
+    pick the same target, and an individual takes part in at most one swap per step.
+    Each cell's state and intent share one byte, the state in the low state_bits bits (see swap_state_bits)
+    '''
+    height, width = grid.shape[-2:]
+    if height % 2 or width % 2:
+        raise ValueError(f"Sublattice swaps need even lattice dimensions, got {height} x {width}")
+
+    # One byte per cell carries the state and the pending move together, split into even and odd columns
+    # so that every substep works on blocks of contiguous rows
+    state_mask = (1 << state_bits) - 1
+    intent_bits = xp.uint8(0xF << state_bits & 0xFF)
+    even = grid[..., 0::2] | (intent[..., 0::2] << state_bits)
+    odd = grid[..., 1::2] | (intent[..., 1::2] << state_bits)
+    for substep in substep_order:
+        axis, parity = SWAP_SUBSTEPS[substep]
+        forward_code, backward_code = [xp.uint8((direction + 1) << state_bits) for direction in _AXIS_DIRECTIONS[axis]]
+        for first, second in _substep_pairs(even, odd, axis, parity):
+            _swap_pairs(first, second, forward_code, backward_code, intent_bits, xp)
+    grid[..., 0::2] = even & state_mask
+    grid[..., 1::2] = odd & state_mask
+    return grid
@@ -0,0 +1,158 @@
+import time
+import tracemalloc
+from backend import is_cupy
+
+'''
+Opt-in per-phase instrumentation for our RPS engines.
+
+update() wraps each of its phases (random words, neighbor counts, probabilities, masks, settlement, domination,
+mobility, entropy tracking, counting) in a named span and reports how many cells settled, were dominated or tried
+to move. A game's profiler is NULL_PROFILER unless one is passed in, whose spans are a shared do-nothing context
+manager and whose counters ignore their argument - so a disabled profiler adds no work to the simulation and no
+device synchronization, only a few no-op calls per step.
+
+Profiler times spans with CUDA events on cupy (recorded on the current stream, resolved once per step, so the GPU is
+not synchronized inside the step) and perf_counter_ns on numpy. Event counts are kept as device scalars until the
+end of the step. With allocations=True it also tracks the bytes each span allocates: new memory-pool bytes on cupy,
+the tracemalloc peak above the span's starting point on numpy (which slows numpy down somewhat, so it's off by default).
+Spans are flat: phases follow one another, they don't nest.
+
+Example:
+  profiler = Profiler(game.xp)
+  game = RockPaperScissors(dims=[1024, 1024], profiler=profiler)
+  ...
+  print(profiler.report())
+or Profiler(xp, callback=fn) to get fn(step, record) with every step's timings and counts
+'''
+
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullProfiler():
+    ''' The disabled profiler: every hook is a no-op '''
+    enabled = False
+
+    def span(self, name):
+        return _NULL_SPAN
+
+    def count(self, name, mask):
+        pass
+
+    def end_step(self, step):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class _Span():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler._on_device:
+            self.start = profiler.xp.cuda.Event()
+            self.start.record()
+            if profiler.allocations:
+                self.start_bytes = profiler._pool.total_bytes()
+        else:
+            if profiler.allocations:
+                tracemalloc.reset_peak()
+                self.start_bytes = tracemalloc.get_traced_memory()[0]
+            self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        profiler = self.profiler
+        if profiler._on_device:
+            stop = profiler.xp.cuda.Event()
+            stop.record()
+            allocated = profiler._pool.total_bytes() - self.start_bytes if profiler.allocations else 0
+            profiler._pending.append((self.name, self.start, stop, allocated))
+        else:
+            elapsed = time.perf_counter_ns() - self.start
+            allocated = tracemalloc.get_traced_memory()[1] - self.start_bytes if profiler.allocations else 0
+            profiler._pending.append((self.name, elapsed, None, allocated))
+        return False
+
+
+class Profiler():
+    '''
+    Collects named spans and event counts per step. end_step(step) (called by update()) resolves the step's spans into
+    a record {'spans': {name: seconds}, 'counts': {name: int}, 'allocated': {name: bytes}}, adds it to the running
+    totals and passes it to callback(step, record) if given. report() formats the totals; totals() returns them
+    '''
+    enabled = True
+
+    def __init__(self, xp, callback=None, allocations=False):
+        self.xp = xp
+        self.callback = callback
+        self.allocations = allocations
+        self._on_device = is_cupy(xp)
+        self._pool = xp.get_default_memory_pool() if self._on_device else None
+        if allocations and not self._on_device and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._pending = [] # (name, start event or elapsed ns, stop event or None, allocated bytes) of this step
+        self._pending_counts = [] # (name, device scalar) of this step
+        self.steps = 0
+        self.span_seconds, self.span_calls, self.span_allocated, self.event_counts = {}, {}, {}, {}
+
+    def span(self, name):
+        ''' Context manager timing one phase '''
+        return _Span(self, name)
+
+    def count(self, name, mask):
+        ''' Adds the number of True cells of mask to this step's counter `name` (summed on the device, read at end_step) '''
+        self._pending_counts.append((name, self.xp.count_nonzero(mask)))
+
+    def end_step(self, step):
+        record = {'spans': {}, 'counts': {}, 'allocated': {}}
+        if self._on_device and self._pending:
+            self._pending[-1][2].synchronize() # The step's last event: every earlier one is done too
+        for name, start, stop, allocated in self._pending:
+            seconds = self.xp.cuda.get_elapsed_time(start, stop) / 1e3 if stop is not None else start / 1e9
+            record['spans'][name] = record['spans'].get(name, 0.0) + seconds
+            record['allocated'][name] = record['allocated'].get(name, 0) + allocated
+            self.span_calls[name] = self.span_calls.get(name, 0) + 1
+        for name, value in self._pending_counts:
+            record['counts'][name] = record['counts'].get(name, 0) + int(value)
+        self._pending, self._pending_counts = [], []
+
+        for name, seconds in record['spans'].items():
+            self.span_seconds[name] = self.span_seconds.get(name, 0.0) + seconds
+            self.span_allocated[name] = self.span_allocated.get(name, 0) + record['allocated'][name]
+        for name, value in record['counts'].items():
+            self.event_counts[name] = self.event_counts.get(name, 0) + value
+        self.steps += 1
+        if self.callback is not None:
+            self.callback(step, record)
+
+    def totals(self):
+        ''' Aggregates over every finished step: seconds, calls and allocated bytes per span, and event counts '''
+        return {'steps': self.steps, 'seconds': dict(self.span_seconds), 'calls': dict(self.span_calls),
+                'allocated': dict(self.span_allocated), 'counts': dict(self.event_counts)}
+
+    def report(self):
+        ''' The totals as a table, slowest span first '''
+        total = sum(self.span_seconds.values()) or 1.0
+        lines = [f"{self.steps} steps profiled",
+                 f"{'span':>16} {'calls':>7} {'total ms':>10} {'ms/step':>9} {'share':>6}" + (f" {'MB/step':>8}" if self.allocations else '')]
+        for name, seconds in sorted(self.span_seconds.items(), key=lambda item: -item[1]):
+            line = f"{name:>16} {self.span_calls[name]:>7} {seconds * 1e3:>10.2f} {seconds * 1e3 / max(self.steps, 1):>9.3f} {seconds / total:>6.1%}"
+            if self.allocations:
+                line += f" {self.span_allocated[name] / 2**20 / max(self.steps, 1):>8.2f}"
+            lines.append(line)
+        for name, value in self.event_counts.items():
+            lines.append(f"{name:>16} {value / max(self.steps, 1):>12.1f} per step")
+        return '\n'.join(lines)
@@ -1,12 +1,26 @@
-import pygame
+import argparse
+import queue
+import threading
 import numpy as np
-import h5py # Import h5py
-import time # Import time for potential delays
-import sys
+import pygame
+from utils.colors import PALETTE
+from utils.trajectory import TrajectoryReader
+from utils.frame_server import FrameClient
 
 '''
 File takes as input a .h5 file containing simulation logs of a rock-paper-scissors cellular automaton.
 It visualizes the simulation using Pygame, displaying the grid state at each epoch.
+
+Frames are streamed lazily from the file by a read-ahead thread (so playback starts immediately, even on multi-GB runs),
+copied whole into an 8-bit palettized surface through pygame.surfarray (SDL applies the palette lookup on blit),
+and optionally scaled up by an integer factor.
+
+With --live NAME it instead attaches to a running simulation's FrameServer (utils/frame_server.py) and draws its
+newest frame every tick, straight out of shared memory. An ensemble's server publishes stacked (R, H, W) lattices;
+--replica r picks the one to draw (replicas are numbered in flat order, 0 by default).
+
+Usage: python pygame-visualization-script.py [file.h5] [--scale 2] [--fps 60] [--readahead 32]
+       python pygame-visualization-script.py --live rps_live [--replica 0] [--scale 2] [--fps 60]
 '''
 
 # Try to import tkinter for a GUI file chooser. If unavailable, we'll fall back to
@@ -18,128 +32,200 @@ try:
 except Exception:
     TK_AVAILABLE = False
 
-# Assuming width and height are defined globally or passed in
-# If running this code separately, make sure width and height are defined.
-# Example:
-width = 400
-height = 400
-fps = 60 # Also ensure fps is defined
-
-# Define colors for the states (0: empty, 1: rock, 2: paper, 3: scissors)
-BLACK = (36, 36, 36)       # Empty
-RED = (232, 87, 58)       # Rock
-GREEN = (42, 163, 75)    # Paper
-BLUE = (119, 86, 219)      # Scissors
-
-COLORS = {
-    0: BLACK,
-    1: RED,
-    2: GREEN,
-    3: BLUE
-}
-
-# Initialize Pygame
-pygame.init()
-
-# Set the dimensions of the window
-screen_width = width
-screen_height = height
-screen = pygame.display.set_mode((screen_width, screen_height))
-
-# Set the window title
-pygame.display.set_caption("Rock Paper Scissors Simulation")
-
-# Load the simulation log from the HDF5 file
-simulation_grids = []
-
-# Choose a file: priority order -> sys.argv[1] -> tkinter chooser -> input prompt -> default path
-output_filename = None
-if len(sys.argv) > 1:
-    output_filename = sys.argv[1]
-else:
+
+def choose_file(path):
+    ''' Choose a file: priority order -> command line -> tkinter chooser -> input prompt -> default path '''
+    if path:
+        return path
     if TK_AVAILABLE:
         root = tk.Tk()
         root.withdraw()
-        output_filename = filedialog.askopenfilename(initialdir='logs', title='Select simulation HDF5 file', filetypes=[('HDF5 files', '*.h5'), ('All files', '*.*')])
+        path = filedialog.askopenfilename(initialdir='logs', title='Select simulation HDF5 file', filetypes=[('HDF5 files', '*.h5'), ('All files', '*.*')])
         root.destroy()
+        return path
+    try:
+        prompt = "Enter path to HDF5 file (press Enter to use 'logs\\simulation_grids.h5'): "
+        choice = input(prompt).strip()
+        return choice if choice else 'logs\\simulation_grids.h5'
+    except Exception:
+        return 'logs\\simulation_grids.h5'
+
+
+class FrameRenderer():
+    '''
+    Draws whole (width, height) state grids onto the screen: the grid is copied as palette indices into an 8-bit surface
+    with our state colors as its palette, scaled by an integer factor if asked, and blitted in one go
+    '''
+
+    def __init__(self, screen, shape, scale=1):
+        self.screen = screen
+        self.scale = scale
+        palette = [tuple(int(c) for c in color) for color in PALETTE]
+        self.frame_surface = pygame.Surface(shape, depth=8)
+        self.frame_surface.set_palette(palette)
+        self.scaled_surface = None
+        if scale > 1:
+            self.scaled_surface = pygame.Surface((shape[0] * scale, shape[1] * scale), depth=8)
+            self.scaled_surface.set_palette(palette)
+
+    def draw(self, grid):
+        pygame.surfarray.blit_array(self.frame_surface, grid)
+        surface = self.frame_surface
+        if self.scaled_surface is not None:
+            pygame.transform.scale(self.frame_surface, self.scaled_surface.get_size(), self.scaled_surface)
+            surface = self.scaled_surface
+        self.screen.blit(surface, (0, 0))
+
+
+class FramePrefetcher():
+    '''
+    Reads frames from a TrajectoryReader on a background thread into a bounded queue of `readahead` frames,
+    so the display loop never waits on disk/decompression and memory stays bounded however long the run is
+    '''
+    _END = object()
+
+    def __init__(self, reader, readahead=32):
+        self.reader = reader
+        self._frames = queue.Queue(maxsize=readahead)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read_loop, name='frame-prefetch', daemon=True)
+        self._thread.start()
+
+    def _read_loop(self):
+        for t in range(len(self.reader)):
+            if self._stop.is_set():
+                return
+            self._frames.put((t, self.reader[t]))
+        self._frames.put(self._END)
+
+    def __iter__(self):
+        while True:
+            item = self._frames.get()
+            if item is self._END:
+                return
+            yield item
+
+    def close(self):
+        self._stop.set()
+        try: # Unblock the reader thread if it's waiting on a full queue
+            while True:
+                self._frames.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class LiveFrames():
+    '''
+    Frames of a running simulation, read zero-copy from its FrameServer ring: each iteration yields (step, grid)
+    for the newest published frame, or None while nothing new has been published.
+    For a ring of stacked lattices, grid is lattice `replica` of the stack (in flat order); shape is the (H, W) drawn
+    '''
+
+    def __init__(self, client, replica=0):
+        self.client = client
+        self.shape = client.shape[-2:]
+        self.replicas = int(np.prod(client.shape[:-2], dtype=np.int64))
+        if not 0 <= replica < self.replicas:
+            raise ValueError(f"Replica {replica} out of range: the frames hold {self.replicas} lattice(s)")
+        self.replica = replica
+
+    def __iter__(self):
+        while True:
+            seq = self.client.last_seq
+            frame = self.client.latest(copy=False) # Drawing copies it into the surface right away
+            if frame is None or frame.seq == seq:
+                yield None
+            else:
+                yield frame.step, frame.grid.reshape((-1,) + self.shape)[self.replica]
+
+    def close(self):
+        self.client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play back an RPS simulation trajectory')
+    parser.add_argument('path', nargs='?', default=None, help='HDF5 trajectory file (asks if omitted)')
+    parser.add_argument('--scale', type=int, default=1, help='integer upscaling: each cell becomes scale x scale pixels')
+    parser.add_argument('--fps', type=int, default=60)
+    parser.add_argument('--readahead', type=int, default=32, help='frames to prefetch ahead of the display')
+    parser.add_argument('--live', default=None, metavar='NAME', help='watch a running simulation publishing to FrameServer NAME')
+    parser.add_argument('--replica', type=int, default=0, help='with --live, which lattice of an ensemble to draw')
+    args = parser.parse_args()
+
+    if args.live:
+        try:
+            client = FrameClient(args.live)
+        except FileNotFoundError:
+            print(f"Error: no simulation is publishing frames as '{args.live}'.")
+            raise SystemExit(1)
+        try:
+            source = LiveFrames(client, args.replica)
+        except ValueError as error:
+            print(f"Error: {error}.")
+            client.close()
+            raise SystemExit(1)
+        shape = source.shape
+        print(f"Attached to live frames '{args.live}' of shape {client.shape}" +
+              (f", drawing replica {args.replica}." if source.replicas > 1 else "."))
     else:
+        output_filename = choose_file(args.path)
         try:
-            prompt = "Enter path to HDF5 file (press Enter to use 'logs\\simulation_grids.h5'): "
-            choice = input(prompt).strip()
-            output_filename = choice if choice else 'logs\\simulation_grids.h5'
-        except Exception:
-            output_filename = 'logs\\simulation_grids.h5'
-
-try:
-    if not output_filename:
-        raise FileNotFoundError('No file selected')
-
-    with h5py.File(output_filename, 'r') as f:
-        # Assuming datasets are named 'epoch_00000', 'epoch_00001', etc.
-        # Get sorted list of epoch dataset names
-        epoch_names = sorted([name for name in f.keys() if name.startswith('epoch_')])
-        for name in epoch_names:
-            grid_np = f[name][()] # Load the dataset as a NumPy array
-            simulation_grids.append(grid_np)
-
-    print(f"Successfully loaded {len(simulation_grids)} grid states from '{output_filename}'.")
-
-except FileNotFoundError:
-    print(f"Error: {output_filename} not found or not selected. Please run the simulation cell first or choose a valid file.")
-    simulation_grids = [] # Empty list if file not found
-except Exception as e:
-    print(f"Error loading data from HDF5 file '{output_filename}': {e}")
-    simulation_grids = []
-
-
-# --- Drawing parameters ---
-# Calculate cell size
-cell_size_x = screen_width // width
-cell_size_y = screen_height // height
-
-# Main game loop
-running = True
-clock = pygame.time.Clock()
-current_epoch_index = 0
-
-while running:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-
-    if simulation_grids and current_epoch_index < len(simulation_grids):
-        current_grid = simulation_grids[current_epoch_index] # Corrected: Access the grid directly from the list
-
-        # Clear the screen
-        screen.fill(BLACK)
-
-        # Draw the grid
-        for y in range(height):
-            for x in range(width):
-                state = current_grid[x,y]
-                color = COLORS.get(state, BLACK) # Default to black if state is unknown
-                pygame.draw.rect(screen, color, (x * cell_size_x, y * cell_size_y, cell_size_x, cell_size_y))
+            if not output_filename:
+                raise FileNotFoundError('No file selected')
+            reader = TrajectoryReader(output_filename)
+        except (FileNotFoundError, OSError):
+            print(f"Error: {output_filename} not found or not selected. Please run the simulation cell first or choose a valid file.")
+            raise SystemExit(1)
+        print(f"Opened '{output_filename}' with {len(reader)} grid states.")
+        source = FramePrefetcher(reader, args.readahead)
+        shape = reader.shape
+
+    # The first grid axis is drawn along the screen's x axis (as surfarray expects), the second along y
+    width, height = shape
+
+    # Initialize Pygame
+    pygame.init()
+
+    # Set the dimensions of the window
+    screen = pygame.display.set_mode((width * args.scale, height * args.scale))
+
+    # Set the window title
+    pygame.display.set_caption("Rock Paper Scissors Simulation")
+
+    # Main game loop
+    running = True
+    clock = pygame.time.Clock()
+    renderer = FrameRenderer(screen, (width, height), args.scale)
+    frames = iter(source)
+
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+
+        frame = next(frames, None)
+        if frame is None:
+            if args.live:
+                clock.tick(args.fps) # Nothing new published yet: keep the window responsive and look again
+                continue
+            # Stop when the simulation ends
+            print("Simulation visualization finished.")
+            break
+        current_epoch_index, current_grid = frame
+
+        # Draw the whole grid in one blit
+        renderer.draw(current_grid)
 
         # Update the display
         pygame.display.flip()
 
-        # Move to the next epoch
-        current_epoch_index += 1
-
         # Control playback speed
-        clock.tick(fps) # Use the fps constant defined earlier
-        if current_epoch_index%10 == 0:
-            print(f"Epoch {current_epoch_index} passed")
-
-    elif simulation_grids:
-        # Stop or loop when simulation ends
-        print("Simulation visualization finished.")
-        running = False # Stop after the last frame
-
-    else:
-        # If no grids were loaded, exit
-        running = False
-
-
-# Quit Pygame
-pygame.quit()
\ No newline at end of file
+        clock.tick(args.fps)
+        if (current_epoch_index + 1) % 10 == 0:
+            print(f"Epoch {current_epoch_index + 1} passed")
+
+    # Quit Pygame
+    source.close()
+    if not args.live:
+        reader.close()
+    pygame.quit()
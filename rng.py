@@ -0,0 +1,241 @@
+import sys
+import numpy as np
+from backend import is_cupy
+
+'''
+Counter-based random numbers for our RPS engines.
+
+Instead of drawing several random arrays (and extra integer draws for settlers and movers) from a stateful generator,
+every cell gets one 64-bit word per step from Philox2x32-10, a keyed bijection of the counter (cell index, step).
+The word is returned as two uint32 halves and every random decision of that cell is carved out of it:
+  - the top 24 bits of a half are a uniform draw, compared against a 24-bit integer threshold (see to_threshold),
+  - the low 3 bits of a half pick a Moore direction.
+Nothing is stored between steps, so any (seed, step, cell) can be regenerated on its own: runs replay exactly from
+(seed, step), results don't depend on the backend or on how many lattices are batched together, and a subset of
+cells (a tile, a strip on another process) draws exactly what it would have drawn as part of the whole lattice.
+
+The counter holds the low 32 bits of the cell index. Lattices of 2**32 cells (65536 x 65536) and more carry the high
+bits in the key instead - the stream's key XOR a bijective mix of the high word - so no two cells of a stream ever
+share a counter; below that size the high word is 0 and the key is the stream's own.
+'''
+
+PHILOX_M = 0xD256D19F # Philox2x32 multiplier
+PHILOX_W = 0x9E3779B9 # Key schedule increment (golden ratio)
+PHILOX_ROUNDS = 10
+
+UNIFORM_BITS = 24 # Uniform draws use the top 24 bits of a half, which float32 probabilities resolve exactly
+UNIFORM_SCALE = 1 << UNIFORM_BITS
+SEEDING_STEP = 0xFFFFFFFF # Counter step reserved for the initial seeding, so it never collides with an update step
+SHARED_STREAM = -1 # Stream for draws common to every lattice of a run (e.g. the order of the mobility substeps)
+
+NUMPY_CHUNK = 1 << 14 # Cells per chunk on the numpy path (~200 kB of scratch, fits in L2)
+_LO, _HI = (0, 1) if sys.byteorder == 'little' else (1, 0) # uint32 lanes of a uint64
+
+CELL_COUNTER_CELLS = 1 << 32 # Cells a 32-bit counter lane numbers; beyond them the key carries the high bits
+_cupy_kernels = {} # Compiled lazily, so importing this module never needs a GPU
+
+
+def stream_key(seed, stream=0):
+    '''
+    32-bit Philox key for (seed, stream), mixed with splitmix64 so nearby seeds/streams give unrelated keys.
+    Replica r of an ensemble uses stream r, so it draws the same numbers as a single game with stream=r
+    '''
+    z = (int(seed) * 0x9E3779B97F4A7C15 + int(stream) * 0xD1B54A32D192ED03 + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    z ^= z >> 31
+    return (z ^ (z >> 32)) & 0xFFFFFFFF
+
+
+def mix32(value, xp):
+    ''' murmur3's 32-bit finalizer: a bijection of uint32 values with mix32(0) = 0 '''
+    value = xp.asarray(value, dtype=xp.uint32)
+    value = value ^ (value >> 16)
+    value = value * xp.uint32(0x85EBCA6B)
+    value = value ^ (value >> 13)
+    value = value * xp.uint32(0xC2B2AE35)
+    return value ^ (value >> 16)
+
+
+def _philox_rounds_numpy(x0, x1, key, product, halves):
+    # One cache-sized chunk: x0, x1 and key are 1-d uint32, product a uint64 scratch viewed as uint32 (lo, hi) lanes
+    product_lo, product_hi = halves[:, _LO], halves[:, _HI]
+    for r in range(PHILOX_ROUNDS):
+        np.multiply(x0, np.uint64(PHILOX_M), out=product, dtype=np.uint64)
+        np.bitwise_xor(product_hi, x1, out=x0)
+        x0 ^= key
+        x1[...] = product_lo
+        key += np.uint32(PHILOX_W) # wraps mod 2**32, as the key schedule wants
+
+
+def _philox2x32_numpy(counter, step, key):
+    # Broadcast operands are walked in chunks of NUMPY_CHUNK cells, so the ten rounds run in cache
+    # rather than streaming whole-lattice temporaries through memory twenty times
+    iterator = np.nditer([np.asarray(counter, dtype=np.uint32), np.asarray(step, dtype=np.uint32),
+                          np.asarray(key, dtype=np.uint32), None, None],
+                         flags=['external_loop', 'buffered', 'zerosize_ok'],
+                         op_flags=[['readonly'], ['readonly'], ['readonly'], ['writeonly', 'allocate'], ['writeonly', 'allocate']],
+                         op_dtypes=[np.uint32] * 5, buffersize=NUMPY_CHUNK)
+    product = np.empty(NUMPY_CHUNK, dtype=np.uint64)
+    halves = product.view(np.uint32).reshape(NUMPY_CHUNK, 2)
+    with iterator:
+        for counter_chunk, step_chunk, key_chunk, lo, hi in iterator:
+            n = counter_chunk.shape[0]
+            x0 = counter_chunk.copy()
+            x1 = np.array(step_chunk, dtype=np.uint32) # step/key chunks may be stride-0 views of one value
+            round_key = np.array(key_chunk, dtype=np.uint32)
+            _philox_rounds_numpy(x0, x1, round_key, product[:n], halves[:n])
+            lo[...] = x0
+            hi[...] = x1
+        return iterator.operands[3], iterator.operands[4]
+
+
+def _get_cupy_philox_kernel():
+    if 'philox' not in _cupy_kernels:
+        import cupy as cp
+        # All ten rounds stay in registers: one launch writes both halves of every cell's word
+        _cupy_kernels['philox'] = cp.ElementwiseKernel(
+            'uint32 counter, uint32 step, uint32 key',
+            'uint32 lo, uint32 hi',
+            '''
+            unsigned int x0 = counter;
+            unsigned int x1 = step;
+            unsigned int k = key;
+            for (int r = 0; r < 10; r++) {
+                const unsigned long long product = (unsigned long long)0xD256D19Fu * x0;
+                x0 = (unsigned int)(product >> 32) ^ k ^ x1;
+                x1 = (unsigned int)product;
+                k += 0x9E3779B9u;
+            }
+            lo = x0;
+            hi = x1;
+            ''',
+            'rps_philox2x32_10')
+    return _cupy_kernels['philox']
+
+
+def philox2x32(counter, step, key, xp):
+    '''
+    Philox2x32-10 of the counter (counter, step) under key. All three broadcast against each other
+    (uint32 arrays or ints); returns the (lo, hi) uint32 halves of the 64-bit output
+    '''
+    if is_cupy(xp):
+        return _get_cupy_philox_kernel()(xp.asarray(counter, dtype=xp.uint32), xp.uint32(step) if np.ndim(step) == 0 else step,
+                                         xp.asarray(key, dtype=xp.uint32))
+    return _philox2x32_numpy(counter, step, key)
+
+
+def to_threshold(prob, xp):
+    '''
+    Probabilities (floats in [0, 1]) as uint32 thresholds t such that (half >> 8) < t happens with probability t / 2**24.
+    Comparing integers keeps every decision identical across backends
+    '''
+    prob = xp.clip(xp.asarray(prob, dtype=xp.float64), 0.0, 1.0)
+    return xp.floor(prob * UNIFORM_SCALE).astype(xp.uint32)
+
+
+def power_thresholds(keep, max_count, xp):
+    '''
+    Thresholds of 1 - keep**k for k = 0..max_count, one row per lattice: (..., max_count + 1) uint32.
+    The powers are built by repeated float64 multiplication, which is correctly rounded on every backend
+    (a pow() call isn't guaranteed to be)
+    '''
+    keep = xp.asarray(keep, dtype=xp.float64)
+    powers = [xp.ones_like(keep)]
+    for _ in range(max_count):
+        powers.append(powers[-1] * keep)
+    return to_threshold(1 - xp.stack(powers, axis=-1), xp)
+
+
+def lookup_thresholds(table, counts, xp):
+    '''
+    Gathers table[..., counts] for a (..., K) table with one row per lattice and (..., H, W) integer counts,
+    as a single flat take so stacked lattices need no loop
+    '''
+    if table.ndim == 1:
+        return table[counts] # A single lattice needs no row offsets
+    n_entries = table.shape[-1]
+    lead_shape = counts.shape[:-2]
+    n_lattices = int(np.prod(lead_shape, dtype=np.int64))
+    row_offsets = (xp.arange(n_lattices, dtype=xp.int32) * n_entries).reshape(lead_shape + (1, 1))
+    flat_table = xp.broadcast_to(table, lead_shape + (n_entries,)).reshape(-1)
+    return flat_table[row_offsets + counts]
+
+
+def uniform_bits(half):
+    ''' The 24-bit uniform draw in a uint32 half, to compare against to_threshold() thresholds '''
+    return half >> 8
+
+
+def direction_bits(half):
+    ''' Moore direction 0..7 from the low 3 bits of a uint32 half '''
+    return half & 7
+
+
+class CounterRNG():
+    '''
+    Philox streams for one lattice or a stack of lattices.
+
+    seed keys the whole run (None draws a fresh one, kept in .seed so the run can still be replayed).
+    streams is one stream id or an array of them, one per stacked lattice; each lattice gets key stream_key(seed, stream).
+    Cells are counted within their own lattice, so lattice r of a stack draws exactly what a lone lattice with
+    stream r would
+    '''
+
+    def __init__(self, seed, xp, streams=0):
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1, dtype=np.uint64)[0] >> np.uint64(1))
+        self.seed = seed
+        self.xp = xp
+        streams = np.asarray(streams)
+        self.keys = xp.asarray(np.array([stream_key(seed, s) for s in streams.reshape(-1)], dtype=np.uint32).reshape(streams.shape))
+        self._cell_ids = {} # (H, W) -> uint32 cell-index grid, built once per lattice shape
+
+    def lattice_words(self, shape, step):
+        ''' (lo, hi) words of every cell of a (..., H, W) stack whose leading shape matches the streams '''
+        xp = self.xp
+        height, width = shape[-2:]
+        if height * width > CELL_COUNTER_CELLS:
+            lo, hi = self.row_words(xp.arange(height, dtype=xp.int64), (height, width), step)
+        else:
+            if (height, width) not in self._cell_ids:
+                self._cell_ids[(height, width)] = xp.arange(height * width, dtype=xp.uint32).reshape(height, width)
+            lo, hi = philox2x32(self._cell_ids[(height, width)], step, self.keys.reshape(self.keys.shape + (1, 1)), xp)
+        return xp.broadcast_to(lo, shape), xp.broadcast_to(hi, shape)
+
+    def row_words(self, rows, shape, step):
+        '''
+        (lo, hi) words of whole rows of an (H, W) lattice: rows is a 1-d array of row indices, the words come out
+        (..., len(rows), W) with the streams' leading shape. Cell indices are built from the rows in uint32 lanes,
+        so no per-cell index array is ever needed
+        '''
+        xp = self.xp
+        height, width = shape
+        starts = xp.asarray(rows, dtype=xp.int64) * width
+        start_lo = (starts & 0xFFFFFFFF).astype(xp.uint32)[:, None]
+        counter = start_lo + xp.arange(width, dtype=xp.uint32)[None, :] # Low words of row * width + column, wrapping
+        keys = self.keys.reshape(self.keys.shape + (1, 1))
+        if height * width > CELL_COUNTER_CELLS:
+            high = (starts >> 32).astype(xp.uint32)[:, None] + (counter < start_lo) # Carry out of the low word
+            keys = keys ^ mix32(high, xp)
+        return philox2x32(counter, step, keys, xp)
+
+    def words(self, flat_index, step, lattice_size):
+        ''' (lo, hi) words of chosen cells, given as flat indices into the stack of lattices of lattice_size cells each '''
+        xp = self.xp
+        if self.keys.size == 1: # A single lattice: flat indices are already cell indices
+            cell, keys = flat_index, self.keys.reshape(())
+        else:
+            lattice = flat_index // lattice_size
+            cell, keys = flat_index - lattice * lattice_size, self.keys.reshape(-1)[lattice]
+        if lattice_size > CELL_COUNTER_CELLS:
+            keys = keys ^ mix32((cell >> 32).astype(xp.uint32), xp)
+        return philox2x32((cell & 0xFFFFFFFF).astype(xp.uint32), step, keys, xp)
+
+    def shared_permutation(self, n, step):
+        '''
+        A random permutation of range(n) for this step, as a host list. It depends on the seed and step only,
+        not on the streams, so every lattice of a stack - and a lone lattice of any stream - gets the same one
+        '''
+        lo, _ = philox2x32(np.arange(n, dtype=np.uint32), step, stream_key(self.seed, SHARED_STREAM), np)
+        return np.argsort(lo, kind='stable').tolist()
@@ -1,5 +1,7 @@
-import cupy as cp
-import RockPaperScissors
+from backend import asnumpy
+from RockPaperScissors import RockPaperScissors
+from run_control import RunController
+from utils.frame_server import FrameServer
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -9,6 +11,9 @@ Here, we instatiate an RPS game and run it for a number of iterations. Then we v
 
 #Hyper-params:
 k = 10000 #number of iterations
+early_stop = False #Stop before k once a species dies out or the populations stop drifting (see run_control.py)
+publish_live = False #Publish every step to shared memory, to watch with `python pygame-visualization-script.py --live rps_live`
+live_name = 'rps_live' #FrameServer name the viewer attaches to
 
 #Params:
 p,q,gamma = 10, 10, 10 #We can pass in any floats, and we probabilities as the softmax p, g and gamma
@@ -16,14 +21,21 @@ width, height = 512,512
 dims = [width,height] #dimension of our game
 density = 0.5 #Initial starting density
 
-p_settle, p_competition, p_mobility = (p/(p+q+gamma))(q/(p+q+gamma)),(gamma/(p+q+gamma))
+p_settle, p_competition, p_mobility = (p/(p+q+gamma)),(q/(p+q+gamma)),(gamma/(p+q+gamma))
 
 #Initialize our game
 game = RockPaperScissors(dims, density, [p_settle,p_competition,p_mobility])
 game.seeding()
 
-for i in range(k):
+server = FrameServer(live_name, game.shape, n_states=game.n_states) if publish_live else None
+controller = RunController(game, k, check_every=50, stationary_tolerance=0.002) if early_stop else None
+while game.step < k:
     game.update()
+    if server is not None:
+        server.publish_game(game)
+    if controller is not None and (game.step % controller.check_every == 0 or game.step == k) and controller.check():
+        print(f"Stopped at step {game.step} of {k}: {controller.reason}")
+        break
 #Get our grid
 grid = game.grid
 
@@ -31,11 +43,14 @@ grid = game.grid
 entropy = game.get_entropy()
 print(f"Our game's current boundary complexity is {entropy}")
 
-numpy_grid = cp.asnumpy(game.grid)
+numpy_grid = asnumpy(game.grid)
 # Use Seaborn to create a heatmap
 plt.figure(figsize=(width/20, height/20)) # Adjust figure size based on grid dimensions
 sns.heatmap(numpy_grid, cmap="viridis", cbar=False, square=True)
-plt.title(f"State after {epochs} iterations (Seaborn)")
+plt.title(f"State after {game.step} iterations (Seaborn)")
 plt.axis('off') # Hide axes
 plt.show()
 
+if server is not None:
+    server.close()
+
@@ -0,0 +1,204 @@
+import itertools
+import numpy as np
+from kernels import MAX_STATES
+from rng import to_threshold, power_thresholds
+
+'''
+Dominance rules for cyclic games with any number of species, compiled into lookup tables.
+
+A RuleSet is an N x N dominance matrix: dominance[a][b] is the relative rate (0..1) at which species a+1 empties
+a neighboring cell of species b+1, so the chance per predator neighbor is p_competition * rate. Every species' predators
+are ranked, and a cell's neighborhood is summarized by one integer code: its own state times 9**P, plus the number of
+neighbors of its r-th predator times 9**r (P = the most predators any species has; a count is 0..8). For each code, compile()
+tables the domination threshold of the whole neighborhood, so update() finds every cell's probability with one
+gather per predator rank and one table lookup, however many species there are.
+
+Two modes, matching our two original engines:
+  'neighbor-sensitive' - every predator neighbor rolls independently: p = 1 - prod_r (1 - p_competition rate_r)**k_r,
+                         settlement p = 1 - (1 - p_settle)**k over the k non-empty neighbors, and a separate mobility roll
+  'agnostic'           - once `threshold` neighbors are present the count no longer matters: one roll per cell
+                         picks settle (p_settle), domination (p_competition times the highest rate among the predators
+                         present) or mobility (p_mobility) from consecutive intervals
+
+RuleSet.rps() is our rock/paper/scissors game in either mode. cyclic(n), rpsls() and tournament(n) give larger games.
+'''
+
+MAX_TABLE_ENTRIES = 1 << 20 # Per lattice: states * 9**P codes
+
+
+class RuleTables():
+    '''
+    A RuleSet's thresholds for one set of probabilities (one row per lattice, like the probabilities).
+    settle[..., k] is the settle threshold of an empty cell with k non-empty neighbors, dominate[..., code] the
+    domination upper threshold of a neighborhood code, dominate_low the lower one, and a mobile cell moves when
+    mobility_low <= roll < mobility_high. single_roll: every decision uses the low-word roll (agnostic mode)
+    '''
+
+    def __init__(self, settle, dominate, dominate_low, mobility_low, mobility_high, single_roll, lead_shape):
+        self.settle = settle
+        self.dominate = dominate
+        self.dominate_low = dominate_low
+        self.mobility_low = mobility_low
+        self.mobility_high = mobility_high
+        self.single_roll = single_roll
+        self.lead_shape = tuple(lead_shape) # Shape of the lattice stack the tables have rows for
+
+    def select(self, lattice):
+        ''' The tables of the given lattices (flat indices into the stack), e.g. one row per window of a sparse step '''
+        if not self.lead_shape:
+            return self # A single lattice: every window shares its tables
+        n_lattices = int(np.prod(self.lead_shape, dtype=np.int64))
+
+        def rows(table):
+            if table is None or table.ndim == 0:
+                return table
+            return table.reshape((n_lattices,) + table.shape[len(self.lead_shape):])[lattice]
+        return RuleTables(rows(self.settle), rows(self.dominate), rows(self.dominate_low), rows(self.mobility_low),
+                          rows(self.mobility_high), self.single_roll, lattice.shape)
+
+
+class RuleSet():
+    '''
+    Species interactions of a game. dominance is an (n_species, n_species) matrix of rates in [0, 1] with a zero
+    diagonal, dominance[a][b] > 0 meaning species a + 1 dominates species b + 1. mode is 'neighbor-sensitive' or
+    'agnostic'; threshold is the least number of neighbors (non-empty ones to settle, predators to dominate) the
+    agnostic rules act on. names optionally labels the species
+    '''
+    MODES = ('neighbor-sensitive', 'agnostic')
+
+    def __init__(self, dominance, mode='neighbor-sensitive', threshold=2, names=None):
+        dominance = np.asarray(dominance, dtype=np.float64)
+        n_species = dominance.shape[0]
+        if dominance.shape != (n_species, n_species) or n_species < 1:
+            raise ValueError(f"The dominance matrix must be square, got shape {dominance.shape}")
+        if n_species + 1 > MAX_STATES:
+            raise ValueError(f"At most {MAX_STATES - 1} species are supported, got {n_species}")
+        if np.any(dominance < 0) or np.any(dominance > 1) or np.any(np.diag(dominance) != 0):
+            raise ValueError("Dominance rates must lie in [0, 1], with no species dominating itself")
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown rule mode '{mode}', expected one of {self.MODES}")
+        self.mode = mode
+        self.threshold = threshold
+        self.n_species = n_species
+        self.n_states = n_species + 1 # State 0 is the empty cell
+        self.names = list(names) if names is not None else [f"species {s}" for s in range(1, self.n_states)]
+
+        # dominance over states: rates[a, b] for states a, b (the empty state neither dominates nor is dominated)
+        self.dominance = np.zeros((self.n_states, self.n_states))
+        self.dominance[1:, 1:] = dominance
+        # How strongly two neighbors interact, either way round (the competition entries of the entropy's q table)
+        self.interaction = np.maximum(self.dominance, self.dominance.T).astype(np.float32)
+
+        # Predators of every state, ranked; shorter lists are padded with state 0 at rate 0, which never acts
+        predators = [np.flatnonzero(self.dominance[:, prey]) for prey in range(self.n_states)]
+        self.n_ranks = max(1, max(len(p) for p in predators))
+        self.n_codes = 9 ** self.n_ranks # Neighbor-count combinations of one state's predators
+        if self.n_states * self.n_codes > MAX_TABLE_ENTRIES:
+            raise ValueError(f"Species with {self.n_ranks} predators need a {self.n_states * self.n_codes}-entry "
+                             f"table, more than {MAX_TABLE_ENTRIES}")
+        self.predators = np.zeros((self.n_states, self.n_ranks), dtype=np.uint8)
+        self.predator_rates = np.zeros((self.n_states, self.n_ranks))
+        for prey, ranked in enumerate(predators):
+            self.predators[prey, :len(ranked)] = ranked
+            self.predator_rates[prey, :len(ranked)] = self.dominance[ranked, prey]
+        # digits[c, r]: how many neighbors of the r-th predator code c stands for
+        self.digits = np.array(list(itertools.product(range(9), repeat=self.n_ranks)))[:, ::-1]
+        self._device_predators = {} # xp module name -> predators on that backend
+
+    @classmethod
+    def cyclic(cls, n_species, mode='neighbor-sensitive', **kwargs):
+        ''' Species s + 1 dominates species s, and species 1 dominates species n_species (rock/paper/scissors for 3) '''
+        dominance = np.zeros((n_species, n_species))
+        for s in range(n_species):
+            dominance[(s + 1) % n_species, s] = 1
+        return cls(dominance, mode, **kwargs)
+
+    @classmethod
+    def rps(cls, mode='neighbor-sensitive', **kwargs):
+        ''' Our game: rock (1) is dominated by paper (2), paper by scissors (3), scissors by rock '''
+        return cls.cyclic(3, mode, names=['rock', 'paper', 'scissors'], **kwargs)
+
+    @classmethod
+    def tournament(cls, n_species, mode='neighbor-sensitive', **kwargs):
+        ''' Balanced intransitive game for odd n_species: every species dominates the (n_species - 1) / 2 after it '''
+        if n_species % 2 == 0:
+            raise ValueError(f"A balanced tournament needs an odd number of species, got {n_species}")
+        dominance = np.zeros((n_species, n_species))
+        for s in range(n_species):
+            for offset in range(1, (n_species - 1) // 2 + 1):
+                dominance[s, (s + offset) % n_species] = 1
+        return cls(dominance, mode, **kwargs)
+
+    @classmethod
+    def rpsls(cls, mode='neighbor-sensitive', **kwargs):
+        ''' Rock, paper, scissors, lizard, Spock (states 1..5) '''
+        names = ['rock', 'paper', 'scissors', 'lizard', 'spock']
+        beats = {'rock': ['scissors', 'lizard'], 'paper': ['rock', 'spock'], 'scissors': ['paper', 'lizard'],
+                 'lizard': ['paper', 'spock'], 'spock': ['rock', 'scissors']}
+        dominance = np.zeros((5, 5))
+        for winner, losers in beats.items():
+            for loser in losers:
+                dominance[names.index(winner), names.index(loser)] = 1
+        return cls(dominance, mode, names=names, **kwargs)
+
+    @property
+    def agnostic(self):
+        return self.mode == 'agnostic'
+
+    def codes(self, grid, planes, xp):
+        '''
+        Neighborhood code of every cell of a (..., H, W) grid, from its (n_states, ..., H, W) neighbor_counts() planes:
+        state * 9**P + sum_r 9**r * (neighbors of the state's r-th predator), as int32
+        '''
+        key = xp.__name__
+        if key not in self._device_predators:
+            self._device_predators[key] = xp.asarray(self.predators)
+        predators = self._device_predators[key]
+        codes = grid.astype(xp.int32) * self.n_codes
+        for rank in range(self.n_ranks):
+            predator_planes = predators[:, rank][grid][None] # Which plane each cell reads for this rank
+            codes += xp.take_along_axis(planes, predator_planes, axis=0)[0].astype(xp.int32) * 9 ** rank
+        return codes
+
+    def compile(self, p_settle, p_competition, p_mobility, xp):
+        '''
+        RuleTables for the given probabilities, which may be scalars or arrays (one per lattice) and are
+        taken as float32, as the engines store them. The engines build these once per set of probabilities
+        '''
+        p_settle, p_competition, p_mobility = [xp.asarray(p, dtype=xp.float32) for p in (p_settle, p_competition, p_mobility)]
+        rates = xp.asarray(self.predator_rates, dtype=xp.float32) # (states, ranks)
+        digits = xp.asarray(self.digits)
+        lead_shape = p_settle.shape
+
+        if not self.agnostic:
+            settle = power_thresholds(1 - p_settle, 8, xp)
+            # Chance no predator neighbor takes the cell, per rank and neighbor count: (..., states, ranks, 9)
+            # (power_thresholds() tables 1 - keep**k, but a cell with several predators needs the powers themselves,
+            # built the same way: float32 keep, powers by repeated float64 multiplication)
+            keep = xp.asarray(1 - p_competition[..., None, None] * rates, dtype=xp.float64)
+            powers = [xp.ones_like(keep)]
+            for _ in range(8):
+                powers.append(powers[-1] * keep)
+            powers = xp.stack(powers, axis=-1)
+            survive = powers[..., 0, digits[:, 0]] # (..., states, codes)
+            for rank in range(1, self.n_ranks):
+                survive = survive * powers[..., rank, digits[:, rank]]
+            dominate = to_threshold(1 - survive, xp).reshape(lead_shape + (-1,))
+            mobility_high = power_thresholds(1 - p_mobility, 8, xp)[..., 8, None, None]
+            return RuleTables(settle, dominate, None, xp.uint32(0), mobility_high, False, lead_shape)
+
+        # Agnostic: consecutive intervals of one roll, [0, settle) [settle, settle + competition) [.., .. + mobility)
+        p_settle, p_competition, p_mobility = [xp.asarray(p, dtype=xp.float64)[..., None] for p in (p_settle, p_competition, p_mobility)]
+        settle_threshold = to_threshold(p_settle, xp)
+        settle = xp.where(xp.arange(9) >= self.threshold, settle_threshold, xp.uint32(0))
+        # Rate of the strongest predator present, and the number of predator neighbors, for every code
+        rates = xp.asarray(self.predator_rates) # (states, ranks) float64
+        present = digits.T[None] > 0 # (1, ranks, codes)
+        strongest = xp.max(xp.where(present, rates[:, :, None], 0), axis=1) # (states, codes)
+        predator_neighbors = xp.sum(xp.where(rates[:, :, None] > 0, digits.T[None], 0), axis=1)
+        dominate = xp.where(predator_neighbors >= self.threshold,
+                            to_threshold(p_settle[..., None] + p_competition[..., None] * strongest, xp), xp.uint32(0))
+        dominate = dominate.reshape(lead_shape + (-1,))
+        mobility_low = to_threshold(p_settle + p_competition, xp)[..., None]
+        mobility_high = to_threshold(p_settle + p_competition + p_mobility, xp)[..., None]
+        return RuleTables(settle, dominate, settle_threshold[..., None], mobility_low, mobility_high, True, lead_shape)
@@ -0,0 +1,162 @@
+import numpy as np
+from backend import asnumpy
+
+'''
+Early termination of runs that have nothing left to show: RunController steps a game up to max_steps, but every
+check_every steps it looks at a few statistics kept on the device and stops the run as soon as every lattice
+(every replica of an ensemble) has met one of these, in order of precedence:
+  'absorbed'    one state fills the whole lattice, so no transition is possible any more. This one is exact: the
+                lattice can't change and randomness is counter-based, so the run is fast-forwarded to max_steps
+                (step set, history padded with the frozen counts) without computing the steps in between
+  'extinction'  fewer than min_species species are left (default: all of them, i.e. the first extinction)
+  'stationary'  over the last `window` checks, the mean density of every state (and, with entropy=True, the mean
+                boundary complexity, relative to its size) moved by at most stationary_tolerance between the first
+                and the second half of the window
+Runs that meet none of them stop at max_steps. Each check costs one bincount (plus get_entropy() with entropy=True,
+which is cheap with track_entropy=True); the window lives on the device and only a flag per lattice reaches the host.
+
+The reason and step every lattice stopped at are kept in reasons / stop_steps, reason is the run's overall reason
+('mixed' if the lattices stopped for different ones) and summary() has it all, with the window's means and variances.
+A lattice of an ensemble that is done keeps evolving with the others, so its state counts and entropy at the step it
+stopped are snapshotted in stop_counts ((..., n_states), empties in column 0) and stop_entropy.
+
+Example:
+  controller = RunController(game, max_steps=10000, check_every=50, stationary_tolerance=0.002)
+  controller.run(counting=True)
+  print(controller.reason, game.step)
+check() can also be called from a loop of one's own (e.g. one that also saves checkpoints); it returns whether to stop.
+'''
+
+STOP_REASONS = ('absorbed', 'extinction', 'stationary', 'max_steps')
+
+
+class RunController():
+    '''
+    Stops (or, for absorbed lattices, fast-forwards) `game` once its statistics meet the configured criteria:
+    extinction (True: stop once fewer than min_species species survive), stationary_tolerance (None: off) over a
+    window of checks, entropy (include the boundary complexity in the stationarity test) and fast_forward (jump an
+    absorbed run to max_steps; otherwise it stays at the step it was found absorbed)
+    '''
+
+    def __init__(self, game, max_steps, check_every=50, extinction=True, min_species=None, stationary_tolerance=None,
+                 window=20, entropy=False, fast_forward=True):
+        if window < 2:
+            raise ValueError("window needs at least 2 checks to compare")
+        self.game = game
+        self.max_steps = max_steps
+        self.check_every = check_every
+        self.extinction = extinction
+        self.min_species = len(game.species) if min_species is None else min_species
+        self.stationary_tolerance = stationary_tolerance
+        self.window = window
+        self.entropy = entropy
+        self.fast_forward = fast_forward
+
+        lead_shape = game.shape[:-2]
+        self.reasons = np.full(lead_shape, '', dtype=object) # Why each lattice is done ('' while it isn't)
+        self.stop_steps = np.full(lead_shape, -1, dtype=np.int64)
+        self.stop_counts = np.zeros(lead_shape + (game.n_states,), dtype=np.int64) # State counts at each stop step
+        self.stop_entropy = np.full(lead_shape, np.nan) # get_entropy() at each stop step
+        self.reason = None
+        self._samples = None # (window, ..., series) densities (and entropy) of the last checks, on the device
+        self._filled = 0
+        self._counting = False # Whether run() records counts, so a fast-forward pads the history
+
+    @property
+    def done(self):
+        return bool(np.all(self.reasons != ''))
+
+    def _sample(self, counts):
+        xp = self.game.xp
+        densities = counts / float(self.game.shape[-2] * self.game.shape[-1])
+        series = [densities]
+        if self.entropy:
+            series.append(xp.asarray(self.game.get_entropy(), dtype=xp.float64)[..., None])
+        sample = xp.concatenate(series, axis=-1)
+        if self._samples is None:
+            self._samples = xp.zeros((self.window,) + sample.shape, dtype=xp.float64)
+        self._samples = xp.concatenate([self._samples[1:], sample[None]]) # Oldest check first
+        self._filled = min(self._filled + 1, self.window)
+
+    def _stationary(self):
+        xp = self.game.xp
+        half = self.window // 2
+        first, second = self._samples[:half].mean(axis=0), self._samples[-half:].mean(axis=0)
+        drift = xp.abs(second - first)
+        if self.entropy:
+            # The complexity has no natural unit: compare its drift to its size instead
+            scale = xp.maximum(xp.abs(self._samples[..., -1].mean(axis=0)), 1e-12)
+            drift = xp.concatenate([drift[..., :-1], (drift[..., -1] / scale)[..., None]], axis=-1)
+        return xp.all(drift <= self.stationary_tolerance, axis=-1)
+
+    def check(self):
+        '''
+        Evaluates the criteria at the game's current step and marks the lattices that meet one.
+        Returns whether the run should stop (every lattice done, or max_steps reached)
+        '''
+        game = self.game
+        xp = game.xp
+        counts = game._state_counts()
+        n_cells = game.shape[-2] * game.shape[-1]
+        conditions = [('absorbed', xp.max(counts, axis=-1) == n_cells)]
+        if self.extinction:
+            survivors = xp.sum(counts[..., 1:] > 0, axis=-1)
+            conditions.append(('extinction', survivors < self.min_species))
+        if self.stationary_tolerance is not None:
+            self._sample(counts)
+            if self._filled == self.window:
+                conditions.append(('stationary', self._stationary()))
+
+        # Only these few flags leave the device
+        flags = asnumpy(xp.stack([condition for _, condition in conditions]))
+        running = self.reasons == ''
+        for (reason, _), met in zip(conditions, flags):
+            self.reasons[met & (self.reasons == '')] = reason
+        if game.step >= self.max_steps:
+            self.reasons[self.reasons == ''] = 'max_steps'
+        stopped = running & (self.reasons != '')
+        if stopped.any():
+            self._snapshot(stopped, counts)
+        if self.done:
+            self._finish()
+            return True
+        return False
+
+    def _snapshot(self, stopped, counts):
+        # The step, counts and entropy of the lattices that just stopped, before they evolve any further
+        self.stop_steps[stopped] = self.game.step
+        self.stop_counts[stopped] = asnumpy(counts)[stopped]
+        self.stop_entropy[stopped] = np.asarray(asnumpy(self.game.get_entropy()), dtype=np.float64)[stopped]
+
+    def _finish(self):
+        game = self.game
+        reasons = set(self.reasons.reshape(-1).tolist())
+        self.reason = reasons.pop() if len(reasons) == 1 else 'mixed'
+        if self.reason == 'absorbed' and self.fast_forward and game.step < self.max_steps:
+            # Frozen lattices: every skipped step would record the same counts
+            skipped = self.max_steps - game.step
+            if self._counting:
+                game.sync_history()
+                counts = asnumpy(game._state_counts())
+                game._host_history.append(np.broadcast_to(counts, (skipped,) + counts.shape).copy())
+            game.step = self.max_steps
+
+    def run(self, counting=False):
+        ''' Steps the game (update(counting) calls) until a check says stop; returns the overall reason '''
+        game = self.game
+        self._counting = counting
+        while not self.check():
+            for _ in range(min(self.check_every, self.max_steps - game.step)):
+                game.update(counting)
+        return self.reason
+
+    def summary(self):
+        ''' The stop reasons and steps, as JSON-serializable values, plus the last window's means and variances '''
+        summary = {'reason': self.reason, 'step': int(self.game.step), 'max_steps': self.max_steps,
+                   'reasons': self.reasons.tolist(), 'stop_steps': self.stop_steps.tolist(),
+                   'stop_counts': self.stop_counts.tolist(), 'stop_entropy': self.stop_entropy.tolist()}
+        if self._filled:
+            samples = asnumpy(self._samples[-self._filled:])
+            summary['window_mean'] = samples.mean(axis=0).tolist()
+            summary['window_variance'] = samples.var(axis=0).tolist()
+        return summary
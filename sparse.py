@@ -0,0 +1,123 @@
+'''
+Sparse active-region stepping for our RPS engines.
+
+A cell whose whole 3x3 neighborhood is in one state can't change on its own: an empty cell with no occupied neighbor
+can't be settled, a cell with no predator around can't be dominated, and a swap with an identical neighbor changes
+nothing. Late in a run most of the lattice is like that (empty space or single-species domains), so we split it into
+square tiles and only step the tiles that can change:
+
+  - active_tiles() flags the tiles holding a non-uniform neighborhood (from per-tile and tile-edge min/max),
+  - every tile within one tile of an active one is written (mobility carries changes up to 8 cells per step),
+  - each written tile is stepped inside a window with a WINDOW_MARGIN-cell margin, cut from the lattice as flat indices.
+
+A cell's new state only depends on the old lattice within 9 cells (the 8 swap substeps plus the 3x3 stencil), so the
+center tile of every window comes out exactly as in a dense step - and with the counter-based RNG keyed by global cell
+indices, the sparse and dense paths give bit-identical lattices.
+
+The same windows give temporal blocking: with a margin of 9 cells per step, a window can be advanced k steps on its own
+and its center is still exact, so advance(block_steps=k) gathers the lattice once per k steps and keeps each batch of
+windows in cache (or device memory) for all k of them.
+'''
+
+MIN_TILE = 8 # Mobility can carry a change 8 cells, so halo tiles must be at least this wide
+BLOCK_TILES = (256, 128, 64, 32, 16) # Tile sizes advance() tries, largest first
+WINDOW_BATCH_CELLS = 1 << 18 # Window cells stepped together per batch: small enough to stay in cache across a block's steps
+
+
+def window_margin(n_steps):
+    ''' Margin covering n_steps steps of dependence (9 cells each), rounded up to even to keep the sublattice parity '''
+    margin = 9 * n_steps
+    return margin + margin % 2
+
+
+WINDOW_MARGIN = window_margin(1)
+
+
+def check_tile_size(tile, shape):
+    ''' Raises ValueError unless tile is an even size >= MIN_TILE that divides both lattice dimensions '''
+    height, width = shape[-2:]
+    if tile < MIN_TILE or tile % 2 or height % tile or width % tile:
+        raise ValueError(f"Sparse tiles must be even, at least {MIN_TILE} and divide the lattice dimensions; "
+                         f"got tile {tile} for a {height} x {width} lattice")
+
+
+def _tile_neighborhood_any(mask, xp):
+    ''' mask OR'ed with its 8 toroidal neighbors, over the last two (tile) axes '''
+    dilated = mask.copy()
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                dilated |= xp.roll(mask, (dy, dx), axis=(-2, -1))
+    return dilated
+
+
+def active_tiles(grid, tile, xp):
+    '''
+    Boolean (..., H / tile, W / tile) map of the tiles holding at least one cell with a non-uniform 3x3 neighborhood.
+    A tile with two states in it always has two differing neighbors inside; a single-state tile is active when any
+    cell of the one-cell ring around it (edge rows/columns and corners of the neighboring tiles) holds another state.
+    Costs two reductions over the grid plus a few over the tile edges
+    '''
+    height, width = grid.shape[-2:]
+    blocks = grid.reshape(grid.shape[:-2] + (height // tile, tile, width // tile, tile))
+    tile_min = blocks.min(axis=(-3, -1))
+    active = tile_min != blocks.max(axis=(-3, -1))
+
+    def differs(cells, reduce_axis, shift):
+        # Do the cells of a neighboring tile's edge (rolled onto this tile by shift) hold anything but this tile's value?
+        if reduce_axis is not None:
+            edge_min, edge_max = cells.min(axis=reduce_axis), cells.max(axis=reduce_axis)
+        else:
+            edge_min = edge_max = cells
+        return ((xp.roll(edge_min, shift, axis=(-2, -1)) != tile_min) |
+                (xp.roll(edge_max, shift, axis=(-2, -1)) != tile_min))
+
+    active |= differs(blocks[..., :, -1, :, :], -1, (1, 0)) # bottom row of the tile above
+    active |= differs(blocks[..., :, 0, :, :], -1, (-1, 0)) # top row of the tile below
+    active |= differs(blocks[..., :, :, :, -1], -2, (0, 1)) # right column of the tile to the left
+    active |= differs(blocks[..., :, :, :, 0], -2, (0, -1)) # left column of the tile to the right
+    active |= differs(blocks[..., :, -1, :, -1], None, (1, 1)) # corner cells of the diagonal tiles
+    active |= differs(blocks[..., :, -1, :, 0], None, (1, -1))
+    active |= differs(blocks[..., :, 0, :, -1], None, (-1, 1))
+    active |= differs(blocks[..., :, 0, :, 0], None, (-1, -1))
+    return active
+
+
+def written_tiles(grid, tile, xp, n_steps=1):
+    '''
+    Tiles whose cells can change within n_steps steps: the active tiles and every tile close enough to one.
+    A change travels at most 8 cells per step and widens the non-uniform region by one more, so n_steps steps
+    reach 9 n_steps - 1 cells (one tile for a single step)
+    '''
+    written = active_tiles(grid, tile, xp)
+    for _ in range(-(-(9 * n_steps - 1) // tile)):
+        written = _tile_neighborhood_any(written, xp)
+    return written
+
+
+def tile_windows(tiles, shape, tile, xp, margin=WINDOW_MARGIN):
+    '''
+    Flat indices into a (..., H, W) stack for a window of `margin` cells around each flagged tile.
+
+    tiles is a boolean (..., H / tile, W / tile) map. Returns (window_index, lattice): window_index is an
+    (n, tile + 2 margin, tile + 2 margin) int64 array, wrapping around the torus, and lattice the (n,) index of
+    the stacked lattice each window comes from. The tile itself is window_index[:, margin:-margin, margin:-margin]
+    '''
+    height, width = shape[-2:]
+    n_tiles_x = width // tile
+    n_tiles_per_lattice = (height // tile) * n_tiles_x
+    flagged = xp.flatnonzero(tiles)
+    lattice = flagged // n_tiles_per_lattice
+    tile_y = (flagged % n_tiles_per_lattice) // n_tiles_x
+    tile_x = flagged % n_tiles_x
+
+    offsets = xp.arange(-margin, tile + margin, dtype=xp.int64)
+    rows = (tile_y[:, None] * tile + offsets[None, :]) % height
+    cols = (tile_x[:, None] * tile + offsets[None, :]) % width
+    window_index = (lattice[:, None, None] * (height * width) + rows[:, :, None] * width + cols[:, None, :])
+    return window_index, lattice
+
+
+def window_cells(n_windows, tile, margin=WINDOW_MARGIN):
+    ''' Cells processed for n_windows windows, to compare against a dense step '''
+    return n_windows * (tile + 2 * margin) ** 2
@@ -0,0 +1,29 @@
+import numpy as np
+from RockPaperScissors import RockPaperScissors
+from profiling import Profiler
+from sparse import written_tiles, window_cells
+
+
+def make_game(**kwargs):
+    game = RockPaperScissors(dims=[256, 256], density=0.5, backend='numpy', seed=7, profiler=Profiler(np), **kwargs)
+    # A small populated patch in empty space, so a sparse step only covers a few windows
+    patch = RockPaperScissors(dims=[24, 24], density=0.5, backend='numpy', seed=7)
+    patch.seeding()
+    grid = np.zeros(game.shape, dtype=np.uint8)
+    grid[116:140, 116:140] = patch.grid
+    game.grid = grid
+    return game
+
+
+def test_sparse_and_dense_event_counts_match():
+    dense, sparse = make_game(), make_game(sparse_tile=16)
+    tiles = written_tiles(sparse.grid, 16, np)
+    assert window_cells(int(tiles.sum()), 16) < sparse.grid.size # The sparse game really steps windows
+
+    for _ in range(10):
+        dense.update()
+        sparse.update()
+    assert (dense.grid == sparse.grid).all()
+    counts = dense.profiler.totals()['counts']
+    assert counts == sparse.profiler.totals()['counts']
+    assert counts['settle'] > 0 and counts['dominate'] > 0 and counts['move_attempt'] > 0
@@ -0,0 +1,43 @@
+import numpy as np
+
+'''
+Colors for our lattice states, shared by the pygame viewer and the animation export.
+colorize() turns a whole grid into an RGB image with one palette lookup instead of drawing cell by cell.
+'''
+
+# Define colors for the states (0: empty, 1: rock, 2: paper, 3: scissors)
+BLACK = (36, 36, 36)       # Empty
+RED = (232, 87, 58)       # Rock
+GREEN = (42, 163, 75)    # Paper
+BLUE = (119, 86, 219)      # Scissors
+
+COLORS_MAP = {
+    0: BLACK,
+    1: RED,
+    2: GREEN,
+    3: BLUE,
+    # Further species of larger rule sets (rules.py), e.g. lizard and Spock
+    4: (240, 190, 50),
+    5: (60, 180, 210),
+    6: (220, 90, 170),
+    7: (150, 150, 150),
+    8: (140, 200, 80),
+    9: (245, 130, 60)
+}
+
+# 256-entry lookup table indexed by the uint8 state; unknown states fall back to black
+PALETTE = np.array([BLACK] * 256, dtype=np.uint8)
+for state, color in COLORS_MAP.items():
+    PALETTE[state] = color
+
+
+def colorize(grid, scale=1, palette=PALETTE):
+    '''
+    (A, B) uint8 grid of states -> (A * scale, B * scale, 3) uint8 RGB image, using a single palette lookup.
+    scale is an integer upscaling factor (each cell becomes a scale x scale block).
+    A (T, A, B) stack of frames gives a (T, A * scale, B * scale, 3) stack of images
+    '''
+    rgb = palette[np.asarray(grid, dtype=np.uint8)]
+    if scale > 1:
+        rgb = rgb.repeat(scale, axis=-3).repeat(scale, axis=-2)
+    return rgb
@@ -0,0 +1,175 @@
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from utils.colors import PALETTE, colorize
+from utils.trajectory import TrajectoryReader
+
+'''
+Streaming MP4/GIF export of a trajectory file (replaces the notebook's imshow + temporary PNG + imageio route).
+
+Frames are read lazily from the HDF5 trajectory in batches (one hyperslab read each), colorized with the same palette
+lookup as the pygame viewer (utils/colors.py) by a pool of worker processes, and piped as raw RGB straight into
+ffmpeg in frame order. Only a few batches are in flight at a time, so memory stays bounded however long the run,
+and nothing but the video itself touches the disk.
+
+The encoder is ffmpeg: the one on the PATH, or else the binary bundled with the imageio-ffmpeg package if installed.
+The output format follows the extension: .gif is encoded with our exact state palette (no dithering, no palette pass
+over the frames), anything else (.mp4, .mkv, .webm, ...) with `codec` (libx264 by default) in yuv420p.
+
+Run from the repo root, e.g.:
+  python -m utils.export_video simulation_grids.h5 run.mp4 --fps 30 --scale 2 --workers 4
+  python -m utils.export_video simulation_grids.h5 run.gif --every 4 --stop 2000
+'''
+
+# imageio-ffmpeg is optional: it ships an ffmpeg binary for machines without one
+try:
+    import imageio_ffmpeg
+    IMAGEIO_FFMPEG_AVAILABLE = True
+except Exception:
+    IMAGEIO_FFMPEG_AVAILABLE = False
+
+
+def find_ffmpeg():
+    ''' Path of an ffmpeg executable: the PATH first, then imageio-ffmpeg's bundled binary '''
+    path = shutil.which('ffmpeg')
+    if path is None and IMAGEIO_FFMPEG_AVAILABLE:
+        path = imageio_ffmpeg.get_ffmpeg_exe()
+    if path is None:
+        raise RuntimeError("Video export needs ffmpeg: install it on the PATH or pip install imageio-ffmpeg")
+    return path
+
+
+class FFmpegEncoder():
+    '''
+    Pipes (n, H, W, 3) uint8 RGB frame batches into an ffmpeg process writing `path`. size is the (H, W) of a frame.
+    GIFs are mapped onto `palette` (256 RGB entries, our state colors by default), so state colors stay exact.
+    Use as a context manager, or call close() to finish the file
+    '''
+
+    def __init__(self, path, size, fps=30, codec=None, crf=None, palette=PALETTE, ffmpeg=None):
+        height, width = size
+        self.path = path
+        self._palette_dir = None
+        command = [ffmpeg or find_ffmpeg(), '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0']
+        if path.lower().endswith('.gif'):
+            # paletteuse wants the palette as a 16 x 16 image: our 256-entry lookup table is exactly that
+            self._palette_dir = tempfile.TemporaryDirectory()
+            palette_path = os.path.join(self._palette_dir.name, 'palette.ppm')
+            with open(palette_path, 'wb') as f:
+                f.write(b'P6 16 16 255\n' + np.ascontiguousarray(palette, dtype=np.uint8).tobytes())
+            command += ['-i', palette_path, '-lavfi', '[0:v][1:v]paletteuse=dither=none', '-loop', '0']
+        else:
+            command += ['-c:v', codec or 'libx264', '-pix_fmt', 'yuv420p']
+            if crf is not None:
+                command += ['-crf', str(crf)]
+        command.append(path)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.frames = 0
+
+    def write(self, frames):
+        ''' Appends a batch of (n, H, W, 3) (or one (H, W, 3)) RGB frames '''
+        frames = np.ascontiguousarray(frames, dtype=np.uint8)
+        self.process.stdin.write(frames.data)
+        self.frames += 1 if frames.ndim == 3 else frames.shape[0]
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.process = None
+        if self._palette_dir is not None:
+            self._palette_dir.cleanup()
+        if returncode:
+            raise RuntimeError(f"ffmpeg exited with status {returncode} while writing '{self.path}'")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def frame_batches(start, stop, every, batch):
+    ''' (start, stop) frame ranges of `batch` exported frames each, covering range(start, stop, every) '''
+    span = batch * every
+    return [(t, min(t + span, stop)) for t in range(start, stop, span)]
+
+
+# Each worker process opens the trajectory once and keeps it for all the batches it renders
+_worker_reader = None
+
+
+def _init_worker(path):
+    global _worker_reader
+    _worker_reader = TrajectoryReader(path)
+
+
+def _render_range(frame_range, every, scale):
+    start, stop = frame_range
+    return colorize(_worker_reader[start:stop:every], scale) # A strided hyperslab: skipped frames aren't read
+
+
+def export_video(trajectory_path, output_path, fps=30, scale=1, start=0, stop=None, every=1, workers=None,
+                 batch=16, codec=None, crf=None, progress=False):
+    '''
+    Writes frames start, start + every, ... (up to stop) of a trajectory file to a video or GIF.
+    Batches of `batch` frames are read and colorized by `workers` processes (None: one per core, 0: in this process),
+    with at most 2 batches per worker in flight. Returns the number of frames written
+    '''
+    with TrajectoryReader(trajectory_path) as reader:
+        n_frames = len(reader)
+        height, width = reader.shape
+    stop = n_frames if stop is None else min(stop, n_frames)
+    ranges = frame_batches(start, stop, every, batch)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    begin = time.perf_counter()
+    with FFmpegEncoder(output_path, (height * scale, width * scale), fps, codec, crf) as encoder:
+        if workers == 0:
+            with TrajectoryReader(trajectory_path) as reader:
+                for frame_start, frame_stop in ranges:
+                    encoder.write(colorize(reader[frame_start:frame_stop:every], scale))
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(trajectory_path,)) as pool:
+                # Batches are submitted ahead of the encoder but written strictly in order
+                pending = deque()
+                next_range = 0
+                while pending or next_range < len(ranges):
+                    while next_range < len(ranges) and len(pending) < 2 * workers:
+                        pending.append(pool.submit(_render_range, ranges[next_range], every, scale))
+                        next_range += 1
+                    encoder.write(pending.popleft().result())
+                    if progress:
+                        print(f"\r{encoder.frames} frames", end='', flush=True)
+        written = encoder.frames
+    if progress:
+        print(f"\r{written} frames written to {output_path} in {time.perf_counter() - begin:.1f} s")
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a trajectory file to MP4 (or any ffmpeg format) or GIF')
+    parser.add_argument('trajectory', help='HDF5 trajectory file (utils/trajectory.py)')
+    parser.add_argument('output', help='output video, e.g. run.mp4 or run.gif')
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--scale', type=int, default=1, help='integer upscaling factor per cell')
+    parser.add_argument('--start', type=int, default=0, help='first frame')
+    parser.add_argument('--stop', type=int, default=None, help='frame to stop before (default: the end)')
+    parser.add_argument('--every', type=int, default=1, help='export every N-th frame')
+    parser.add_argument('--workers', type=int, default=None, help='rendering processes (default: one per core, 0: none)')
+    parser.add_argument('--batch', type=int, default=16, help='frames per worker task')
+    parser.add_argument('--codec', default=None, help='ffmpeg video codec for non-GIF outputs (default libx264)')
+    parser.add_argument('--crf', type=int, default=None, help='constant rate factor (quality) for the codec')
+    args = parser.parse_args()
+
+    export_video(args.trajectory, args.output, fps=args.fps, scale=args.scale, start=args.start, stop=args.stop,
+                 every=args.every, workers=args.workers, batch=args.batch, codec=args.codec, crf=args.crf, progress=True)
@@ -0,0 +1,246 @@
+import argparse
+import time
+import weakref
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from kernels import state_counts, N_STATES
+
+'''
+Live frames of a running simulation over shared memory, for viewers, plotting processes and metrics scrapers.
+
+FrameServer owns a multiprocessing.shared_memory block holding a ring of `slots` frames. Each slot has the grid,
+its step, its state counts (computed from the frame itself) and optionally its entropy. publish() copies the grid
+straight into the next slot (a single device-to-host copy on cupy) and never waits for anyone: readers that
+fall behind just skip frames.
+
+Every slot is guarded by a sequence lock: the server makes the slot's sequence number odd while it writes and even
+(2 frame + 2) once it's done, and only then advances the published frame counter. FrameClient attaches by name,
+looks at the newest frame and checks the slot's sequence number before and after reading, so it never returns a torn
+frame. With copy=False the client hands out views straight into shared memory (zero-copy); such a view stays intact
+through the next slots - 1 publishes, which Frame.is_current() checks. FrameClient.close() turns the grids of its
+zero-copy frames still alive into private copies before unmapping the block; other arrays taken from those views
+(slices, np.asarray(...)) must be dropped before closing, they would point at unmapped memory.
+
+Example:
+  server = FrameServer('rps_live', game.shape)       # in the simulation loop: server.publish_game(game)
+  client = FrameClient('rps_live')                    # in any other process:  frame = client.latest()
+Watch live with `python pygame-visualization-script.py --live rps_live`, or print metrics with
+`python -m utils.frame_server rps_live`
+'''
+
+_MAGIC = 0x52505346 # 'RPSF'
+_MAX_DIMS = 4
+# Header (int64): magic, slots, lattices, ndim, dims[4], published frames, states, then per slot: sequence, step,
+# counts[lattices, states]
+_HEADER_FIELDS = 6 + _MAX_DIMS
+
+
+class _Layout():
+    ''' Views of one frame ring laid out in a shared buffer '''
+
+    def __init__(self, buffer, shape, slots, n_states):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.n_states = n_states
+        self.lattices = int(np.prod(self.shape[:-2], dtype=np.int64))
+        slot_fields = 2 + self.lattices * n_states
+
+        offset = 0
+        self.header = np.ndarray(_HEADER_FIELDS, dtype=np.int64, buffer=buffer, offset=offset)
+        offset += self.header.nbytes
+        self.slot_meta = np.ndarray((slots, slot_fields), dtype=np.int64, buffer=buffer, offset=offset)
+        offset += self.slot_meta.nbytes
+        self.entropy = np.ndarray((slots, self.lattices), dtype=np.float64, buffer=buffer, offset=offset)
+        offset += self.entropy.nbytes
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=buffer, offset=offset)
+
+    @staticmethod
+    def nbytes(shape, slots, n_states):
+        lattices = int(np.prod(shape[:-2], dtype=np.int64))
+        return 8 * (_HEADER_FIELDS + slots * (2 + lattices * n_states) + slots * lattices) + slots * int(np.prod(shape, dtype=np.int64))
+
+
+class Frame():
+    '''
+    One published frame: grid (shape of the lattice, uint8), step, counts ((..., n_states) state counts, empties in column 0),
+    entropy ((...) floats, nan if none was published) and seq, the frame's number since the server started
+    '''
+
+    def __init__(self, client, seq, slot, grid, step, counts, entropy):
+        self._client = client
+        self._slot = slot
+        self.seq = seq
+        self.grid = grid
+        self.step = step
+        self.counts = counts
+        self.entropy = entropy
+
+    def is_current(self):
+        ''' Whether the server hasn't started overwriting this frame's slot yet (only matters for copy=False frames) '''
+        if self._client is None:
+            return self._intact # Detached: whether the grid was still whole when it was copied
+        return self._client._layout.slot_meta[self._slot, 0] == 2 * self.seq + 2
+
+    def _detach(self):
+        # The client is unmapping the block: keep a private copy of the grid instead of the view
+        grid = self.grid.copy()
+        self._intact = self.is_current()
+        self.grid = grid
+        self._client = None
+
+
+class FrameServer():
+    '''
+    Publishes frames of a (..., H, W) lattice into a shared-memory ring named `name` (None picks a name, see .name).
+    n_states is the number of lattice states counted per frame (game.n_states; publish_game() needs it to match).
+    Call close() (or use it as a context manager) to free the block; clients already attached keep their mapping.
+    Arrays viewing the block in this process keep it mapped until they are dropped
+    '''
+
+    def __init__(self, name, shape, slots=4, n_states=N_STATES):
+        if len(shape) > _MAX_DIMS:
+            raise ValueError(f"Frames can have at most {_MAX_DIMS} dimensions, got shape {tuple(shape)}")
+        self.memory = shared_memory.SharedMemory(name=name, create=True, size=_Layout.nbytes(shape, slots, n_states))
+        self.name = self.memory.name
+        self._layout = _Layout(self.memory.buf, shape, slots, n_states)
+        header = self._layout.header
+        header[:] = 0
+        header[:4] = _MAGIC, slots, self._layout.lattices, len(shape)
+        header[4:4 + len(shape)] = shape
+        header[5 + _MAX_DIMS] = n_states
+        self._layout.slot_meta[:, 0] = 0
+        self.published = 0
+
+    def publish(self, grid, step, entropy=None):
+        '''
+        Writes grid (numpy or cupy) into the next slot, with its step, its state counts and optionally entropy
+        (a scalar, or one value per stacked lattice). Never blocks on readers
+        '''
+        layout = self._layout
+        seq = self.published
+        slot = seq % layout.slots
+        meta = layout.slot_meta[slot]
+        meta[0] = 2 * seq + 1 # Odd: being written
+        frame = layout.frames[slot]
+        if hasattr(grid, 'get'):
+            grid.get(out=frame) # cupy: one device-to-host copy straight into shared memory
+        else:
+            np.copyto(frame, grid, casting='unsafe')
+        meta[1] = step
+        meta[2:] = state_counts(frame, np, layout.n_states).reshape(-1)
+        layout.entropy[slot] = np.nan if entropy is None else np.asarray(entropy.get() if hasattr(entropy, 'get') else entropy, dtype=np.float64).reshape(-1)
+        meta[0] = 2 * seq + 2 # Even: complete
+        self.published = seq + 1
+        layout.header[4 + _MAX_DIMS] = self.published
+
+    def publish_game(self, game, entropy=False):
+        ''' Publishes a game's current grid and step (and its get_entropy() if entropy, cheap with track_entropy=True) '''
+        self.publish(game.grid, game.step, game.get_entropy() if entropy else None)
+
+    def close(self):
+        self._layout = None # Drop our views into the block before releasing it
+        try:
+            self.memory.close()
+        except BufferError:
+            pass # Something in this process still views the block: the mapping goes away with the last view
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _attach(name):
+    # Attaching must not register the block with this process's resource tracker, or it would be unlinked
+    # (from under the server) when this process exits. Before 3.13 we undo the registration, which makes a tracker
+    # shared with the server's process (a client started by it) print a harmless KeyError when the server unlinks
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python 3.13+
+    except TypeError:
+        memory = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+class FrameClient():
+    '''
+    Attaches to the FrameServer ring `name` from any process. latest() returns the newest complete Frame
+    (None before the first publish); copy=False returns views into shared memory instead of copies,
+    which close() turns into copies of their own
+    '''
+
+    def __init__(self, name):
+        self.memory = _attach(name)
+        header = np.ndarray(_HEADER_FIELDS, dtype=np.int64, buffer=self.memory.buf)
+        if header[0] != _MAGIC:
+            raise ValueError(f"Shared memory block '{name}' is not a frame ring")
+        slots, ndim = int(header[1]), int(header[3])
+        self.shape = tuple(int(d) for d in header[4:4 + ndim])
+        self._layout = _Layout(self.memory.buf, self.shape, slots, int(header[5 + _MAX_DIMS]))
+        self.last_seq = -1 # Newest frame handed out, so callers can tell a new frame from a repeat
+        self._views = weakref.WeakSet() # copy=False frames still alive, to detach before unmapping
+
+    @property
+    def published(self):
+        ''' Frames published so far '''
+        return int(self._layout.header[4 + _MAX_DIMS])
+
+    def latest(self, copy=True):
+        layout = self._layout
+        while True:
+            published = self.published
+            if published == 0:
+                return None
+            seq = published - 1
+            slot = seq % layout.slots
+            meta = layout.slot_meta[slot]
+            if meta[0] != 2 * seq + 2:
+                continue # The server moved on and is rewriting this slot: look again
+            grid = layout.frames[slot].copy() if copy else layout.frames[slot]
+            step, counts, entropy = int(meta[1]), meta[2:].copy(), layout.entropy[slot].copy()
+            if meta[0] == 2 * seq + 2: # Unchanged while we read: the frame is whole
+                self.last_seq = seq
+                lead_shape = self.shape[:-2]
+                frame = Frame(self, seq, slot, grid, step, counts.reshape(lead_shape + (layout.n_states,)), entropy.reshape(lead_shape))
+                if not copy:
+                    self._views.add(frame)
+                return frame
+
+    def frames(self, poll_interval=0.005):
+        ''' Yields every new latest frame as it's published (skipping frames the reader was too slow for) '''
+        while True:
+            if self.published - 1 > self.last_seq:
+                frame = self.latest()
+                if frame is not None:
+                    yield frame
+                    continue
+            time.sleep(poll_interval)
+
+    def close(self):
+        for frame in list(self._views):
+            frame._detach()
+        self._layout = None
+        try:
+            self.memory.close()
+        except BufferError:
+            pass # Views taken from our frames are still alive: the mapping goes away with the last of them
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    # A minimal metrics scraper: prints the step, populations and entropy of every frame it sees
+    parser = argparse.ArgumentParser(description='Print live metrics from a FrameServer ring')
+    parser.add_argument('name', help='shared memory name the simulation publishes to')
+    args = parser.parse_args()
+
+    with FrameClient(args.name) as client:
+        print(f"Attached to '{args.name}': frames of shape {client.shape}")
+        for frame in client.frames():
+            print(f"step {frame.step}: counts {frame.counts.tolist()}, entropy {frame.entropy.tolist()}")
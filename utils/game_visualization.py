@@ -1,7 +1,7 @@
-import cupy as cp
 import matplotlib.pyplot as plt
 import seaborn as sns
-import RockPaperScissors
+from backend import asnumpy
+from RockPaperScissors import RockPaperScissors
 
 
 epochs = 1950 #How many epochs do we want to visualize
@@ -15,7 +15,7 @@ game.seeding()
 for i in range(epochs):
   game.update()
 
-numpy_grid = cp.asnumpy(game.grid)
+numpy_grid = asnumpy(game.grid)
 # Use Seaborn to create a heatmap
 plt.figure(figsize=(width/20, height/20)) # Adjust figure size based on grid dimensions
 sns.heatmap(numpy_grid, cmap="viridis", cbar=False, square=True)
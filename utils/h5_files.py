@@ -1,30 +1,36 @@
-import cupy as cp
-import h5py
-import RockPaperScissors
+from RockPaperScissors import RockPaperScissors
+from utils.trajectory import TrajectoryWriter
+from utils.snapshot_pipeline import AsyncSnapshotWriter
 
 '''
-For storing simulations of our RPS game. We store as an HDF5 file and visualize in pygame
+For storing simulations of our RPS game. We store as an HDF5 trajectory file (one compressed (T, H, W) dataset,
+see utils/trajectory.py) and visualize in pygame.
+Frames are copied off the device and written by a background thread, so saving overlaps the simulation. Run from the repo root: python -m utils.h5_files
 '''
 
 
 epochs = 4000 #number of epochs
-save_interval = 5 #sve every 1000 epochs
+save_interval = 5 #save every 5 epochs
 dims = [512,512] #width, height
+seed = 0 #so the run can be reproduced
 
 # Initialize - can also pass in density and transition probabilities
-game = RockPaperScissors(width=dims)
+game = RockPaperScissors(dims=dims, seed=seed)
 game.seeding()
 
 # Create an HDF5 file to store the grids
 output_filename = 'simulation_grids.h5'
+params = {'dims': dims, 'density': game.density, 'probs': [game.p_settle, game.p_competition, game.p_mobility],
+          'variant': type(game).__name__, 'save_interval': save_interval}
 
-with h5py.File(output_filename, 'w') as f:
+writer = TrajectoryWriter(output_filename, game.grid.shape, params=params, seed=seed)
+with AsyncSnapshotWriter(writer, game.grid.shape, game.xp) as snapshots:
     for i in range(epochs):
         game.update()
         if i % save_interval == 0:
-            # Convert CuPy grid to NumPy array
-            grid_np = cp.asnumpy(game.grid)
-            # Create a dataset in the HDF5 file for the current epoch
-            f.create_dataset(f'epoch_{i:05d}', data=grid_np)
+            # Queue the current grid as the next frame (stored as compressed uint8); returns without waiting for the disk
+            snapshots.submit(game.grid, step=i)
+    snapshots.flush()
+    saved = len(writer)
 
-print(f"Simulation finished. Saved {epochs / save_interval} grid states to '{output_filename}' every {save_interval} epochs.")
\ No newline at end of file
+print(f"Simulation finished. Saved {saved} grid states to '{output_filename}' every {save_interval} epochs.")
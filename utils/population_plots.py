@@ -2,34 +2,42 @@ from contextlib import nullcontext
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import cupy as cp
 import numpy as np # Import numpy
 import gc
-import RockPaperScissors
+import os
+from RockPaperScissors import RockPaperScissors
+from checkpoint import Checkpointer
 
 
 # Create an instance of the game and run a simulation to populate self.history
 game_instance = None
 gc.collect() #Collect garbage RAM
-game_instance = RockPaperScissors()
 epochs = 10000 # You can adjust the number of epochs for the static plot
-game_instance.seeding()
+checkpoint_path = 'population_plots.ckpt.npz' # An interrupted run resumes from here; delete it to start over
+if os.path.exists(checkpoint_path):
+    game_instance = RockPaperScissors.load_checkpoint(checkpoint_path)
+    print(f"Resuming from step {game_instance.step}")
+else:
+    game_instance = RockPaperScissors()
+    game_instance.seeding()
+    # Record the initial counts after seeding (kept on the device with the rest of the history)
+    game_instance.record_counts()
 
-# Append the initial counts after seeding to the history (transfer to CPU and convert to item)
-initial_counts_cpu = [count.get().item() for count in game_instance.counts]
-game_instance.history.append(initial_counts_cpu)
+# Run the simulation with counting enabled to populate self.history, checkpointing every few minutes in the background
+with Checkpointer(game_instance, checkpoint_path, every_seconds=300) as checkpointer:
+    while game_instance.step < epochs:
+        game_instance.update(counting=True)
+        checkpointer.save_if_due()
 
-# Run the simulation with counting enabled to populate self.history
-for epoch in range(epochs):
-    game_instance.update(counting=True)
+# Bring the whole count history to the host in one transfer: a (steps, 3) numpy array
+history = game_instance.history
 
 # Check if history was populated
-if game_instance.history:
-    # The history now contains lists of Python integers, no need for .get().item() again here
-    # Convert the history data to a pandas DataFrame for plotting
+if len(history):
+    # Convert the history array to a pandas DataFrame for plotting
     # Map the species numbers to strings for the 'Species' column
     species_map = {0: "Rock (1)", 1: "Paper (2)", 2: "Scissors (3)"}
-    counts_df = pd.DataFrame(game_instance.history, columns=[species_map[i] for i in range(len(game_instance.species))])
+    counts_df = pd.DataFrame(history, columns=[species_map[i] for i in range(len(game_instance.species))])
 
 
     # Add an epoch number column
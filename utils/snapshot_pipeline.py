@@ -0,0 +1,122 @@
+import queue
+import threading
+import numpy as np
+from backend import is_cupy
+
+'''
+Asynchronous, double-buffered snapshot export.
+
+Saving a frame used to mean a blocking device-to-host copy followed by a synchronous HDF5 write, right in the middle of
+the simulation loop. AsyncSnapshotWriter instead:
+  1. copies the grid into a free host buffer - page-locked (pinned) and issued on a side CUDA stream on cupy, so the
+     copy overlaps the next update() kernels,
+  2. hands the buffer to a background writer thread through a bounded queue,
+  3. the writer thread waits for that copy only, writes the frame to the sink, and recycles the buffer.
+With n_buffers in flight at most, submit() blocks once the writer falls behind (backpressure), so memory stays bounded.
+'''
+
+
+class AsyncSnapshotWriter():
+    '''
+    Wraps a frame sink (anything with append(frame, step), e.g. utils.trajectory.TrajectoryWriter) so that
+    submit(grid, step) returns as soon as the copy is queued.
+
+    shape is the (H, W) frame shape, xp the game's backend (game.xp). flush() waits until every submitted frame is
+    written; close() flushes, stops the writer thread and (if close_sink) closes the sink. Errors raised by the sink
+    in the writer thread are re-raised on the next submit/flush/close
+    '''
+
+    def __init__(self, sink, shape, xp, n_buffers=2, close_sink=True):
+        self.sink = sink
+        self.shape = tuple(shape)
+        self.xp = xp
+        self.close_sink = close_sink
+        self._on_device = is_cupy(xp)
+        self._stream = xp.cuda.Stream(non_blocking=True) if self._on_device else None # Side stream for the copies
+
+        self._free_buffers = queue.Queue()
+        for _ in range(n_buffers):
+            self._free_buffers.put(self._allocate_host_buffer())
+        self._jobs = queue.Queue(maxsize=n_buffers)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer_loop, name='snapshot-writer', daemon=True)
+        self._thread.start()
+
+    def _allocate_host_buffer(self):
+        n_bytes = int(np.prod(self.shape))
+        if self._on_device:
+            # Page-locked memory is what lets the device-to-host copy run asynchronously
+            pinned = self.xp.cuda.alloc_pinned_memory(n_bytes)
+            return np.frombuffer(pinned, dtype=np.uint8, count=n_bytes).reshape(self.shape) # keeps `pinned` alive
+        return np.empty(self.shape, dtype=np.uint8)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Snapshot writer thread failed') from error
+
+    def submit(self, grid, step=None):
+        ''' Queues a copy of grid (cupy or numpy, (H, W)) to be written as frame `step`. Blocks only if every buffer is busy '''
+        if self._closed:
+            raise RuntimeError('submit() called on a closed AsyncSnapshotWriter')
+        self._raise_if_failed()
+        host_buffer = self._free_buffers.get() # Backpressure: wait for the writer to release a buffer
+
+        if self._on_device:
+            xp = self.xp
+            source = xp.ascontiguousarray(grid).astype(xp.uint8, copy=False)
+            # The side stream must not start copying before the kernels that produced `grid` have finished
+            self._stream.wait_event(xp.cuda.get_current_stream().record())
+            xp.cuda.runtime.memcpyAsync(host_buffer.ctypes.data, source.data.ptr, source.nbytes,
+                                        xp.cuda.runtime.memcpyDeviceToHost, self._stream.ptr)
+            copied = self._stream.record()
+            # `source` rides along with the job so its device memory isn't recycled before the copy completes
+            self._jobs.put((host_buffer, step, copied, source))
+        else:
+            np.copyto(host_buffer, grid, casting='unsafe')
+            self._jobs.put((host_buffer, step, None, None))
+
+    def _writer_loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+            host_buffer, step, copied, source = job
+            try:
+                if copied is not None:
+                    copied.synchronize() # Wait for this frame's copy only, not for the simulation stream
+                del source
+                if self._error is None:
+                    self.sink.append(host_buffer, step)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._free_buffers.put(host_buffer)
+                self._jobs.task_done()
+
+    def flush(self):
+        ''' Blocks until every submitted frame has been handed to the sink '''
+        self._jobs.join()
+        self._raise_if_failed()
+        if hasattr(self.sink, 'flush'):
+            self.sink.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._jobs.put(None)
+            self._thread.join()
+            if self.close_sink and hasattr(self.sink, 'close'):
+                self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
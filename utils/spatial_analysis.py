@@ -0,0 +1,199 @@
+import numpy as np
+from kernels import state_counts, N_STATES
+
+'''
+Spatial structure of our lattices: two-point correlations, structure factors and domain sizes.
+
+Everything works on (..., H, W) stacks - frames of a trajectory chunk, replicas of an ensemble - in one batch, on
+numpy or cupy, and respects the torus:
+  correlation_functions()  species-resolved C_s(r) = <d_s(x) d_s(x + r)> with d_s = [cell is s] - density of s, from
+                           |FFT|^2 (Wiener-Khinchin) instead of pairwise loops, radially averaged over torus distances
+  structure_factor()       S_s(k) = |FFT(d_s)|^2 / (H W), radially averaged over |k|
+  correlation_length()     where C_s(r) / C_s(0) first drops below 1/e
+  label_domains()          connected same-state domains by hooking and pointer jumping (whole-array passes only,
+                           no per-cell loop), domains wrapping around the torus included
+  spatial_summary()        all of the above reduced to a few numbers per state and lattice, cheap enough to call every
+                           N steps, e.g. spatial_summary(game.grid, game.xp, game.n_states)
+
+Radial bins are 1 cell wide in real space and 2 pi / min(H, W) wide in k space; the real-space curves stop at
+min(H, W) // 2, the largest distance a torus has in every direction.
+'''
+
+_radial_bins = {} # (kind, H, W, xp name) -> (bin of every displacement / wavevector, weights, counts per bin)
+
+
+def _get_radial_bins(kind, height, width, xp):
+    key = (kind, height, width, xp.__name__)
+    if key not in _radial_bins:
+        if kind == 'r':
+            # Torus distance of every displacement (dy, dx), as laid out by the inverse FFT
+            dy = np.minimum(np.arange(height), height - np.arange(height))[:, None]
+            dx = np.minimum(np.arange(width), width - np.arange(width))[None, :]
+            bins = np.rint(np.sqrt(dy ** 2 + dx ** 2)).astype(np.int64)
+            weights = np.ones((height, width))
+        else:
+            # |k| in units of 2 pi / min(H, W), over the rfft2 half plane; columns standing for two wavevectors count twice
+            side = min(height, width)
+            ky = np.fft.fftfreq(height)[:, None] * side
+            kx = np.fft.rfftfreq(width)[None, :] * side
+            bins = np.rint(np.sqrt(ky ** 2 + kx ** 2)).astype(np.int64)
+            weights = np.full(bins.shape, 2.0)
+            weights[:, 0] = 1
+            if width % 2 == 0:
+                weights[:, -1] = 1 # The Nyquist column is its own mirror image
+        n_bins = min(height, width) // 2 + 1
+        weights = np.where(bins < n_bins, weights, 0)
+        bins = np.minimum(bins, n_bins - 1)
+        counts = np.bincount(bins.reshape(-1), weights=weights.reshape(-1), minlength=n_bins)
+        _radial_bins[key] = (xp.asarray(bins), xp.asarray(weights), xp.asarray(counts))
+    return _radial_bins[key]
+
+
+def _radial_average(field, bins, weights, counts, xp):
+    lead_shape = field.shape[:-2]
+    n_bins = counts.shape[0]
+    n_fields = int(np.prod(lead_shape, dtype=np.int64))
+    # One weighted bincount for every field at once: field f's bins are offset by f * n_bins
+    offsets = (xp.arange(n_fields) * n_bins).reshape(lead_shape + (1, 1))
+    sums = xp.bincount((bins + offsets).reshape(-1), weights=(field * weights).reshape(-1), minlength=n_fields * n_bins)
+    return (sums.reshape(lead_shape + (n_bins,)) / xp.maximum(counts, 1)).astype(xp.float32)
+
+
+def _fluctuation_spectra(grid, xp, n_states):
+    # rfft2 of every state's indicator minus its density: (..., n_states, H, W // 2 + 1)
+    states = xp.arange(n_states, dtype=grid.dtype).reshape((n_states, 1, 1))
+    indicators = (grid[..., None, :, :] == states).astype(xp.float32)
+    densities = indicators.mean(axis=(-2, -1), keepdims=True)
+    return xp.fft.rfft2(indicators - densities)
+
+
+def correlation_functions(grid, xp, n_states=N_STATES):
+    '''
+    Species-resolved two-point correlation functions of a (..., H, W) stack: (r, C) with r the radial distances
+    (0, 1, ..., min(H, W) // 2) and C (..., n_states, len(r)), C[..., s, 0] = rho_s (1 - rho_s)
+    '''
+    height, width = grid.shape[-2:]
+    spectra = _fluctuation_spectra(grid, xp, n_states)
+    correlation = xp.fft.irfft2(spectra.real ** 2 + spectra.imag ** 2, s=(height, width)) / (height * width)
+    bins, weights, counts = _get_radial_bins('r', height, width, xp)
+    return xp.arange(counts.shape[0]), _radial_average(correlation, bins, weights, counts, xp)
+
+
+def structure_factor(grid, xp, n_states=N_STATES):
+    '''
+    Radially averaged structure factors of a (..., H, W) stack: (k, S) with k the wavenumbers
+    (multiples of 2 pi / min(H, W)) and S (..., n_states, len(k))
+    '''
+    height, width = grid.shape[-2:]
+    spectra = _fluctuation_spectra(grid, xp, n_states)
+    power = (spectra.real ** 2 + spectra.imag ** 2) / (height * width)
+    bins, weights, counts = _get_radial_bins('k', height, width, xp)
+    k = xp.arange(counts.shape[0]) * (2 * np.pi / min(height, width))
+    return k, _radial_average(power, bins, weights, counts, xp)
+
+
+def correlation_length(r, correlation, xp, level=1 / np.e):
+    '''
+    Distance where correlation / correlation[..., 0] first drops below level, interpolated linearly between bins
+    (nan for a state that is absent or uniform, the largest r if it never drops that far)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = correlation / correlation[..., :1]
+    below = normalized < level
+    first = xp.argmax(below, axis=-1) # 0 when nothing is below (normalized[0] is 1)
+    found = xp.any(below, axis=-1)
+    previous = xp.maximum(first - 1, 0)
+    take = lambda values, index: xp.take_along_axis(values, index[..., None], axis=-1)[..., 0]
+    high, low = take(normalized, previous), take(normalized, first)
+    fraction = xp.where(high > low, (high - level) / xp.where(high > low, high - low, 1), 0)
+    length = xp.where(found, r[previous] + fraction * (r[first] - r[previous]), r[-1])
+    return xp.where(correlation[..., 0] > 0, length, xp.nan).astype(xp.float32)
+
+
+_CONNECTIVITY = {4: [(0, 1), (1, 0)], 8: [(0, 1), (1, 0), (1, 1), (1, -1)]} # Half the neighbors: the rest mirror them
+
+
+def label_domains(grid, xp, connectivity=4):
+    '''
+    Connected domains of equal state in a (..., H, W) stack of toroidal lattices (4- or 8-connected).
+    Returns (..., H, W) int64 labels: the flat index (into the whole stack) of one cell of the cell's domain,
+    so equal labels mean the same domain and no domain spans two lattices
+    '''
+    axes = (-2, -1)
+    labels = xp.arange(grid.size, dtype=xp.int64).reshape(grid.shape)
+    # Which neighbor links join equal states, for each direction and its mirror
+    links = []
+    for dy, dx in _CONNECTIVITY[connectivity]:
+        same = grid == xp.roll(grid, (-dy, -dx), axis=axes) # cell x and its neighbor x + d
+        links.append(((-dy, -dx), same))
+        links.append(((dy, dx), xp.roll(same, (dy, dx), axis=axes))) # cell x and its neighbor x - d
+    while True:
+        # Every cell's smallest label among linked neighbors
+        smallest = labels
+        for shift, same in links:
+            smallest = xp.where(same, xp.minimum(smallest, xp.roll(labels, shift, axis=axes)), smallest)
+        hooked = smallest < labels
+        if not bool(xp.any(hooked)):
+            return labels
+        # Hook: the cell and its label's root both point at the smaller label (labels always name a cell of the same
+        # domain and only ever decrease, so this merges trees and never makes a cycle), then compress every chain
+        # to its root by pointer jumping - a few passes merge whole domains instead of creeping a cell per pass
+        flat = smallest.reshape(-1)
+        flat[labels.reshape(-1)[hooked.reshape(-1)]] = flat[hooked.reshape(-1)]
+        while True:
+            jumped = flat[flat]
+            if bool(xp.all(jumped == flat)):
+                break
+            flat = jumped
+        labels = flat.reshape(grid.shape)
+
+
+def domain_statistics(grid, xp, n_states=N_STATES, connectivity=4, labels=None):
+    '''
+    Domains of a (..., H, W) stack: a dict with 'state', 'size' and 'lattice' (flat index of its lattice in the stack)
+    of every domain, plus per lattice and state (..., n_states) 'count' (number of domains), 'mean_size' (cells per
+    domain) and 'weighted_size' (size of the domain an average cell belongs to, sum size**2 / sum size)
+    '''
+    if labels is None:
+        labels = label_domains(grid, xp, connectivity)
+    height, width = grid.shape[-2:]
+    flat_labels = labels.reshape(-1)
+    roots = xp.flatnonzero(flat_labels == xp.arange(flat_labels.size))
+    sizes = xp.bincount(flat_labels, minlength=flat_labels.size)[roots]
+    states = grid.reshape(-1)[roots].astype(xp.int64)
+    lattices = roots // (height * width)
+
+    lead_shape = grid.shape[:-2]
+    n_lattices = int(np.prod(lead_shape, dtype=np.int64))
+    bins = lattices * n_states + states
+    per_state = lambda weights: xp.bincount(bins, weights=weights, minlength=n_lattices * n_states).reshape(lead_shape + (n_states,))
+    count = per_state(None)
+    cells = state_counts(grid, xp, n_states)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_size = cells / count
+        weighted_size = per_state(sizes.astype(xp.float64) ** 2) / cells
+    return {'state': states, 'size': sizes, 'lattice': lattices, 'count': count,
+            'mean_size': mean_size.astype(xp.float32), 'weighted_size': weighted_size.astype(xp.float32)}
+
+
+def domain_size_distribution(domains, state, xp, max_size=None):
+    ''' Histogram of the sizes of one state's domains (summed over the stack): counts[s] = domains of s cells '''
+    sizes = domains['size'][domains['state'] == state]
+    return xp.bincount(sizes, minlength=(max_size or 0) + 1)
+
+
+def spatial_summary(grid, xp, n_states=N_STATES, connectivity=4):
+    '''
+    A few numbers per lattice and state (each (..., n_states)) for monitoring a run: correlation_length,
+    structure_peak_wavelength (2 pi / the k > 0 where S(k) peaks, the typical spacing of domains or spiral arms),
+    domain_count, mean_domain_size and weighted_domain_size
+    '''
+    r, correlation = correlation_functions(grid, xp, n_states)
+    k, structure = structure_factor(grid, xp, n_states)
+    peak = xp.argmax(structure[..., 1:], axis=-1) + 1 # k = 0 is the (zero) mean
+    domains = domain_statistics(grid, xp, n_states, connectivity)
+    return {'correlation_length': correlation_length(r, correlation, xp),
+            'structure_peak_wavelength': (2 * np.pi / k[peak]).astype(xp.float32),
+            'domain_count': domains['count'],
+            'mean_domain_size': domains['mean_size'],
+            'weighted_domain_size': domains['weighted_size']}
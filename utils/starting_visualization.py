@@ -1,7 +1,7 @@
 import matplotlib.pyplot as plt
-import cupy as cp
 import seaborn as sns
-import RockPaperScissors
+from backend import asnumpy
+from RockPaperScissors import RockPaperScissors
 
 
 # Create an instance of the game
@@ -13,8 +13,8 @@ game.seeding()
 #Print number of instances (species)
 print(game.counts)
 
-# Convert the CuPy grid to a NumPy array
-numpy_grid = cp.asnumpy(game.grid)
+# Bring the grid to the host as a NumPy array
+numpy_grid = asnumpy(game.grid)
 
 # Use Seaborn to create a heatmap
 plt.figure(figsize=(width/20, height/20)) # Adjust figure size based on grid dimensions
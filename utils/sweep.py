@@ -0,0 +1,248 @@
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+'''
+Parallel, resumable parameter sweeps over our RPS games (replaces the serial gamma loop in ECSG_simulation.ipynb).
+
+A sweep is a parameter grid: every combination of p (competition), q (settlement), gamma (mobility), z, density,
+dims and rule variant is one point. Points are fanned out over a process pool (optionally one GPU per worker),
+and each finished point is appended to a JSON-lines results file straight away. Re-running the same command
+skips every point already in that file, so a crashed or preempted sweep just picks up where it stopped.
+With --stop-on-extinction and/or --stationary-tolerance, a point's replicas stop before --iterations once they have
+all lost a species or settled down (run_control.py), and the record says why and when.
+
+Run from the repo root, e.g. the notebook's mobility sweep:
+  python -m utils.sweep --results entropy_mobility.jsonl --p 50 --q 50 --gamma 0:400:5 --replicas 5 --iterations 1000
+'''
+
+VARIANTS = ('neighbor-sensitive', 'agnostic')
+
+DEFAULT_GRID = {
+    'p': [50], # competition weight
+    'q': [50], # settlement weight
+    'gamma': [50], # mobility weight
+    'z': [0], # dominance + settlement weight (only enters the normalization)
+    'density': [0.25],
+    'dims': [[512, 512]],
+    'variant': ['neighbor-sensitive'],
+}
+
+
+def expand_grid(grid):
+    ''' Every combination of a {name: [values]} grid, as a list of point dicts in a stable order '''
+    grid = {**DEFAULT_GRID, **grid}
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def point_key(point, replicas, iterations, stop=None):
+    ''' Stable id of a sweep point (its parameters plus the run length), used to skip finished work on restart '''
+    run = {'point': point, 'replicas': replicas, 'iterations': iterations}
+    if stop:
+        run['stop'] = stop # Early stopping changes the results; without it, keys stay what they always were
+    payload = json.dumps(run, sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def probabilities(point):
+    ''' [p_settle, p_competition, p_mobility] from the notebook's p, q, gamma, z weights '''
+    total = point['p'] + point['q'] + point['gamma'] + point['z']
+    return [point['q'] / total, point['p'] / total, point['gamma'] / total]
+
+
+def mobility_coefficient(p_mobility):
+    ''' The notebook's 1 / -ln(mobility), with 0 for a game without mobility '''
+    if p_mobility <= 0:
+        return 0.0
+    return 1 / -math.log(p_mobility)
+
+
+class ResultStore():
+    '''
+    Append-only JSON-lines file of finished sweep points. Every append is flushed and fsynced,
+    and a torn last line (e.g. from a crash mid-write) is ignored when reading back
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        ''' All complete result records in the file '''
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue # Partially written line from an interrupted run
+        return records
+
+    def completed_keys(self):
+        return {record['key'] for record in self.load()}
+
+    def append(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def run_point(point, replicas=5, iterations=1000, backend=None, seed=None, stop=None):
+    '''
+    Simulates one sweep point: `replicas` independent games for `iterations` steps each, or until they meet the
+    early stopping criteria in `stop` (run_control.RunController arguments, e.g. {'stationary_tolerance': 0.002}).
+    Returns a JSON-serializable record with per-replica boundary complexity and final species counts
+    (with `stop`, each replica's at its own stop step, next to its stop reason)
+    '''
+    from backend import asnumpy
+    from RockPaperScissorsEnsemble import RockPaperScissorsEnsemble
+    from run_control import RunController
+
+    if point['variant'] not in VARIANTS:
+        raise ValueError(f"Unknown rule variant '{point['variant']}', expected one of {VARIANTS}")
+    probs = probabilities(point)
+    start = time.perf_counter()
+    # All replicas advance together as one batched array; replica r plays stream r, as a lone game with stream=r would
+    game = RockPaperScissorsEnsemble(replicas, point['dims'], point['density'], probs, backend=backend, seed=seed,
+                                     mode=point['variant'])
+    game.seeding()
+    if stop:
+        # Replicas that stop early keep evolving with the rest, so take each one's stats from its own stop step
+        controller = RunController(game, iterations, **stop)
+        controller.run()
+        entropies = controller.stop_entropy.tolist()
+        counts = controller.stop_counts[..., game.species].tolist()
+    else:
+        for _ in range(iterations):
+            game.update()
+        entropies = asnumpy(game.get_entropy()).tolist()
+        counts = asnumpy(game.xp.stack(game._species_counts(), axis=-1)).tolist()
+
+    record = {
+        'point': point,
+        'p_settle': probs[0], 'p_competition': probs[1], 'p_mobility': probs[2],
+        'mobility_coefficient': mobility_coefficient(probs[2]),
+        'replicas': replicas,
+        'iterations': iterations,
+        'seed': seed,
+        'entropies': entropies,
+        'entropy_mean': sum(entropies) / len(entropies),
+        'final_counts': counts,
+        'seconds': time.perf_counter() - start,
+    }
+    if stop:
+        record.update(stop=stop, steps=int(game.step), stop_reason=controller.reason, stop_reasons=controller.reasons.tolist(),
+                      stop_steps=controller.stop_steps.tolist())
+    return record
+
+
+def _init_worker(device_queue):
+    ''' Pins each worker process to one GPU (taken from the queue) before cupy is ever imported in it '''
+    if device_queue is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(device_queue.get())
+
+
+def _run_keyed(key, point, replicas, iterations, backend, seed, stop):
+    record = run_point(point, replicas, iterations, backend, seed, stop)
+    record['key'] = key
+    return record
+
+
+def run_sweep(grid, results_path, replicas=5, iterations=1000, workers=None, devices=None, backend=None, seed=0, progress=True,
+              stop=None):
+    '''
+    Runs every point of `grid` not already in `results_path`, streaming records to it as points finish.
+
+    workers defaults to one per device when devices (a list of GPU ids) is given, else to the CPU count.
+    Each point's seed is derived from `seed` and the point itself, so a resumed sweep reproduces the same runs.
+    stop (RunController arguments) ends each point's run early once its criteria are met
+    Returns the list of records appended by this call
+    '''
+    store = ResultStore(results_path)
+    done = store.completed_keys()
+    pending = []
+    for point in expand_grid(grid):
+        key = point_key(point, replicas, iterations, stop)
+        if key not in done:
+            pending.append((key, point))
+    if progress:
+        print(f"{len(pending)} sweep points to run ({len(done)} already in '{results_path}')")
+    if not pending:
+        return []
+
+    if workers is None:
+        workers = len(devices) if devices else os.cpu_count()
+    # 'spawn' so no worker inherits a parent's CUDA context
+    context = mp.get_context('spawn')
+    device_queue = None
+    if devices:
+        device_queue = context.Queue()
+        for worker in range(workers):
+            device_queue.put(devices[worker % len(devices)])
+
+    finished = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(device_queue,)) as pool:
+        futures = [pool.submit(_run_keyed, key, point, replicas, iterations, backend,
+                               None if seed is None else seed + int(key[:8], 16), stop)
+                   for key, point in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            store.append(record) # Persist immediately, so a crash loses at most the points in flight
+            finished.append(record)
+            if progress:
+                print(f"[{len(finished)}/{len(pending)}] {record['point']} -> entropy {record['entropy_mean']:.4f} ({record['seconds']:.1f}s)")
+    return finished
+
+
+def _parse_values(text, cast=float):
+    ''' "0:400:5" -> 0, 5, ..., 400 (inclusive, like the notebook's loop); "1,2,3" -> [1, 2, 3] '''
+    if ':' in text:
+        start, stop, step = (cast(part) for part in text.split(':'))
+        count = int(round((stop - start) / step)) + 1
+        return [cast(start + i * step) for i in range(count)]
+    return [cast(part) for part in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resumable parallel parameter sweep over RPS games')
+    parser.add_argument('--results', required=True, help='JSON-lines results file (appended to, and used to resume)')
+    parser.add_argument('--p', default='50', help="competition weights, e.g. '50' or '10,50' or '0:100:10'")
+    parser.add_argument('--q', default='50', help='settlement weights')
+    parser.add_argument('--gamma', default='50', help='mobility weights')
+    parser.add_argument('--z', default='0', help='dominance + settlement weights')
+    parser.add_argument('--density', default='0.25')
+    parser.add_argument('--dims', default='512x512', help="comma-separated lattice sizes, e.g. '256x256,512x512'")
+    parser.add_argument('--variant', default='neighbor-sensitive', help=f"comma-separated subset of {VARIANTS}")
+    parser.add_argument('--replicas', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--devices', type=int, nargs='*', default=None, help='GPU ids to spread workers over')
+    parser.add_argument('--backend', default=None, help="'cupy', 'numpy' or 'auto' (default: RPS_BACKEND)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stop-on-extinction', action='store_true', help='stop a point once every replica has lost a species')
+    parser.add_argument('--stationary-tolerance', type=float, default=None,
+                        help='stop a point once no replica\'s state densities drift by more than this over a window of checks')
+    parser.add_argument('--check-every', type=int, default=50, help='steps between early stopping checks')
+    args = parser.parse_args()
+
+    sweep_grid = {
+        'p': _parse_values(args.p), 'q': _parse_values(args.q), 'gamma': _parse_values(args.gamma), 'z': _parse_values(args.z),
+        'density': _parse_values(args.density),
+        'dims': [[int(n) for n in dims.split('x')] for dims in args.dims.split(',')],
+        'variant': args.variant.split(','),
+    }
+    stop = None
+    if args.stop_on_extinction or args.stationary_tolerance is not None:
+        stop = {'check_every': args.check_every, 'extinction': args.stop_on_extinction,
+                'stationary_tolerance': args.stationary_tolerance}
+    run_sweep(sweep_grid, args.results, args.replicas, args.iterations, args.workers, args.devices, args.backend, args.seed,
+              stop=stop)
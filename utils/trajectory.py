@@ -0,0 +1,142 @@
+import json
+import numpy as np
+import h5py
+from backend import asnumpy
+
+'''
+HDF5 trajectories of our RPS games.
+
+A trajectory file holds one extendable (T, H, W) uint8 dataset 'frames' (chunked one frame per chunk and compressed)
+plus a (T,) 'steps' dataset recording the simulation step of every frame. Run parameters and the seed are stored as
+attributes of the file. Reading frame t touches exactly one chunk, so random access is O(1) however long the run.
+
+Older files with one 'epoch_XXXXX' dataset per frame can still be read through TrajectoryReader.
+'''
+
+FORMAT_VERSION = 1
+
+# 'blosc' is only available when the hdf5plugin package is installed
+try:
+    import hdf5plugin
+    BLOSC_AVAILABLE = True
+except Exception:
+    BLOSC_AVAILABLE = False
+
+MAX_CHUNK_SIDE = 1024 # Frames bigger than this are split into tiles, so a chunk stays around 1 MB
+
+
+def _compression_kwargs(compression, level):
+    if compression in (None, 'none'):
+        return {}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if level is None else level}
+    if compression == 'lzf':
+        return {'compression': 'lzf'}
+    if compression == 'blosc':
+        if not BLOSC_AVAILABLE:
+            raise ValueError("blosc compression needs the hdf5plugin package (pip install hdf5plugin)")
+        return dict(hdf5plugin.Blosc(cname='zstd', clevel=5 if level is None else level, shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+    raise ValueError(f"Unknown compression '{compression}', expected 'gzip', 'lzf', 'blosc' or None")
+
+
+class TrajectoryWriter():
+    '''
+    Appends frames of a simulation to a single chunked, compressed (T, H, W) uint8 dataset.
+
+    shape is the (H, W) lattice shape. params (any JSON-serializable dict, e.g. dims/density/probs) and seed are
+    stored as file attributes. Use as a context manager, or call close() when done
+    '''
+
+    def __init__(self, path, shape, params=None, seed=None, compression='gzip', compression_level=None):
+        self.path = path
+        self.shape = tuple(shape)
+        self.file = h5py.File(path, 'w')
+        height, width = self.shape
+        chunks = (1, min(height, MAX_CHUNK_SIDE), min(width, MAX_CHUNK_SIDE))
+        self.frames = self.file.create_dataset('frames', shape=(0,) + self.shape, maxshape=(None,) + self.shape,
+                                               dtype=np.uint8, chunks=chunks, **_compression_kwargs(compression, compression_level))
+        self.steps = self.file.create_dataset('steps', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(4096,))
+        self.file.attrs['format_version'] = FORMAT_VERSION
+        self.file.attrs['params'] = json.dumps(params or {})
+        self.file.attrs['seed'] = -1 if seed is None else seed # HDF5 attributes can't hold None
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def append(self, grid, step=None):
+        ''' Writes one frame (a cupy or numpy (H, W) grid); step defaults to the frame index '''
+        frame = asnumpy(grid).astype(np.uint8, copy=False)
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match the trajectory shape {self.shape}")
+        t = len(self)
+        self.frames.resize(t + 1, axis=0)
+        self.steps.resize(t + 1, axis=0)
+        self.frames.write_direct(np.ascontiguousarray(frame), dest_sel=np.s_[t])
+        self.steps[t] = t if step is None else step
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TrajectoryReader():
+    '''
+    Random access to the frames of a trajectory file: len(reader), reader[t], reader[t0:t1] (one hyperslab read),
+    and iteration. Also reads the legacy one-dataset-per-epoch layout
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        if 'frames' in self.file:
+            self.frames = self.file['frames']
+            self.steps = self.file['steps'][()]
+            self._legacy_names = None
+        else:
+            # Legacy layout: datasets named 'epoch_00000', 'epoch_00005', ...
+            self._legacy_names = sorted(name for name in self.file.keys() if name.startswith('epoch_'))
+            self.frames = None
+            self.steps = np.array([int(name[len('epoch_'):]) for name in self._legacy_names], dtype=np.int64)
+        self.params = json.loads(self.file.attrs.get('params', '{}'))
+        seed = int(self.file.attrs.get('seed', -1))
+        self.seed = None if seed < 0 else seed
+
+    @property
+    def shape(self):
+        ''' (H, W) of one frame '''
+        if self.frames is not None:
+            return self.frames.shape[1:]
+        return self.file[self._legacy_names[0]].shape if self._legacy_names else (0, 0)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, index):
+        if self.frames is not None:
+            return self.frames[index]
+        if isinstance(index, slice):
+            return np.stack([self.file[name][()] for name in self._legacy_names[index]])
+        return self.file[self._legacy_names[index]][()]
+
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self[t]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
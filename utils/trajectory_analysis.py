@@ -0,0 +1,204 @@
+import argparse
+import csv
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from kernels import state_counts
+from entropy import entropy_log_table, pair_histogram, complexity_from_histogram
+from rules import RuleSet
+from utils.trajectory import TrajectoryReader
+
+'''
+Out-of-core analysis of saved trajectories: per-frame populations, boundary complexity and interface lengths.
+
+The trajectory is read in chunks of frames (one HDF5 hyperslab each, so memory stays at a chunk per worker however
+long the run) and every chunk is analyzed as one (T, H, W) batch: the same batched pair-histogram and bincount kernels
+get_entropy() uses, so the entropy column matches what get_entropy() returned during the run. Chunks are spread
+over a process pool and their rows written to a columnar table as they arrive, in frame order:
+a Parquet file (needs pyarrow) or CSV, by the output's extension.
+
+Columns: frame, step, one count per state ('empty', then the species' names), entropy (the boundary complexity,
+if the probabilities are known), interface (unordered pairs of unlike 8-neighbors, i.e. the length of all domain
+boundaries) and species_interface (the same between two species only, so empty space doesn't count as a boundary).
+
+Probabilities default to the trajectory's 'probs' parameter and the rules to its 'rules' parameter (RuleSet
+arguments) or else our rock/paper/scissors. Run from the repo root, e.g.:
+  python -m utils.trajectory_analysis simulation_grids.h5 stats.parquet --workers 8
+'''
+
+# pyarrow is optional: without it results can still be written as CSV
+try:
+    import pyarrow
+    import pyarrow.parquet
+    PYARROW_AVAILABLE = True
+except Exception:
+    PYARROW_AVAILABLE = False
+
+
+def analyze_frames(frames, n_states, log_table=None):
+    '''
+    Statistics of a (T, H, W) batch of frames as a dict of length-T columns: 'counts' (T, n_states),
+    'interface', 'species_interface' and, given the (n_states, n_states) log q table, 'entropy'
+    '''
+    frames = np.asarray(frames)
+    n_cells = frames.shape[-2] * frames.shape[-1]
+    pairs = pair_histogram(frames, np, n_states).astype(np.int64) # (T, n_states, n_states) ordered (cell, neighbor) pairs
+    counts = state_counts(frames, np, n_states)
+    like_pairs = np.trace(pairs, axis1=-2, axis2=-1)
+    species_pairs = pairs[:, 1:, 1:].sum(axis=(-2, -1))
+    columns = {'counts': counts,
+               'interface': (8 * n_cells - like_pairs) // 2, # Each unordered pair appears twice in the histogram
+               'species_interface': (species_pairs - (like_pairs - pairs[:, 0, 0])) // 2}
+    if log_table is not None:
+        columns['entropy'] = complexity_from_histogram(pairs, counts / n_cells, log_table, n_cells, np)
+    return columns
+
+
+def trajectory_rules(reader, probs=None, rules=None):
+    ''' The (rules, log q table or None) to analyze a trajectory with, from the arguments or its parameters '''
+    if rules is None:
+        rules = RuleSet(**reader.params['rules']) if 'rules' in reader.params else RuleSet.rps()
+    probs = reader.params.get('probs') if probs is None else probs
+    log_table = None
+    if probs is not None:
+        log_table = entropy_log_table(probs[0], probs[1], np, rules.interaction)
+    return rules, log_table
+
+
+# Each worker process opens the trajectory once and keeps it for all the chunks it analyzes
+_worker_reader = None
+
+
+def _init_worker(path):
+    global _worker_reader
+    _worker_reader = TrajectoryReader(path)
+
+
+def _analyze_range(frame_range, every, n_states, log_table, reader=None):
+    start, stop = frame_range
+    reader = reader or _worker_reader
+    columns = analyze_frames(reader[start:stop:every], n_states, log_table)
+    columns['frame'] = np.arange(start, stop, every)
+    columns['step'] = reader.steps[start:stop:every]
+    return columns
+
+
+class _TableWriter():
+    ''' Appends chunks of rows to a Parquet (row group per chunk) or CSV file '''
+
+    def __init__(self, path, names):
+        self.path = path
+        self.names = names
+        self.parquet = path.lower().endswith('.parquet')
+        if self.parquet and not PYARROW_AVAILABLE:
+            raise ValueError("Writing Parquet needs the pyarrow package (pip install pyarrow); use a .csv output instead")
+        self._writer = None
+        if not self.parquet:
+            self._file = open(path, 'w', newline='')
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(names)
+
+    def write(self, table):
+        if self.parquet:
+            batch = pyarrow.table({name: table[name] for name in self.names})
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(self.path, batch.schema)
+            self._writer.write_table(batch)
+        else:
+            self._csv.writerows(zip(*(table[name].tolist() for name in self.names)))
+
+    def close(self):
+        if self.parquet:
+            if self._writer is not None:
+                self._writer.close()
+        else:
+            self._file.close()
+
+
+def _table_columns(columns, state_names):
+    # Flattens a chunk's results into named 1-D columns
+    table = {'frame': columns['frame'], 'step': columns['step']}
+    for state, name in enumerate(state_names):
+        table[name] = columns['counts'][:, state]
+    if 'entropy' in columns:
+        table['entropy'] = columns['entropy']
+    table['interface'] = columns['interface']
+    table['species_interface'] = columns['species_interface']
+    return table
+
+
+def analyze_trajectory(path, output=None, probs=None, rules=None, start=0, stop=None, every=1, chunk=64, workers=None,
+                       progress=False):
+    '''
+    Analyzes frames start, start + every, ... (up to stop) of a trajectory file, `chunk` frames per task on
+    `workers` processes (None: one per core, 0: in this process). Writes the table to output (.parquet or .csv)
+    if given, chunk by chunk, and returns it as a dict of numpy columns
+    '''
+    with TrajectoryReader(path) as reader:
+        n_frames = len(reader)
+        rules, log_table = trajectory_rules(reader, probs, rules)
+    stop = n_frames if stop is None else min(stop, n_frames)
+    span = chunk * every
+    ranges = [(t, min(t + span, stop)) for t in range(start, stop, span)]
+    state_names = ['empty'] + [name.replace(' ', '_') for name in rules.names]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    begin = time.perf_counter()
+    chunks = []
+    writer = None
+    try:
+        def collect(columns):
+            nonlocal writer
+            table = _table_columns(columns, state_names)
+            if output is not None:
+                if writer is None:
+                    writer = _TableWriter(output, list(table))
+                writer.write(table)
+            chunks.append(table)
+            if progress:
+                print(f"\r{sum(len(c['frame']) for c in chunks)} frames analyzed", end='', flush=True)
+
+        if workers == 0:
+            with TrajectoryReader(path) as reader:
+                for frame_range in ranges:
+                    collect(_analyze_range(frame_range, every, rules.n_states, log_table, reader))
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(path,)) as pool:
+                # Chunks are submitted ahead but collected (and written) strictly in frame order
+                pending = deque()
+                next_range = 0
+                while pending or next_range < len(ranges):
+                    while next_range < len(ranges) and len(pending) < 2 * workers:
+                        pending.append(pool.submit(_analyze_range, ranges[next_range], every, rules.n_states, log_table))
+                        next_range += 1
+                    collect(pending.popleft().result())
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if not chunks:
+        return {}
+    table = {name: np.concatenate([c[name] for c in chunks]) for name in chunks[0]}
+    if progress:
+        print(f"\r{len(table['frame'])} frames analyzed in {time.perf_counter() - begin:.1f} s")
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-frame counts, boundary complexity and interface lengths of a trajectory')
+    parser.add_argument('trajectory', help='HDF5 trajectory file (utils/trajectory.py)')
+    parser.add_argument('output', help='results table, .parquet (needs pyarrow) or .csv')
+    parser.add_argument('--probs', type=float, nargs=3, default=None, metavar=('P_SETTLE', 'P_COMPETITION', 'P_MOBILITY'),
+                        help="probabilities for the entropy (default: the trajectory's 'probs' parameter)")
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stop', type=int, default=None)
+    parser.add_argument('--every', type=int, default=1, help='analyze every N-th frame')
+    parser.add_argument('--chunk', type=int, default=64, help='frames per task')
+    parser.add_argument('--workers', type=int, default=None, help='processes (default: one per core, 0: none)')
+    args = parser.parse_args()
+
+    analyze_trajectory(args.trajectory, args.output, probs=args.probs, start=args.start, stop=args.stop,
+                       every=args.every, chunk=args.chunk, workers=args.workers, progress=True)